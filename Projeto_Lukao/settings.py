@@ -168,6 +168,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'core',
     'user',
     'checkout',
@@ -220,6 +221,18 @@ DATABASES = {
 }
 
 
+# Cache: o backend real vai em OPTIONS; core.metricas_cache conta acertos, faltas e latência por prefixo
+CACHES = {
+    'default': {
+        'BACKEND': 'core.metricas_cache.CacheInstrumentado',
+        'OPTIONS': {
+            'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+            'LOCATION': os.getenv('CACHE_LOCATION', ''),
+        },
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -271,6 +284,9 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Garante que o diretório media exista
 os.makedirs(MEDIA_ROOT, exist_ok=True)
 
+# URL pública do site, usada nos links absolutos do feed de produtos e do sitemap
+SITE_URL = os.getenv('SITE_URL', 'http://localhost:8000')
+
 # Configurações para os tipos de arquivos permitidos (opcional)
 ALLOWED_FILE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'pdf']
 MAX_UPLOAD_SIZE = 5242880  # 5MB
@@ -36,6 +36,10 @@ urlpatterns = [
     path('salvar-cep/', salvar_cep_usuario, name='salvar_cep_usuario'),
     path('calcular-frete/', calcular_frete, name='calcular_frete'),    
     path('api/cart/count/', cart_count, name='cart_count'),
+    path('api/produtos/', ProdutosAPIView.as_view(), name='api-produtos'),
+    path('api/search/suggest/', sugestoes_busca, name='api-sugestoes'),
+    path('api/cache/metricas/', metricas_cache, name='api-metricas-cache'),
+    path('sitemap.xml', sitemap_xml, name='sitemap'),
     
     path('checkout/', include('checkout.urls', namespace='checkout')),
     path('user/', include('user.urls', namespace='user')),
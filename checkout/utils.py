@@ -7,7 +7,7 @@ from django.conf import settings
 from decimal import Decimal
 import logging
 from django.core.cache import cache
-from functools import lru_cache, wraps
+from functools import wraps
 from typing import Dict, List, Tuple, Optional, Any
 from asgiref.sync import sync_to_async
 import aiohttp
@@ -15,6 +15,7 @@ from django.core.exceptions import ValidationError
 import re
 from uuid import uuid4
 from core.models import ReservaEstoque, ProtecaoCarrinho
+from core.cache import invalidar_namespace, montar_chave, tag
 
 
 # Configuração de logging
@@ -25,7 +26,6 @@ CARRINHO_CONFIG = {
     'MAX_QUANTIDADE': 99,
     'CACHE_TIMEOUT': 3600,
     'SESSION_KEY': 'carrinho',
-    'CACHE_PREFIX': 'carrinho_',
     'MAX_ITENS': 50,
     'RATE_LIMIT': 60,  # requisições por minuto
 }
@@ -57,6 +57,15 @@ def get_cache_key(prefix: str, *args) -> str:
     key_parts = [prefix] + [str(arg) for arg in args]
     return '_'.join(key_parts)
 
+def tags_itens_carrinho(itens_carrinho: List[Dict]) -> List[str]:
+    """Tags de cache (core.cache) dos produtos e variações dos itens"""
+    tags = []
+    for item in itens_carrinho:
+        tags.append(tag('produto', item['produto'].id))
+        if item.get('variacao'):
+            tags.append(tag('variacao', item['variacao'].id))
+    return tags
+
 # Exceções personalizadas
 class CarrinhoError(Exception):
     """Exceção base para erros do carrinho"""
@@ -117,13 +126,12 @@ def cache_result(timeout: int = 3600):
 # Funções relacionadas ao carrinho
 # ==========================
 
-@lru_cache(maxsize=128)
 async def obter_carrinho_usuario(request) -> Optional[Carrinho]:
     """Obtém o carrinho do usuário com cache"""
     if not request.user.is_authenticated:
         return None
         
-    cache_key = get_cache_key(CARRINHO_CONFIG['CACHE_PREFIX'], request.user.id)
+    cache_key = montar_chave('carrinho', 'checkout', escopo=request.user.id)
     carrinho = cache.get(cache_key)
     
     if carrinho is None:
@@ -132,7 +140,6 @@ async def obter_carrinho_usuario(request) -> Optional[Carrinho]:
         
     return carrinho
 
-@lru_cache(maxsize=256)
 async def validar_itens_carrinho(itens: List[ItemCarrinho]) -> Tuple[set, set]:
     """Valida todos os itens do carrinho em uma única query"""
     produto_ids = [item.produto.id for item in itens]
@@ -354,7 +361,7 @@ async def adicionar_ao_carrinho(request, produto_id: int, variacao_id: Optional[
             await atualizar_protecao_carrinho(request, carrinho.itens.all())
             
             # Invalida cache
-            cache.delete(get_cache_key(CARRINHO_CONFIG['CACHE_PREFIX'], request.user.id))
+            invalidar_namespace('carrinho', request.user.id)
             
         return {'success': True, 'message': 'Item adicionado ao carrinho'}
         
@@ -395,7 +402,7 @@ async def remover_do_carrinho(request, produto_key):
     await atualizar_protecao_carrinho(request, carrinho.itens.all())
     
     # Invalida cache
-    cache.delete(get_cache_key(CARRINHO_CONFIG['CACHE_PREFIX'], request.user.id))
+    invalidar_namespace('carrinho', request.user.id)
     
     return {'success': True, 'message': 'Item removido do carrinho'}
 
@@ -524,7 +531,7 @@ async def migrar_carrinho_sessao_para_banco(request):
             )
             
             # Limpa cache
-            cache.delete(get_cache_key(CARRINHO_CONFIG['CACHE_PREFIX'], request.user.id))
+            invalidar_namespace('carrinho', request.user.id)
             
     except Exception as e:
         logger.error(f"Erro ao migrar carrinho: {str(e)}")
@@ -607,7 +614,6 @@ async def cotar_frete_melhor_envio(cep_destino: str, token: str, produtos: List[
             
     return []
 
-@lru_cache(maxsize=128)
 def preparar_produtos_para_frete(itens_carrinho: List[Dict]) -> List[Dict]:
     """Prepara a lista de produtos para cálculo de frete"""
     produtos = []
@@ -685,7 +691,6 @@ async def criar_envio_melhor_envio(pedido, token: str) -> Optional[Dict]:
             
     return None
 
-@lru_cache(maxsize=64)
 def montar_payload_envio(pedido) -> Dict:
     """Monta payload do envio"""
     def safe_str(val: Any) -> str:
@@ -12,7 +12,7 @@ from django.views.generic import TemplateView, UpdateView, CreateView, FormView,
 from django.db import transaction
 from django.utils import timezone
 from django.core.cache import cache
-from functools import wraps, lru_cache
+from functools import wraps
 import logging
 import hashlib
 
@@ -25,9 +25,11 @@ from .utils import (
     verificar_protecao_carrinho,
     atualizar_protecao_carrinho,
     sanitizar_input,
-    get_cache_key
+    get_cache_key,
+    tags_itens_carrinho
 )
 from core.models import Endereco, Pedido, ItemPedido, LogAcao, ProdutoVariacao, ReservaEstoque, LogEstoque, Cupom
+from core.cache import get_or_compute, invalidar_namespace, montar_chave, tag
 
 
 # Configuração do logger
@@ -174,11 +176,6 @@ def rate_limit(view_func):
         return view_func(request, *args, **kwargs)
     return wrapper
 
-# Cache para endereços
-@lru_cache(maxsize=100)
-def get_endereco_cache(user_id):
-    return Endereco.objects.select_related('usuario').filter(usuario_id=user_id)
-
 # ==========================
 # Formulários auxiliares
 # ==========================
@@ -216,7 +213,8 @@ class EnderecoEditView(UpdateView):
     success_url = reverse_lazy('checkout:select_address')
 
     def get_queryset(self):
-        return get_endereco_cache(self.request.user.id)
+        # QuerySet novo a cada requisição: a edição precisa ler o endereço atual do banco
+        return Endereco.objects.select_related('usuario').filter(usuario_id=self.request.user.id)
 
     def form_valid(self, form):
         try:
@@ -227,10 +225,9 @@ class EnderecoEditView(UpdateView):
                     acao="Editou endereço",
                     detalhes=f"Endereço ID: {self.object.id}"
                 )
-                # Limpa cache relacionado ao endereço
+                # Limpa cache relacionado ao endereço (a lista do cabeçalho sai pela tag 'usuario')
                 cache_keys = [
                     f'endereco_{self.object.id}',
-                    f'enderecos_usuario_{self.request.user.id}',
                     f'endereco_pedido_{self.request.user.id}'
                 ]
                 cache.delete_many(cache_keys)
@@ -271,8 +268,6 @@ class EnderecoCreateView(CreateView):
                 acao="Criou endereço",
                 detalhes=f"Endereço ID: {self.object.id}"
             )
-            # Limpa cache relacionado aos endereços do usuário
-            cache.delete(f'enderecos_usuario_{self.request.user.id}')
         return response
 
     def form_invalid(self, form):
@@ -429,16 +424,17 @@ class OrderSummaryView(LoginRequiredMixin, TemplateView):
         
         try:
             # Obtém itens do carrinho com cache
-            cache_key = get_cache_key(self.request, 'itens_carrinho')
-            cached_data = cache.get(cache_key)
-            
-            if cached_data is None:
-                itens_carrinho, subtotal = obter_itens_do_carrinho(self.request)
-                cached_data = {'itens': itens_carrinho, 'subtotal': subtotal}
-                cache.set(cache_key, cached_data, CACHE_TIMEOUT)
-            else:
-                itens_carrinho = cached_data['itens']
-                subtotal = cached_data['subtotal']
+            cache_key = montar_chave('carrinho', 'resumo_pedido', escopo=self.request.user.id)
+
+            def _calcular():
+                itens, subtotal = obter_itens_do_carrinho(self.request)
+                return {'itens': itens, 'subtotal': subtotal}
+
+            cached_data = get_or_compute(
+                cache_key, _calcular, CACHE_TIMEOUT, tags=lambda dados: tags_itens_carrinho(dados['itens'])
+            )
+            itens_carrinho = cached_data['itens']
+            subtotal = cached_data['subtotal']
             
             # Informações de frete
             frete_info = self.request.session.get('frete_escolhido')
@@ -497,16 +493,18 @@ class OrderSummaryView(LoginRequiredMixin, TemplateView):
         desconto = Decimal('0.00')
         
         if cupom_codigo:
-            cache_key = f'cupom_{cupom_codigo}'
-            cupom_data = cache.get(cache_key)
-            
-            if cupom_data is None:
+            # Por usuário e total: o resultado depende dos dois, não só do código
+            cache_key = montar_chave('carrinho', 'cupom', cupom_codigo, total, escopo=self.request.user.id)
+
+            def _calcular():
+                cupom = None
+                desconto = Decimal('0.00')
+                total_com_cupom = total
                 try:
                     cupom = Cupom.objects.select_related('usuario').get(codigo__iexact=cupom_codigo)
                     if cupom.is_valido(self.request.user):
                         total_com_cupom = cupom.aplicar(total)
                         desconto = total - total_com_cupom
-                        total = total_com_cupom
                     else:
                         self.request.session.pop('cupom', None)
                         cupom = None
@@ -514,17 +512,20 @@ class OrderSummaryView(LoginRequiredMixin, TemplateView):
                     logger.error(f"Erro ao validar cupom: {str(e)}")
                     self.request.session.pop('cupom', None)
                     cupom = None
-                    
-                cupom_data = {
+
+                return {
                     'cupom': cupom,
                     'desconto': desconto,
-                    'total': total
+                    'total': total_com_cupom
                 }
-                cache.set(cache_key, cupom_data, CACHE_TIMEOUT)
-            else:
-                cupom = cupom_data['cupom']
-                desconto = cupom_data['desconto']
-                total = cupom_data['total']
+
+            cupom_data = get_or_compute(
+                cache_key, _calcular, CACHE_TIMEOUT,
+                tags=lambda dados: [tag('cupom', dados['cupom'].codigo)] if dados['cupom'] else []
+            )
+            cupom = cupom_data['cupom']
+            desconto = cupom_data['desconto']
+            total = cupom_data['total']
                 
         return {
             'cupom': cupom,
@@ -737,7 +738,6 @@ def salvar_cep_usuario(request):
                             endereco.save(update_fields=['cep'])
                             # Limpa cache relacionado ao endereço
                             cache.delete(f'endereco_{endereco.id}')
-                            cache.delete(f'enderecos_usuario_{request.user.id}')
                             cache.delete(f'endereco_pedido_{request.user.id}')
                             
                             LogAcao.objects.create(
@@ -963,7 +963,7 @@ def cancelar_pedido(request, pedido_id):
             atualizar_protecao_carrinho(request, carrinho.itens.all())
             
             # Invalida cache
-            cache.delete(get_cache_key(request, 'carrinho'))
+            invalidar_namespace('carrinho', carrinho.usuario_id)
             
             messages.success(request, "Pedido cancelado com sucesso")
             return JsonResponse({'success': True})
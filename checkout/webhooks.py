@@ -14,10 +14,10 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 from core.models import ReservaEstoque, LogEstoque
 import logging
-from django.core.cache import cache
 import hmac
 import hashlib
-from .utils import sanitizar_input, verificar_protecao_carrinho, get_cache_key, atualizar_protecao_carrinho
+from .utils import sanitizar_input, verificar_protecao_carrinho, atualizar_protecao_carrinho
+from core.cache import invalidar_namespace
 from user.models import Notificacao
 
 
@@ -215,7 +215,7 @@ def webhook_pagamento(request):
             atualizar_protecao_carrinho(request, carrinho.itens.all())
             
             # Invalida cache
-            cache.delete(get_cache_key(request, 'carrinho'))
+            invalidar_namespace('carrinho', carrinho.usuario_id)
             
             return JsonResponse({'success': True})
             
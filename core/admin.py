@@ -1,10 +1,15 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.exceptions import ValidationError
+from django.template.response import TemplateResponse
 from .models import (
     Categoria, Produto, Endereco, Pedido, ItemPedido, Marca, ProdutoVariacao,
     ImagemProduto, AvaliacaoProduto, Cupom, HistoricoPreco, Tag,
     LogStatusPedido, LogAcao, Carrinho, ItemCarrinho, Reembolso,
     Notification, AtributoTipo, AtributoValor
 )
+from .variacoes import gerar_combinacoes
 
 @admin.register(Categoria)
 class CategoriaAdmin(admin.ModelAdmin):
@@ -34,6 +39,20 @@ class MarcaAdmin(admin.ModelAdmin):
     search_fields = ('nome',)
     prepopulated_fields = {"slug": ("nome",)}
 
+class GerarVariacoesForm(forms.Form):
+    valores = forms.ModelMultipleChoiceField(
+        queryset=AtributoValor.objects.filter(ativo=True, tipo__ativo=True).select_related('tipo').order_by(
+            'tipo__ordem', 'tipo__nome', 'ordem', 'valor'
+        ),
+        widget=forms.CheckboxSelectMultiple,
+        help_text="Uma variação para cada combinação entre os tipos (ex.: cores x tamanhos)"
+    )
+    estoque = forms.IntegerField(min_value=0, initial=0)
+    preco_adicional = forms.DecimalField(
+        min_value=0, max_digits=10, decimal_places=2, required=False,
+        help_text="Em branco: soma do valor adicional de cada atributo"
+    )
+
 @admin.register(Produto)
 class ProdutoAdmin(admin.ModelAdmin):
     list_display = ('id', 'nome', 'preco', 'categoria', 'ativo', 'destaque')
@@ -41,9 +60,56 @@ class ProdutoAdmin(admin.ModelAdmin):
     search_fields = ('nome', 'descricao')
     list_editable = ('preco', 'ativo', 'destaque')
     prepopulated_fields = {"slug": ("nome",)}
+    actions = ['gerar_variacoes']
+
+    @admin.action(description="Gerar matriz de variações")
+    def gerar_variacoes(self, request, queryset):
+        form = GerarVariacoesForm(request.POST if 'aplicar' in request.POST else None)
+        if form.is_valid():
+            criadas = 0
+            try:
+                for produto in queryset:
+                    criadas += len(gerar_combinacoes(
+                        produto,
+                        [valor.id for valor in form.cleaned_data['valores']],
+                        estoque=form.cleaned_data['estoque'],
+                        preco_adicional=form.cleaned_data['preco_adicional'],
+                    ))
+            except ValidationError as e:
+                self.message_user(request, ' '.join(e.messages), messages.ERROR)
+                return None
+            self.message_user(request, f"{criadas} variações criadas; combinações existentes foram mantidas.")
+            return None
+
+        return TemplateResponse(request, 'admin/core/produto/gerar_variacoes.html', {
+            **self.admin_site.each_context(request),
+            'title': "Gerar matriz de variações",
+            'form': form,
+            'produtos': queryset,
+            'opts': self.model._meta,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+
+class ProdutoVariacaoAdminForm(forms.ModelForm):
+    class Meta:
+        model = ProdutoVariacao
+        fields = '__all__'
+
+    def clean(self):
+        # O clean do modelo vê os atributos já gravados; aqui valem os do formulário
+        dados = super().clean()
+        if dados.get('produto') and dados.get('atributos') is not None:
+            try:
+                ProdutoVariacao.validar_combinacao(
+                    dados['produto'].pk, [valor.pk for valor in dados['atributos']], self.instance.pk
+                )
+            except ValidationError as e:
+                self.add_error('atributos', e)
+        return dados
 
 @admin.register(ProdutoVariacao)
 class ProdutoVariacaoAdmin(admin.ModelAdmin):
+    form = ProdutoVariacaoAdminForm
     list_display = ('id', 'produto', 'estoque', 'preco_adicional', 'sku')
     list_filter = ('produto',)
     search_fields = ('produto__nome', 'sku')
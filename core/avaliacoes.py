@@ -0,0 +1,75 @@
+"""
+Agregados de avaliação por produto.
+
+Produto guarda, só para avaliações aprovadas, o total, a soma das notas e
+a quantidade por nota (1 a 5). Os signals de AvaliacaoProduto ajustam esses
+campos com F() na mesma transação em que a avaliação é criada, aprovada,
+alterada ou removida; recalcular_avaliacoes corrige eventuais desvios.
+"""
+import logging
+from typing import Iterable, Optional
+
+from django.db.models import Count, F, Q, Sum
+
+from core.models import AvaliacaoProduto, Produto
+
+logger = logging.getLogger(__name__)
+
+AVALIACOES_CONFIG = {
+    'TAMANHO_LOTE': 500,
+    'NOTAS': range(1, 6),
+}
+
+
+def _campo_nota(nota: int) -> str:
+    return f'avaliacoes_nota_{nota}'
+
+
+def ajustar_agregados(produto_id: int, nota: int, delta: int) -> None:
+    """Soma (delta=1) ou retira (delta=-1) uma avaliação aprovada dos agregados do produto"""
+    if not produto_id or not delta or nota not in AVALIACOES_CONFIG['NOTAS']:
+        return
+    Produto.objects.filter(pk=produto_id).update(**{
+        'total_avaliacoes': F('total_avaliacoes') + delta,
+        'soma_notas': F('soma_notas') + delta * nota,
+        _campo_nota(nota): F(_campo_nota(nota)) + delta,
+    })
+
+
+def recalcular_avaliacoes(produto_ids: Optional[Iterable[int]] = None) -> int:
+    """Recalcula os agregados dos produtos informados (ou de todos), em lotes"""
+    produtos = Produto.objects.order_by('id')
+    if produto_ids is not None:
+        produtos = produtos.filter(id__in=list(produto_ids))
+    campos = ['total_avaliacoes', 'soma_notas'] + [_campo_nota(nota) for nota in AVALIACOES_CONFIG['NOTAS']]
+    tamanho = AVALIACOES_CONFIG['TAMANHO_LOTE']
+    ultimo_id = 0
+    total = 0
+
+    while True:
+        lote = list(produtos.filter(id__gt=ultimo_id).only('id', *campos)[:tamanho])
+        if not lote:
+            break
+        agregados = {
+            linha.pop('produto_id'): linha
+            for linha in AvaliacaoProduto.objects.filter(
+                produto_id__in=[produto.id for produto in lote],
+                aprovada=True
+            ).values('produto_id').annotate(
+                total_avaliacoes=Count('id'),
+                soma_notas=Sum('nota'),
+                **{
+                    _campo_nota(nota): Count('id', filter=Q(nota=nota))
+                    for nota in AVALIACOES_CONFIG['NOTAS']
+                }
+            )
+        }
+        for produto in lote:
+            valores = agregados.get(produto.id, {})
+            for campo in campos:
+                setattr(produto, campo, valores.get(campo) or 0)
+        Produto.objects.bulk_update(lote, campos)
+        total += len(lote)
+        ultimo_id = lote[-1].id
+
+    return total
@@ -0,0 +1,151 @@
+"""
+Busca textual de produtos.
+
+Cada Produto tem um documento em ProdutoBusca com os textos já sem acento
+e um tsvector em português (pesos A a D) indexado por GIN. As consultas
+usam prefixo por termo e são ordenadas por relevância.
+"""
+import logging
+import re
+import unicodedata
+from typing import Iterable, List
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import transaction
+from django.db.models import F, FloatField, Prefetch, QuerySet
+from django.db.models.functions import Cast
+
+from core.models import Produto, ProdutoBusca, ProdutoVariacao
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+BUSCA_CONFIG = {
+    'IDIOMA': 'portuguese',
+    'TAMANHO_LOTE': 500,
+    'MAX_TERMOS': 8,
+}
+
+_TERMO_RE = re.compile(r'[^\W_]+')
+
+
+def normalizar_texto(texto: str) -> str:
+    """Remove acentos, converte para minúsculas e compacta espaços"""
+    if not texto:
+        return ''
+    decomposto = unicodedata.normalize('NFKD', texto)
+    sem_acento = ''.join(c for c in decomposto if not unicodedata.combining(c))
+    return ' '.join(sem_acento.lower().split())
+
+
+def extrair_termos(texto: str) -> List[str]:
+    """Quebra o texto normalizado em termos válidos para o tsquery"""
+    return _TERMO_RE.findall(normalizar_texto(texto))[:BUSCA_CONFIG['MAX_TERMOS']]
+
+
+def montar_documento(produto: Produto) -> dict:
+    """Monta os campos de texto do documento de busca de um produto"""
+    classificacao = [produto.categoria.nome]
+    if produto.marca_id:
+        classificacao.append(produto.marca.nome)
+
+    complementos = [tag.nome for tag in produto.tags.all()]
+    valores = set()
+    for variacao in produto.variacoes.all():
+        for atributo in variacao.atributos.all():
+            valores.add(atributo.valor)
+    complementos.extend(sorted(valores))
+
+    return {
+        'nome': normalizar_texto(produto.nome),
+        'classificacao': normalizar_texto(' '.join(classificacao)),
+        'complementos': normalizar_texto(' '.join(complementos)),
+        'descricao': normalizar_texto(produto.descricao),
+    }
+
+
+def _vetor_documento():
+    idioma = BUSCA_CONFIG['IDIOMA']
+    return (
+        SearchVector('nome', weight='A', config=idioma)
+        + SearchVector('classificacao', weight='B', config=idioma)
+        + SearchVector('complementos', weight='C', config=idioma)
+        + SearchVector('descricao', weight='D', config=idioma)
+    )
+
+
+def _produtos_para_indexar(produto_ids: List[int]) -> QuerySet:
+    return Produto.objects.filter(id__in=produto_ids).select_related(
+        'categoria',
+        'marca'
+    ).prefetch_related(
+        'tags',
+        Prefetch(
+            'variacoes',
+            queryset=ProdutoVariacao.objects.filter(ativo=True).prefetch_related('atributos')
+        )
+    )
+
+
+def atualizar_documentos(produto_ids: Iterable[int]) -> int:
+    """Regrava os documentos de busca dos produtos informados, em lotes"""
+    ids = sorted(set(produto_ids))
+    tamanho = BUSCA_CONFIG['TAMANHO_LOTE']
+    total = 0
+
+    for inicio in range(0, len(ids), tamanho):
+        lote = ids[inicio:inicio + tamanho]
+        documentos = [
+            ProdutoBusca(produto_id=produto.id, **montar_documento(produto))
+            for produto in _produtos_para_indexar(lote)
+        ]
+        if not documentos:
+            continue
+
+        with transaction.atomic():
+            ProdutoBusca.objects.bulk_create(
+                documentos,
+                update_conflicts=True,
+                unique_fields=['produto'],
+                update_fields=['nome', 'classificacao', 'complementos', 'descricao'],
+            )
+            ProdutoBusca.objects.filter(
+                produto_id__in=[doc.produto_id for doc in documentos]
+            ).update(vetor=_vetor_documento())
+        total += len(documentos)
+
+    return total
+
+
+def agendar_atualizacao(produto_ids: Iterable[int]) -> None:
+    """Atualiza os documentos após o commit da transação corrente"""
+    ids = set(produto_ids)
+    if not ids:
+        return
+    apos_commit(atualizar_documentos, ids, erro="Erro ao atualizar índice de busca")
+
+
+def montar_consulta(texto: str):
+    """Converte o texto digitado em SearchQuery com prefixo em cada termo"""
+    termos = extrair_termos(texto)
+    if not termos:
+        return None
+    expressao = ' & '.join(f'{termo}:*' for termo in termos)
+    return SearchQuery(expressao, search_type='raw', config=BUSCA_CONFIG['IDIOMA'])
+
+
+def buscar_produtos(queryset: QuerySet, texto: str, prefixo: str = '') -> QuerySet:
+    """
+    Filtra o queryset pelo índice e anota a relevância.
+
+    prefixo é o caminho até o Produto quando o queryset é de outro modelo
+    (ex.: 'produto__' para ProdutoCard).
+    """
+    consulta = montar_consulta(texto)
+    if consulta is None:
+        return queryset.none()
+    campo = f'{prefixo}busca__vetor'
+    # float8 para a relevância poder ser usada como chave de cursor sem perda
+    return queryset.filter(**{campo: consulta}).annotate(
+        relevancia=Cast(SearchRank(F(campo), consulta), FloatField())
+    )
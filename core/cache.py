@@ -0,0 +1,392 @@
+"""
+Namespaces de chaves de cache com geração.
+
+Toda chave de produto, variação, carrinho, pedido e catálogo é montada por
+montar_chave, que embute o contador de geração do namespace e, se houver,
+do escopo (ex.: o produto 12 dentro de 'produto'). invalidar_namespace
+incrementa o contador: as chaves antigas deixam de ser lidas e expiram
+pelo próprio timeout, sem delete_pattern (que os backends padrão do Django
+não têm) e sem listas de chaves espalhadas pelos save()/delete().
+
+Escopos por namespace:
+- produto: id do produto (preço, desconto, variações, imagens, avaliações,
+  preço final das variações e matriz de variações);
+- variacao: id da variação (reservas de estoque);
+- carrinho: id do usuário dono do carrinho (totais, itens e contexto da
+  página do carrinho);
+- pedido: id do pedido (totais e itens) ou 'usuario_<id>' (listas);
+- catalogo: sem escopo (listas de produtos; incrementado também quando um
+  card muda em campo da listagem e na reconstrução dos rankings);
+- cupom: código do cupom;
+- usuario: id do usuário (endereços e notificações do cabeçalho);
+- categoria, marca, atributo, tag: sem escopo, incrementados só pelo
+  próprio modelo (dados de referência de cache_dois_niveis, que assim não
+  caem a cada produto salvo).
+
+Os contadores começam no instante atual em milissegundos, e não em 1, para
+que um contador expulso do cache não volte a uma geração já usada. A
+geração também serve de versão para os ETags de core.condicional.
+
+Tags: um valor que lê outros objetos além do seu escopo (ex.: o preço de
+um item do carrinho lê o produto e a variação) é gravado por
+get_or_compute junto da geração atual de cada tag ('produto:12',
+'variacao:40', 'cupom:ABC') e descartado se alguma tag mudou. As tags são
+os mesmos contadores dos escopos, e o signal invalidar_tags_modelo
+incrementa, no post_save/post_delete de cada modelo de TAGS_MODELOS, as
+tags do objeto alterado; assim os save()/delete() não precisam listar o
+que depende deles e os timeouts podem ser longos.
+
+Dois níveis: dados de referência lidos a cada requisição (categorias,
+marcas, atributos, notificações e endereços do cabeçalho) passam por
+cache_dois_niveis, um LRU limitado com TTL na memória do processo à frente
+do cache compartilhado. Cada valor guarda a geração das suas tags; o
+processo relê as gerações no cache compartilhado no máximo a cada
+INTERVALO_GERACOES segundos, então uma invalidação feita por qualquer
+worker chega aos demais nesse prazo (no próprio processo, na hora). Os
+valores do nível local são compartilhados entre requisições e não devem
+ser alterados por quem os lê.
+
+Stampede: get_or_compute é o cache-aside de todo o projeto. O valor é
+gravado com a sua expiração lógica e o tempo que levou para ser calculado,
+e fica no cache JANELA_OBSOLETO segundos além dela. Perto de expirar, cada
+leitura decide ao acaso se recalcula antes da hora (mais provável quanto
+mais caro o cálculo e mais perto da expiração), e só quem pega o lock da
+chave recalcula: os demais seguem com o valor atual ou obsoleto, ou, se
+não há valor algum, esperam o dono do lock por até ESPERA_MAXIMA (meio
+segundo) e então calculam por conta própria.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from operator import attrgetter
+from typing import Callable, Iterable, List, Optional, Union
+
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONFIG = {
+    'NAMESPACES': (
+        'produto', 'variacao', 'carrinho', 'pedido', 'catalogo', 'cupom', 'usuario',
+        'categoria', 'marca', 'atributo', 'tag',
+    ),
+    'PREFIXO_GERACAO': 'geracao_',
+    # Tags incrementadas no post_save/post_delete: (namespace, atributo com o escopo ou None)
+    'TAGS_MODELOS': {
+        'core.Produto': (('produto', 'pk'), ('catalogo', None)),
+        'core.ProdutoVariacao': (('variacao', 'pk'), ('produto', 'produto_id')),
+        'core.ImagemProduto': (('produto', 'produto_id'),),
+        'core.AvaliacaoProduto': (('produto', 'produto_id'),),
+        'core.Categoria': (('catalogo', None), ('categoria', None)),
+        'core.Marca': (('catalogo', None), ('marca', None)),
+        'core.AtributoTipo': (('catalogo', None), ('atributo', None)),
+        'core.AtributoValor': (('catalogo', None), ('atributo', None)),
+        'core.Cupom': (('cupom', 'codigo'),),
+        'core.Pedido': (('pedido', 'pk'),),
+        'core.ItemPedido': (('pedido', 'pedido_id'),),
+        'core.Reembolso': (('pedido', 'pedido_id'),),
+        'core.Carrinho': (('carrinho', 'usuario_id'),),
+        'core.ItemCarrinho': (('carrinho', 'carrinho.usuario_id'),),
+        'core.Endereco': (('carrinho', 'usuario_id'), ('usuario', 'usuario_id')),  # CEP no carrinho e no cabeçalho
+        'core.Tag': (('catalogo', None), ('tag', None)),
+        'user.Notificacao': (('usuario', 'usuario_id'),),
+        'core.ReservaEstoque': (('variacao', 'variacao_id'),),
+        'core.LogEstoque': (('variacao', 'variacao_id'), ('pedido', 'pedido_id')),
+    },
+    # Nível local de cache_dois_niveis (por processo)
+    'LOCAL_TAMANHO_MAXIMO': 1000,
+    'LOCAL_TTL': 300,
+    'INTERVALO_GERACOES': 2,  # segundos entre releituras das gerações no cache compartilhado
+    # get_or_compute
+    'JANELA_OBSOLETO': 300,  # segundos em que o valor expirado ainda é servido enquanto um worker recalcula
+    'BETA_RECALCULO': 1.0,  # > 1 antecipa mais o recálculo
+    'TIMEOUT_LOCK': 30,
+    'ESPERA_MAXIMA': 0.5,  # segundos esperando o dono do lock quando não há valor; depois calcula sem lock
+    'INTERVALO_ESPERA': 0.05,
+}
+
+_AUSENTE = object()
+
+
+class CacheLocal:
+    """LRU limitado com TTL na memória do processo (seguro entre threads)"""
+
+    def __init__(self, tamanho_maximo: int, ttl: float):
+        self.tamanho_maximo = tamanho_maximo
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        """Valor ainda no prazo, ou _AUSENTE"""
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return _AUSENTE
+            expira, valor = item
+            if expira <= time.monotonic():
+                del self._itens[chave]
+                return _AUSENTE
+            self._itens.move_to_end(chave)
+            return valor
+
+    def gravar(self, chave, valor, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._itens[chave] = (time.monotonic() + (ttl or self.ttl), valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.tamanho_maximo:
+                self._itens.popitem(last=False)
+
+    def descartar(self, chave) -> None:
+        with self._lock:
+            self._itens.pop(chave, None)
+
+    def limpar(self) -> None:
+        with self._lock:
+            self._itens.clear()
+
+    def __len__(self) -> int:
+        return len(self._itens)
+
+
+_cache_local = CacheLocal(CACHE_CONFIG['LOCAL_TAMANHO_MAXIMO'], CACHE_CONFIG['LOCAL_TTL'])
+# Últimas gerações lidas no cache compartilhado, reaproveitadas por INTERVALO_GERACOES
+_geracoes_vistas = CacheLocal(CACHE_CONFIG['LOCAL_TAMANHO_MAXIMO'], CACHE_CONFIG['INTERVALO_GERACOES'])
+
+
+def _geracao_inicial() -> int:
+    return int(time.time() * 1000)
+
+
+def _chave_geracao(namespace: str, escopo=None) -> str:
+    if namespace not in CACHE_CONFIG['NAMESPACES']:
+        raise ValueError(f"Namespace de cache desconhecido: {namespace}")
+    if escopo is None:
+        return f"{CACHE_CONFIG['PREFIXO_GERACAO']}{namespace}"
+    return f"{CACHE_CONFIG['PREFIXO_GERACAO']}{namespace}_{escopo}"
+
+
+def _geracoes(chaves: list) -> list:
+    """Gerações atuais das chaves, criando as que faltam (uma ida ao cache no caso comum)"""
+    valores = cache.get_many(chaves)
+    for chave in chaves:
+        if chave not in valores:
+            cache.add(chave, _geracao_inicial(), None)
+            valores[chave] = cache.get(chave) or _geracao_inicial()
+    return [valores[chave] for chave in chaves]
+
+
+def _geracoes_recentes(chaves: list, reler: bool = False) -> list:
+    """Como _geracoes, mas sem ir ao cache compartilhado se as gerações foram lidas há pouco"""
+    valores = {} if reler else {chave: _geracoes_vistas.obter(chave) for chave in chaves}
+    faltantes = [chave for chave in chaves if valores.get(chave, _AUSENTE) is _AUSENTE]
+    if faltantes:
+        for chave, geracao in zip(faltantes, _geracoes(faltantes)):
+            _geracoes_vistas.gravar(chave, geracao)
+            valores[chave] = geracao
+    return [valores[chave] for chave in chaves]
+
+
+def obter_geracao(namespace: str, escopo=None) -> int:
+    """Geração atual do namespace ou do escopo dentro dele"""
+    return _geracoes([_chave_geracao(namespace, escopo)])[0]
+
+
+def montar_chave(namespace: str, *partes, escopo=None) -> str:
+    """Chave versionada, ex.: montar_chave('produto', 'preco', escopo=12)"""
+    chaves = [_chave_geracao(namespace)]
+    if escopo is not None:
+        chaves.append(_chave_geracao(namespace, escopo))
+    geracoes = _geracoes(chaves)
+
+    prefixo = [namespace, geracoes[0]]
+    if escopo is not None:
+        prefixo += [escopo, geracoes[1]]
+    return '_'.join(str(parte) for parte in prefixo + list(partes))
+
+
+def invalidar_namespace(namespace: str, *escopos) -> None:
+    """
+    Invalida os escopos informados do namespace, ou o namespace inteiro se
+    nenhum for informado. Custa um incr por escopo, em qualquer backend.
+    """
+    chaves = [_chave_geracao(namespace, escopo) for escopo in set(escopos)] if escopos else [_chave_geracao(namespace)]
+    for chave in chaves:
+        cache.add(chave, _geracao_inicial(), None)
+        try:
+            cache.incr(chave)
+        except ValueError:
+            # Expulso entre o add e o incr
+            cache.set(chave, _geracao_inicial(), None)
+        _geracoes_vistas.descartar(chave)
+
+
+def invalidar_escopos(namespace: str, escopos: Iterable[Optional[object]]) -> None:
+    """invalidar_namespace para uma coleção de escopos, ignorando None; coleção vazia não invalida nada"""
+    escopos = [escopo for escopo in escopos if escopo is not None]
+    if escopos:
+        invalidar_namespace(namespace, *escopos)
+
+
+def tag(namespace: str, escopo=None) -> str:
+    """Nome da tag de um escopo, ex.: tag('produto', 12) -> 'produto:12'"""
+    _chave_geracao(namespace, escopo)  # valida o namespace
+    return namespace if escopo is None else f"{namespace}:{escopo}"
+
+
+def _chave_geracao_tag(nome: str) -> str:
+    namespace, _, escopo = nome.partition(':')
+    return _chave_geracao(namespace, escopo or None)
+
+
+def invalidar_tags(tags: Iterable[str]) -> None:
+    """Invalida todo valor gravado com alguma das tags"""
+    for nome in set(tags):
+        namespace, _, escopo = nome.partition(':')
+        if escopo:
+            invalidar_namespace(namespace, escopo)
+        else:
+            invalidar_namespace(namespace)
+
+
+def tags_da_instancia(instance) -> List[str]:
+    """Tags de TAGS_MODELOS que o objeto alterado invalida"""
+    tags = []
+    for namespace, atributo in CACHE_CONFIG['TAGS_MODELOS'].get(instance._meta.label, ()):
+        if atributo is None:
+            tags.append(tag(namespace))
+            continue
+        try:
+            escopo = attrgetter(atributo)(instance)
+        except ObjectDoesNotExist:
+            continue  # relacionado já apagado (delete em cascata)
+        if escopo is not None:
+            tags.append(tag(namespace, escopo))
+    return tags
+
+
+def _vencido(registro: dict) -> bool:
+    """Expiração probabilística antecipada (XFetch): delta * beta * -ln(U) segundos antes da hora"""
+    if registro['expira'] is None:
+        return False
+    antecipacao = -registro['delta'] * CACHE_CONFIG['BETA_RECALCULO'] * math.log(1 - random.random())
+    return time.time() + antecipacao >= registro['expira']
+
+
+def _tags_inalteradas(geracoes: dict) -> bool:
+    chaves = list(geracoes)
+    return dict(zip(chaves, _geracoes_recentes(chaves, reler=True))) == geracoes
+
+
+def _calcular_e_gravar(chave: str, calcular: Callable, timeout: Optional[int], tags, anterior=None):
+    """
+    Gerações lidas antes do cálculo: uma invalidação durante ele já torna o
+    valor inválido. Com tags em função do valor, as conhecidas antes do
+    cálculo são as do registro anterior; as que só aparecem no novo valor
+    (ex.: na primeira gravação) têm a geração lida logo depois do cálculo.
+    """
+    if not callable(tags):
+        conhecidas = {_chave_geracao_tag(nome) for nome in tags}
+    else:
+        conhecidas = set(anterior['geracoes']) if anterior is not None else set()
+    ordenadas = sorted(conhecidas)
+    geracoes = dict(zip(ordenadas, _geracoes_recentes(ordenadas, reler=True)))
+
+    inicio = time.monotonic()
+    valor = calcular()
+    delta = time.monotonic() - inicio
+
+    usadas = {_chave_geracao_tag(nome) for nome in tags(valor)} if callable(tags) else conhecidas
+    novas = sorted(usadas - conhecidas)
+    geracoes.update(zip(novas, _geracoes_recentes(novas, reler=True)))
+
+    registro = {
+        'valor': valor,
+        'geracoes': {chave_geracao: geracoes[chave_geracao] for chave_geracao in usadas},
+        'expira': None if timeout is None else time.time() + timeout,
+        'delta': delta,
+    }
+    cache.set(chave, registro, None if timeout is None else timeout + CACHE_CONFIG['JANELA_OBSOLETO'])
+    return valor
+
+
+def get_or_compute(chave: str, calcular: Callable, timeout: Optional[int] = None,
+                   tags: Union[Iterable[str], Callable[..., Iterable[str]]] = ()):
+    """
+    Valor da chave, calculado por calcular() em um único worker por vez
+    (lock por chave). Quem não pega o lock recebe o valor atual, mesmo
+    expirado; sem valor, espera o dono do lock. Valores gravados com tags
+    que mudaram desde então não são servidos nem como obsoletos. tags pode
+    ser uma função do valor calculado, quando dependem do que foi lido
+    (ex.: os produtos dos itens do carrinho).
+    """
+    chave_lock = f"lock_{chave}"
+    limite_espera = time.monotonic() + CACHE_CONFIG['ESPERA_MAXIMA']
+    while True:
+        registro = cache.get(chave)
+        valido = registro is not None and _tags_inalteradas(registro['geracoes'])
+        if valido and not _vencido(registro):
+            return registro['valor']
+
+        if cache.add(chave_lock, True, CACHE_CONFIG['TIMEOUT_LOCK']):
+            try:
+                return _calcular_e_gravar(chave, calcular, timeout, tags, registro)
+            finally:
+                cache.delete(chave_lock)
+        if valido:
+            return registro['valor']  # outro worker já está recalculando
+        if time.monotonic() >= limite_espera:
+            logger.warning(f"Lock de cache ocupado além do limite, recalculando sem lock: {chave}")
+            return _calcular_e_gravar(chave, calcular, timeout, tags, registro)
+        time.sleep(CACHE_CONFIG['INTERVALO_ESPERA'])
+
+
+def obter_dois_niveis(chave: str, calcular: Callable, tags: Iterable[str],
+                      timeout: Optional[int] = None, ttl_local: Optional[float] = None):
+    """
+    Valor da memória do processo ou, em get_or_compute, do cache
+    compartilhado; o nível local só vale se as gerações das tags não mudaram.
+    """
+    tags = list(tags)
+    chaves_geracao = sorted({_chave_geracao_tag(nome) for nome in tags})
+    registro = _cache_local.obter(chave)
+    if registro is not _AUSENTE and registro['geracoes'] == dict(zip(chaves_geracao, _geracoes_recentes(chaves_geracao))):
+        return registro['valor']
+
+    # Lidas antes: uma invalidação durante get_or_compute já invalida o nível local
+    geracoes = dict(zip(chaves_geracao, _geracoes_recentes(chaves_geracao, reler=True)))
+    valor = get_or_compute(chave, calcular, timeout, tags)
+    _cache_local.gravar(chave, {'valor': valor, 'geracoes': geracoes}, ttl_local)
+    return valor
+
+
+def cache_dois_niveis(tags: Union[Iterable[str], Callable[..., Iterable[str]]],
+                      timeout: Optional[int] = None, ttl_local: Optional[float] = None):
+    """
+    Substitui functools.lru_cache em funções que leem o banco: o resultado
+    fica em obter_dois_niveis, com chave pelo nome da função e argumentos
+    posicionais. tags é uma lista fixa ou uma função dos mesmos argumentos,
+    ex.: @cache_dois_niveis(lambda usuario_id: [tag('usuario', usuario_id)]).
+    Classes (o cls de classmethods) não entram na chave.
+    """
+    def decorador(funcao):
+        prefixo = f"{funcao.__module__}.{funcao.__qualname__}"
+
+        @wraps(funcao)
+        def wrapper(*args):
+            chave = ':'.join([prefixo] + [str(arg) for arg in args if not isinstance(arg, type)])
+            tags_valor = tags(*args) if callable(tags) else tags
+            return obter_dois_niveis(chave, lambda: funcao(*args), tags_valor, timeout, ttl_local)
+        return wrapper
+    return decorador
+
+
+def limpar_cache_local() -> None:
+    """Esvazia o nível local deste processo (ex.: entre testes)"""
+    _cache_local.limpar()
+    _geracoes_vistas.limpar()
@@ -0,0 +1,184 @@
+"""
+Read model dos cards de produto.
+
+ProdutoCard guarda, por produto, tudo o que os cards da home e da listagem
+exibem (preço e promoção, avaliação, imagem principal, cores e tamanhos
+disponíveis, estoque), para que essas páginas sejam uma única consulta
+indexada. As linhas são regravadas a partir dos signals de Produto,
+ProdutoVariacao, ImagemProduto e AvaliacaoProduto; a avaliação vem dos
+agregados já gravados no Produto (core.avaliacoes).
+
+A geração 'catalogo' (versão das listas e do ETag da listagem) só é
+incrementada quando um card muda em algo que decide se ele aparece em uma
+listagem ou em que posição (CAMPOS_LISTAGEM): uma venda que não zera o
+estoque de uma variação não invalida as listagens de todo o site.
+"""
+import logging
+from typing import Iterable, List
+
+from django.db.models import Prefetch, QuerySet
+from django.urls import reverse
+
+from core.cache import invalidar_namespace
+from core.models import ImagemProduto, Produto, ProdutoCard, ProdutoVariacao
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+CARDS_CONFIG = {
+    'TAMANHO_LOTE': 500,
+    'IMAGEM_PADRAO': 'produtos/default.jpg',
+}
+
+CAMPOS_ATUALIZAVEIS = [
+    'nome', 'slug', 'categoria', 'marca', 'preco', 'preco_original',
+    'preco_promocional', 'promocao_inicio', 'promocao_fim', 'media_avaliacoes',
+    'total_avaliacoes', 'imagem', 'cores', 'tamanhos', 'variacao_padrao_id',
+    'em_estoque', 'ativo', 'destaque', 'created_at', 'atualizado_em',
+]
+
+# Campos usados nos filtros e ordenações da listagem e nas listas do catálogo
+CAMPOS_LISTAGEM = [
+    'nome', 'categoria_id', 'marca_id', 'preco', 'preco_promocional', 'promocao_inicio',
+    'promocao_fim', 'cores', 'tamanhos', 'em_estoque', 'ativo', 'destaque', 'created_at',
+]
+
+
+def _produtos_para_cards(produto_ids: List[int]) -> QuerySet:
+    return Produto.objects.filter(id__in=produto_ids).prefetch_related(
+        Prefetch(
+            'variacoes',
+            queryset=ProdutoVariacao.objects.filter(ativo=True).order_by('id').prefetch_related(
+                'atributos__tipo'
+            )
+        ),
+        Prefetch(
+            'imagens',
+            queryset=ImagemProduto.objects.order_by('-destaque', 'ordem')
+        )
+    )
+
+
+def _imagem_principal(produto: Produto) -> str:
+    if produto.imagem and produto.imagem.name != CARDS_CONFIG['IMAGEM_PADRAO']:
+        return produto.imagem.name
+    imagens = list(produto.imagens.all())
+    if imagens:
+        return imagens[0].imagem.name
+    return produto.imagem.name if produto.imagem else ''
+
+
+def montar_card(produto: Produto) -> ProdutoCard:
+    """Monta o card de um produto já carregado com os prefetches de _produtos_para_cards"""
+    cores, tamanhos = {}, {}
+    variacao_padrao_id = None
+    for variacao in produto.variacoes.all():
+        if variacao.estoque <= 0:
+            continue
+        if variacao_padrao_id is None:
+            variacao_padrao_id = variacao.id
+        for atributo in variacao.atributos.all():
+            dados = {'id': atributo.id, 'valor': atributo.valor, 'codigo': atributo.codigo}
+            if atributo.tipo.tipo == 'color':
+                cores[atributo.id] = (atributo.ordem, dados)
+            elif atributo.tipo.tipo == 'size':
+                tamanhos[atributo.id] = (atributo.ordem, dados)
+
+    return ProdutoCard(
+        produto_id=produto.id,
+        nome=produto.nome,
+        slug=produto.slug,
+        categoria_id=produto.categoria_id,
+        marca_id=produto.marca_id,
+        preco=produto.preco,
+        preco_original=produto.preco_original,
+        preco_promocional=produto.preco_promocional,
+        promocao_inicio=produto.promocao_inicio,
+        promocao_fim=produto.promocao_fim,
+        media_avaliacoes=produto.media_avaliacoes(),
+        total_avaliacoes=produto.total_avaliacoes,
+        imagem=_imagem_principal(produto),
+        cores=[dados for _, dados in sorted(cores.values(), key=lambda item: item[0])],
+        tamanhos=[dados for _, dados in sorted(tamanhos.values(), key=lambda item: item[0])],
+        variacao_padrao_id=variacao_padrao_id,
+        em_estoque=variacao_padrao_id is not None,
+        ativo=produto.ativo,
+        destaque=produto.destaque,
+        created_at=produto.created_at,
+    )
+
+
+def serializar_card(card: ProdutoCard) -> dict:
+    """Representação JSON de um card para a API de listagem"""
+    # Querysets com with_preco_vigente() já trazem preço e desconto calculados no banco
+    preco_vigente = getattr(card, 'preco_efetivo', None)
+    if preco_vigente is None:
+        preco_vigente = card.preco_vigente()
+    desconto = getattr(card, 'desconto_efetivo', None)
+    if desconto is None:
+        desconto = card.calcular_desconto()
+    return {
+        'id': card.pk,
+        'nome': card.nome,
+        'slug': card.slug,
+        'url': reverse('item-view', args=[card.pk]),
+        'imagem': card.imagem_url,
+        'preco': str(card.preco),
+        'preco_vigente': str(preco_vigente),
+        'desconto': desconto,
+        'media_avaliacoes': str(card.media_avaliacoes),
+        'total_avaliacoes': card.total_avaliacoes,
+        'cores': card.cores,
+        'tamanhos': card.tamanhos,
+        'em_estoque': card.em_estoque,
+        'variacao_padrao_id': card.variacao_padrao_id,
+    }
+
+
+def _muda_listagem(cards: List[ProdutoCard]) -> bool:
+    """Se algum card é novo ou mudou em CAMPOS_LISTAGEM"""
+    gravados = {
+        linha[0]: linha[1:]
+        for linha in ProdutoCard.objects.filter(
+            produto_id__in=[card.produto_id for card in cards]
+        ).values_list('produto_id', *CAMPOS_LISTAGEM)
+    }
+    return any(
+        gravados.get(card.produto_id) != tuple(getattr(card, campo) for campo in CAMPOS_LISTAGEM)
+        for card in cards
+    )
+
+
+def atualizar_cards(produto_ids: Iterable[int]) -> int:
+    """Regrava os cards dos produtos informados, em lotes"""
+    ids = sorted(set(produto_ids))
+    tamanho = CARDS_CONFIG['TAMANHO_LOTE']
+    total = 0
+    muda_listagem = False
+
+    for inicio in range(0, len(ids), tamanho):
+        lote = ids[inicio:inicio + tamanho]
+        cards = [montar_card(produto) for produto in _produtos_para_cards(lote)]
+        if not cards:
+            continue
+
+        muda_listagem = muda_listagem or _muda_listagem(cards)
+        ProdutoCard.objects.bulk_create(
+            cards,
+            update_conflicts=True,
+            unique_fields=['produto'],
+            update_fields=CAMPOS_ATUALIZAVEIS,
+        )
+        total += len(cards)
+
+    if muda_listagem:
+        invalidar_namespace('catalogo')
+    return total
+
+
+def agendar_atualizacao(produto_ids: Iterable[int]) -> None:
+    """Atualiza os cards após o commit da transação corrente"""
+    ids = set(produto_ids)
+    if not ids:
+        return
+    apos_commit(atualizar_cards, ids, erro="Erro ao atualizar cards de produto")
@@ -0,0 +1,169 @@
+"""
+Árvore de categorias.
+
+CategoriaFechamento guarda um par (ancestral, descendente, profundidade)
+para cada caminho da árvore, incluindo o par da categoria com ela mesma.
+Assim "esta categoria e todas as de baixo" é uma única consulta indexada,
+em qualquer profundidade. Categoria.total_produtos guarda o total de
+produtos ativos da subárvore e é ajustado com F() quando um produto é
+criado, removido, ativado/desativado ou muda de categoria.
+"""
+import logging
+from collections import defaultdict
+from typing import List, Optional
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, QuerySet, Value
+from django.db.models.functions import Greatest
+
+from core.cache import get_or_compute
+from core.models import Categoria, CategoriaFechamento, Produto
+
+logger = logging.getLogger(__name__)
+
+CATEGORIAS_CONFIG = {
+    'CHAVE_ARVORE': 'categorias_arvore',
+    'TIMEOUT': 3600,  # 1 hora
+    'PROFUNDIDADE_MAXIMA': 32,
+    'RECUO_PX': 12,
+}
+
+_SQL_FECHAMENTO = """
+    INSERT INTO {fechamento} (ancestral_id, descendente_id, profundidade)
+    WITH RECURSIVE arvore (ancestral_id, descendente_id, profundidade) AS (
+        SELECT id, id, 0 FROM {categoria}
+        UNION ALL
+        SELECT arvore.ancestral_id, filha.id, arvore.profundidade + 1
+        FROM arvore
+        JOIN {categoria} filha ON filha.categoria_pai_id = arvore.descendente_id
+        WHERE arvore.profundidade < %s
+    )
+    SELECT ancestral_id, descendente_id, profundidade FROM arvore
+"""
+
+_SQL_TOTAIS = """
+    UPDATE {categoria} AS c SET total_produtos = (
+        SELECT count(*)
+        FROM {produto} p
+        JOIN {fechamento} f ON f.descendente_id = p.categoria_id
+        WHERE f.ancestral_id = c.id AND p.ativo
+    )
+"""
+
+
+def _tabelas() -> dict:
+    return {
+        'categoria': connection.ops.quote_name(Categoria._meta.db_table),
+        'fechamento': connection.ops.quote_name(CategoriaFechamento._meta.db_table),
+        'produto': connection.ops.quote_name(Produto._meta.db_table),
+    }
+
+
+def invalidar_arvore() -> None:
+    cache.delete(CATEGORIAS_CONFIG['CHAVE_ARVORE'])
+
+
+def reconstruir_arvore() -> None:
+    """Recalcula toda a tabela de fechamento e os totais por subárvore"""
+    tabelas = _tabelas()
+    with transaction.atomic(), connection.cursor() as cursor:
+        CategoriaFechamento.objects.all().delete()
+        cursor.execute(
+            _SQL_FECHAMENTO.format(**tabelas),
+            [CATEGORIAS_CONFIG['PROFUNDIDADE_MAXIMA']]
+        )
+        cursor.execute(_SQL_TOTAIS.format(**tabelas))
+    invalidar_arvore()
+
+
+def recalcular_totais() -> None:
+    """Recalcula só os totais por subárvore (ex.: após uma importação em massa)"""
+    with connection.cursor() as cursor:
+        cursor.execute(_SQL_TOTAIS.format(**_tabelas()))
+    invalidar_arvore()
+
+
+def inserir_categoria(categoria: Categoria) -> None:
+    """Cria os caminhos de uma categoria nova a partir dos ancestrais do pai"""
+    caminhos = [CategoriaFechamento(ancestral_id=categoria.id, descendente_id=categoria.id, profundidade=0)]
+    if categoria.categoria_pai_id:
+        caminhos.extend(
+            CategoriaFechamento(
+                ancestral_id=ancestral_id,
+                descendente_id=categoria.id,
+                profundidade=profundidade + 1
+            )
+            for ancestral_id, profundidade in CategoriaFechamento.objects.filter(
+                descendente_id=categoria.categoria_pai_id
+            ).values_list('ancestral_id', 'profundidade')
+        )
+    CategoriaFechamento.objects.bulk_create(caminhos, ignore_conflicts=True)
+    invalidar_arvore()
+
+
+def ajustar_total(categoria_id: Optional[int], delta: int) -> None:
+    """Soma delta ao total de produtos da categoria e de todos os seus ancestrais"""
+    if not categoria_id or not delta:
+        return
+    Categoria.objects.filter(
+        fechamento_descendentes__descendente_id=categoria_id
+    ).update(total_produtos=Greatest(F('total_produtos') + delta, Value(0)))
+    invalidar_arvore()
+
+
+def subarvore(categorias: QuerySet) -> QuerySet:
+    """Subconsulta com os ids das categorias informadas e de todas as descendentes"""
+    return CategoriaFechamento.objects.filter(
+        ancestral__in=categorias
+    ).values('descendente_id')
+
+
+def filtrar_por_categoria(queryset: QuerySet, nome: str, campo: str = 'categoria') -> QuerySet:
+    """Filtra o queryset pela categoria de nome informado e todas as abaixo dela"""
+    categorias = Categoria.objects.filter(nome__iexact=nome.strip()).values('id')
+    return queryset.filter(**{f'{campo}_id__in': subarvore(categorias)})
+
+
+def _montar_no(categoria, filhos, profundidade) -> dict:
+    return {
+        'categoria': categoria,
+        'nome': categoria.nome,
+        'total_produtos': categoria.total_produtos,
+        'profundidade': profundidade,
+        'subcategorias': [
+            _montar_no(filha, filhos, profundidade + 1) for filha in filhos.get(categoria.id, [])
+        ],
+    }
+
+
+def _descendentes(no: dict) -> List[dict]:
+    lista = []
+    for sub in no['subcategorias']:
+        sub['recuo'] = (sub['profundidade'] - 1) * CATEGORIAS_CONFIG['RECUO_PX']
+        lista.append(sub)
+        lista.extend(_descendentes(sub))
+    return lista
+
+
+def arvore_categorias() -> List[dict]:
+    """Retorna a árvore de categorias ativas, montada a partir de uma consulta, com cache"""
+    def _calcular():
+        categorias = list(Categoria.objects.filter(ativo=True).order_by('ordem', 'nome'))
+        ids = {categoria.id for categoria in categorias}
+        filhos = defaultdict(list)
+        raizes = []
+        for categoria in categorias:
+            if categoria.categoria_pai_id in ids:
+                filhos[categoria.categoria_pai_id].append(categoria)
+            else:
+                raizes.append(categoria)
+
+        arvore = []
+        for raiz in raizes:
+            no = _montar_no(raiz, filhos, 0)
+            no['descendentes'] = _descendentes(no)
+            arvore.append(no)
+        return arvore
+
+    return get_or_compute(CATEGORIAS_CONFIG['CHAVE_ARVORE'], _calcular, CATEGORIAS_CONFIG['TIMEOUT'])
@@ -0,0 +1,107 @@
+"""
+Validadores para GET condicional (ETag e Last-Modified).
+
+As páginas de produto e de listagem e o contador do carrinho recebem um
+ETag calculado só com dados baratos (uma linha de Produto/ProdutoCard ou
+gerações de core.cache), via django.views.decorators.http.condition.
+Se o cliente já tem a versão atual, a resposta é 304 antes de renderizar
+template ou consultar itens.
+
+Versões:
+- produto: Produto.updated_at e ProdutoCard.atualizado_em (o card é
+  regravado a cada mudança de variação, estoque, imagem ou avaliação) e se
+  a promoção está valendo agora;
+- catálogo: geração do namespace 'catalogo', incrementada quando um card
+  muda em campo de filtro ou ordenação da listagem (não a cada venda),
+  na reconstrução dos rankings, nas fronteiras de promoção e quando
+  produtos ou dados de referência são salvos;
+- carrinho: geração do escopo do usuário no namespace 'carrinho',
+  incrementada pelos signals de ItemCarrinho (na sessão, o próprio
+  conteúdo do carrinho).
+
+O ETag das páginas também muda a cada JANELA (o mesmo tempo do cache_page),
+o que limita o quanto partes sem versão (ex.: produtos relacionados) podem
+ficar defasadas no navegador.
+
+A página do produto também tem Last-Modified: a maior data entre
+Produto.updated_at, ProdutoCard.atualizado_em, a fronteira de promoção já
+cruzada e o início da JANELA, da mesma linha lida para o ETag. Quem manda
+If-None-Match é validado só pelo ETag (como pede a RFC 9110), que também
+distingue o usuário; If-Modified-Since vale para clientes sem ETag. A
+listagem e o contador do carrinho só têm ETag: suas versões são gerações,
+não datas.
+"""
+import hashlib
+import json
+import time
+from datetime import datetime, timezone as dt_timezone
+from typing import Optional
+
+from django.utils import timezone
+
+from core.cache import obter_geracao
+from core.models import Produto
+
+CONDICIONAL_CONFIG = {
+    'JANELA': 60 * 15,  # mesma duração do cache_page das páginas
+}
+
+
+def _etag(*partes) -> str:
+    return hashlib.md5('|'.join(str(parte) for parte in partes).encode()).hexdigest()
+
+
+def _usuario(request) -> str:
+    # O HTML traz o cabeçalho do usuário logado
+    return str(request.user.pk) if request.user.is_authenticated else 'anonimo'
+
+
+def _janela() -> int:
+    return int(time.time() // CONDICIONAL_CONFIG['JANELA'])
+
+
+def _linha_produto(request, pk) -> Optional[tuple]:
+    """Uma linha de Produto + ProdutoCard por requisição, usada pelos dois validadores"""
+    if getattr(request, '_linha_produto', (None,))[0] != pk:
+        request._linha_produto = (pk, Produto.objects.filter(pk=pk).values_list(
+            'updated_at', 'card__atualizado_em', 'preco_promocional', 'promocao_inicio', 'promocao_fim'
+        ).first())
+    return request._linha_produto[1]
+
+
+def etag_produto(request, pk, *args, **kwargs) -> Optional[str]:
+    """ETag da página do produto a partir de uma linha de Produto + ProdutoCard"""
+    linha = _linha_produto(request, pk)
+    if linha is None:
+        return None  # a view responde 404
+    updated_at, card_atualizado_em, preco_promocional, inicio, fim = linha
+    agora = timezone.now()
+    em_promocao = bool(preco_promocional and inicio and fim and inicio <= agora <= fim)
+    return _etag('produto', pk, updated_at, card_atualizado_em, em_promocao, _janela(), _usuario(request))
+
+
+def ultima_modificacao_produto(request, pk, *args, **kwargs) -> Optional[datetime]:
+    """Last-Modified da página do produto, coerente com o ETag (menos o usuário)"""
+    linha = _linha_produto(request, pk)
+    if linha is None:
+        return None
+    updated_at, card_atualizado_em, preco_promocional, inicio, fim = linha
+    agora = timezone.now()
+    datas = [updated_at, card_atualizado_em]
+    if preco_promocional:
+        datas += [fronteira for fronteira in (inicio, fim) if fronteira and fronteira <= agora]
+    datas.append(datetime.fromtimestamp(_janela() * CONDICIONAL_CONFIG['JANELA'], tz=dt_timezone.utc))
+    return max(data for data in datas if data is not None)
+
+
+def etag_listagem(request, *args, **kwargs) -> str:
+    """ETag da listagem; o navegador guarda um por URL, então os filtros não entram"""
+    return _etag('listagem', obter_geracao('catalogo'), _janela(), _usuario(request))
+
+
+def etag_contador_carrinho(request, *args, **kwargs) -> str:
+    """ETag do contador do carrinho sem consultar os itens"""
+    if request.user.is_authenticated:
+        return _etag('carrinho', request.user.pk, obter_geracao('carrinho', request.user.pk))
+    carrinho = request.session.get('carrinho', {})
+    return _etag('carrinho', 'sessao', json.dumps(carrinho, sort_keys=True, default=str))
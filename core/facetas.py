@@ -0,0 +1,206 @@
+"""
+Facetas de atributos da listagem de produtos.
+
+O índice guarda, para cada AtributoValor, o conjunto de produtos que têm
+ao menos uma variação ativa com estoque naquele valor (posting list). Os
+filtros e as contagens são resolvidos com interseções em memória: valores
+do mesmo tipo combinam com OU, tipos diferentes combinam com E.
+
+Na listagem, o filtro vai para o SQL (filtrar, um EXISTS por tipo com os
+valores escolhidos) e o índice só dá as contagens (obter_contagens), que
+são cacheadas por estado de filtro na geração 'catalogo'. Os ids da
+listagem só são lidos no cálculo das contagens, e nunca voltam ao banco
+como uma lista IN.
+"""
+import hashlib
+import json
+import logging
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef, QuerySet
+
+from core.cache import get_or_compute, montar_chave
+from core.models import ProdutoVariacao
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+FACETAS_CONFIG = {
+    'CHAVE_INDICE': 'facetas_indice',
+    'CHAVE_LOCK': 'facetas_indice_lock',
+    'TIMEOUT': 60 * 60 * 24,  # 24 horas
+    'TIMEOUT_LOCK': 10,
+    'TIMEOUT_CONTAGENS': 60 * 15,  # 15 minutos, igual ao cache da página
+}
+
+
+def _pares_disponiveis(produto_ids: Optional[Iterable[int]] = None):
+    """Retorna (produto_id, valor_id, tipo) das variações ativas com estoque"""
+    pares = ProdutoVariacao.atributos.through.objects.filter(
+        produtovariacao__ativo=True,
+        produtovariacao__estoque__gt=0,
+        produtovariacao__produto__ativo=True,
+    )
+    if produto_ids is not None:
+        pares = pares.filter(produtovariacao__produto_id__in=list(produto_ids))
+    return pares.values_list(
+        'produtovariacao__produto_id',
+        'atributovalor_id',
+        'atributovalor__tipo__nome',
+    ).distinct()
+
+
+def construir_indice() -> dict:
+    """Reconstrói o índice completo de facetas com uma única consulta"""
+    indice = {'tipos': {}, 'postings': {}, 'por_produto': {}}
+    for produto_id, valor_id, tipo in _pares_disponiveis():
+        indice['tipos'][valor_id] = tipo
+        indice['postings'].setdefault(valor_id, set()).add(produto_id)
+        indice['por_produto'].setdefault(produto_id, set()).add(valor_id)
+
+    cache.set(FACETAS_CONFIG['CHAVE_INDICE'], indice, FACETAS_CONFIG['TIMEOUT'])
+    return indice
+
+
+def obter_indice() -> dict:
+    """Retorna o índice de facetas com cache"""
+    indice = cache.get(FACETAS_CONFIG['CHAVE_INDICE'])
+    if indice is None:
+        indice = construir_indice()
+    return indice
+
+
+def invalidar_indice() -> None:
+    cache.delete(FACETAS_CONFIG['CHAVE_INDICE'])
+
+
+def atualizar_produtos(produto_ids: Iterable[int]) -> None:
+    """Atualiza no índice apenas as posting lists dos produtos informados"""
+    ids = set(produto_ids)
+    if not ids:
+        return
+
+    if not cache.add(FACETAS_CONFIG['CHAVE_LOCK'], True, FACETAS_CONFIG['TIMEOUT_LOCK']):
+        # Outra atualização em andamento: força reconstrução na próxima leitura
+        invalidar_indice()
+        return
+
+    try:
+        indice = cache.get(FACETAS_CONFIG['CHAVE_INDICE'])
+        if indice is None:
+            return
+
+        novos = {produto_id: set() for produto_id in ids}
+        for produto_id, valor_id, tipo in _pares_disponiveis(ids):
+            indice['tipos'][valor_id] = tipo
+            novos[produto_id].add(valor_id)
+
+        for produto_id, valores in novos.items():
+            antigos = indice['por_produto'].get(produto_id, set())
+            for valor_id in antigos - valores:
+                posting = indice['postings'].get(valor_id)
+                if posting is not None:
+                    posting.discard(produto_id)
+                    if not posting:
+                        del indice['postings'][valor_id]
+            for valor_id in valores - antigos:
+                indice['postings'].setdefault(valor_id, set()).add(produto_id)
+
+            if valores:
+                indice['por_produto'][produto_id] = valores
+            else:
+                indice['por_produto'].pop(produto_id, None)
+
+        cache.set(FACETAS_CONFIG['CHAVE_INDICE'], indice, FACETAS_CONFIG['TIMEOUT'])
+    finally:
+        cache.delete(FACETAS_CONFIG['CHAVE_LOCK'])
+
+
+def agendar_atualizacao(produto_ids: Iterable[int]) -> None:
+    """Atualiza as facetas após o commit da transação corrente"""
+    ids = set(produto_ids)
+    if not ids:
+        return
+    apos_commit(atualizar_produtos, ids, erro="Erro ao atualizar facetas", ao_falhar=invalidar_indice)
+
+
+def calcular(
+    base_ids: Set[int],
+    selecionados: Dict[str, Set[int]],
+    indice: Optional[dict] = None
+) -> Tuple[Set[int], Dict[int, int]]:
+    """
+    Aplica os filtros de atributos sobre base_ids.
+
+    Retorna os ids que atendem a todos os filtros e a contagem de produtos
+    por valor, calculada sem o filtro do próprio tipo (contagem disjuntiva).
+    """
+    if indice is None:
+        indice = obter_indice()
+    tipos = indice['tipos']
+    postings = indice['postings']
+
+    unioes = {}
+    for tipo, valores in selecionados.items():
+        if not valores:
+            continue
+        uniao = set()
+        for valor_id in valores:
+            if tipos.get(valor_id) == tipo:
+                uniao |= postings.get(valor_id, set())
+        unioes[tipo] = uniao
+
+    ids = set(base_ids)
+    for uniao in unioes.values():
+        ids &= uniao
+
+    universos = {}
+    contagens = {}
+    for valor_id, produtos in postings.items():
+        tipo = tipos.get(valor_id)
+        if tipo not in universos:
+            universo = set(base_ids)
+            for outro_tipo, uniao in unioes.items():
+                if outro_tipo != tipo:
+                    universo &= uniao
+            universos[tipo] = universo
+        total = len(produtos & universos[tipo])
+        if total:
+            contagens[valor_id] = total
+
+    return ids, contagens
+
+
+def filtrar(queryset: QuerySet, selecionados: Dict[str, Set[int]]) -> QuerySet:
+    """
+    Filtra os produtos (pk do queryset) pelos valores escolhidos, com a regra
+    do índice: alguma variação ativa com estoque em um dos valores do tipo.
+    """
+    for tipo, valores in selecionados.items():
+        if not valores:
+            continue
+        queryset = queryset.filter(Exists(
+            ProdutoVariacao.atributos.through.objects.filter(
+                produtovariacao__produto_id=OuterRef('pk'),
+                produtovariacao__ativo=True,
+                produtovariacao__estoque__gt=0,
+                atributovalor_id__in=sorted(valores),
+                atributovalor__tipo__nome=tipo,
+            )
+        ))
+    return queryset
+
+
+def obter_contagens(queryset: QuerySet, estado: dict, selecionados: Dict[str, Set[int]]) -> Dict[int, int]:
+    """Contagens por valor do queryset (antes do filtro de atributos), com cache por estado de filtro"""
+    estado = {**estado, 'atributos': {tipo: sorted(valores) for tipo, valores in selecionados.items()}}
+    assinatura = hashlib.md5(json.dumps(estado, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _calcular():
+        base_ids = set(queryset.order_by().values_list('pk', flat=True))
+        return calcular(base_ids, selecionados)[1]
+
+    return get_or_compute(
+        montar_chave('catalogo', 'facetas', assinatura), _calcular, FACETAS_CONFIG['TIMEOUT_CONTAGENS']
+    )
@@ -0,0 +1,343 @@
+"""
+Feed de produtos (estilo Google Merchant, XML e CSV) e sitemap.xml.
+
+O catálogo é dividido em shards por faixa de id de produto (URLS_POR_SHARD
+ids por shard, o limite de URLs de um sitemap). Cada shard é lido em
+streaming com .iterator(chunk_size=...) e gravado direto em arquivos gzip
+no disco: um sitemap-N.xml.gz completo e as partes do feed (itens XML e
+linhas CSV). Os feeds finais são a concatenação de membros gzip
+(cabeçalho + partes + rodapé), o que é um gzip válido e dispensa
+recomprimir o que não mudou.
+
+A assinatura de cada shard (total de cards, ativos e o maior
+atualizado_em de ProdutoCard, que é regravado a cada mudança de produto,
+variação ou imagem) fica em um manifesto; a reconstrução só regrava os
+shards cuja assinatura mudou (ou todos, se uma categoria, marca ou valor
+de atributo foi alterado). Preços promocionais vão com a janela de
+validade (sale_price_effective_date), então o feed não muda nas
+fronteiras de promoção.
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from typing import Iterator, List
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Count, F, Max, Prefetch, Q
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from core.models import AtributoValor, Categoria, Marca, Produto, ProdutoCard, ProdutoVariacao
+
+logger = logging.getLogger(__name__)
+
+FEEDS_CONFIG = {
+    'DIRETORIO': 'feeds',  # dentro do MEDIA_ROOT, servido em MEDIA_URL
+    'TITULO': 'Lukao MultiMarcas',
+    'URLS_POR_SHARD': 50000,  # limite do protocolo de sitemap
+    'TAMANHO_CHUNK': 2000,
+    'MOEDA': 'BRL',
+    'MAX_DESCRICAO': 5000,
+    'MANIFESTO': 'manifesto.json',
+    'MAX_AGE': 60 * 60,  # Cache-Control do sitemap.xml, em segundos
+}
+
+COLUNAS_CSV = [
+    'id', 'item_group_id', 'title', 'description', 'link', 'image_link', 'availability',
+    'price', 'sale_price', 'sale_price_effective_date', 'brand', 'product_type', 'color', 'size',
+    'gtin', 'condition',
+]
+
+_NS_SITEMAP = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+_NS_IMAGEM = 'http://www.google.com/schemas/sitemap-image/1.1'
+_NS_GOOGLE = 'http://base.google.com/ns/1.0'
+
+
+def caminho_arquivo(nome: str) -> str:
+    return os.path.join(settings.MEDIA_ROOT, FEEDS_CONFIG['DIRETORIO'], nome)
+
+
+def url_absoluta(caminho: str) -> str:
+    return f"{settings.SITE_URL.rstrip('/')}{caminho}"
+
+
+def _preco(valor) -> str:
+    return f"{valor:.2f} {FEEDS_CONFIG['MOEDA']}"
+
+
+def _janela(inicio: datetime, fim: datetime) -> str:
+    return f"{inicio.isoformat()}/{fim.isoformat()}"
+
+
+class _ArquivoGzip:
+    """Arquivo gzip de texto gravado em .tmp e movido para o destino ao fechar sem erro"""
+
+    def __init__(self, nome: str):
+        self.destino = caminho_arquivo(nome)
+        self.temporario = f'{self.destino}.tmp'
+
+    def __enter__(self):
+        self.arquivo = gzip.open(self.temporario, 'wt', encoding='utf-8', newline='')
+        return self.arquivo
+
+    def __exit__(self, tipo, valor, rastreio):
+        self.arquivo.close()
+        if tipo is None:
+            os.replace(self.temporario, self.destino)
+        elif os.path.exists(self.temporario):
+            os.remove(self.temporario)
+
+
+def assinaturas() -> dict:
+    """{shard: assinatura} a partir de ProdutoCard, em uma consulta agrupada"""
+    linhas = ProdutoCard.objects.annotate(
+        shard=F('produto_id') / FEEDS_CONFIG['URLS_POR_SHARD']
+    ).order_by().values('shard').annotate(
+        total=Count('pk'),
+        ativos=Count('pk', filter=Q(ativo=True)),
+        ultima=Max('atualizado_em', filter=Q(ativo=True)),
+    )
+    return {
+        int(linha['shard']): [linha['total'], linha['ativos'], linha['ultima'].isoformat() if linha['ultima'] else None]
+        for linha in linhas if linha['ativos']
+    }
+
+
+def versao_classificacoes() -> list:
+    """Última alteração de categorias, marcas e valores de atributo, cujos nomes vão no feed"""
+    return [
+        ultima.isoformat() if ultima else None
+        for ultima in (
+            modelo.objects.aggregate(ultima=Max('updated_at'))['ultima'] for modelo in (Categoria, Marca, AtributoValor)
+        )
+    ]
+
+
+def produtos_do_shard(shard: int) -> Iterator[Produto]:
+    """Produtos ativos do shard, com card e variações ativas, lidos em chunks"""
+    inicio = shard * FEEDS_CONFIG['URLS_POR_SHARD']
+    return Produto.objects.filter(
+        ativo=True, id__gte=inicio, id__lt=inicio + FEEDS_CONFIG['URLS_POR_SHARD']
+    ).select_related('marca', 'categoria', 'card').prefetch_related(
+        Prefetch(
+            'variacoes',
+            queryset=ProdutoVariacao.objects.filter(ativo=True).order_by('id').prefetch_related('atributos__tipo'),
+        )
+    ).order_by('id').iterator(chunk_size=FEEDS_CONFIG['TAMANHO_CHUNK'])
+
+
+def itens_do_produto(produto: Produto) -> List[dict]:
+    """Itens do feed: um por variação ativa (agrupados por produto) ou o próprio produto"""
+    card = getattr(produto, 'card', None)
+    imagem = card.imagem if card and card.imagem else (produto.imagem.name if produto.imagem else '')
+    base = {
+        'title': produto.nome,
+        'description': strip_tags(produto.descricao or produto.nome)[:FEEDS_CONFIG['MAX_DESCRICAO']],
+        'link': url_absoluta(reverse('item-view', args=[produto.pk])),
+        'image_link': url_absoluta(default_storage.url(imagem)) if imagem else '',
+        'brand': produto.marca.nome if produto.marca else '',
+        'product_type': produto.categoria.nome,
+        'condition': 'new',
+        'color': '',
+        'size': '',
+        'sale_price': '',
+        'sale_price_effective_date': '',
+    }
+    promocao_produto = produto.preco_promocional and produto.promocao_inicio and produto.promocao_fim
+
+    variacoes = list(produto.variacoes.all())
+    if not variacoes:
+        item = dict(
+            base,
+            id=produto.sku or f'P{produto.pk}',
+            item_group_id='',
+            availability='in_stock' if card and card.em_estoque else 'out_of_stock',
+            price=_preco(produto.preco),
+            gtin=produto.codigo_barras or '',
+        )
+        if promocao_produto:
+            item['sale_price'] = _preco(produto.preco_promocional)
+            item['sale_price_effective_date'] = _janela(produto.promocao_inicio, produto.promocao_fim)
+        return [item]
+
+    itens = []
+    for variacao in variacoes:
+        item = dict(
+            base,
+            id=variacao.sku or f'V{variacao.pk}',
+            item_group_id=produto.sku or f'P{produto.pk}',
+            availability='in_stock' if variacao.estoque > 0 else 'out_of_stock',
+            price=_preco(produto.preco + variacao.preco_adicional),
+            gtin='',
+        )
+        # Mesma regra de ProdutoVariacao.preco_final, com a janela em vez do instante atual
+        if variacao.preco_promocional and variacao.promocao_inicio and variacao.promocao_fim:
+            item['sale_price'] = _preco(variacao.preco_promocional)
+            item['sale_price_effective_date'] = _janela(variacao.promocao_inicio, variacao.promocao_fim)
+        elif promocao_produto:
+            item['sale_price'] = _preco(produto.preco_promocional + variacao.preco_adicional)
+            item['sale_price_effective_date'] = _janela(produto.promocao_inicio, produto.promocao_fim)
+        for atributo in variacao.atributos.all():
+            if atributo.tipo.tipo == 'color':
+                item['color'] = atributo.valor
+            elif atributo.tipo.tipo == 'size':
+                item['size'] = atributo.valor
+        itens.append(item)
+    return itens
+
+
+def _item_xml(item: dict) -> str:
+    campos = ''.join(
+        f'<g:{coluna}>{escape(str(item[coluna]))}</g:{coluna}>'
+        for coluna in COLUNAS_CSV if item.get(coluna) not in (None, '')
+    )
+    return f'<item>{campos}</item>\n'
+
+
+def _url_sitemap(produto: Produto) -> str:
+    card = getattr(produto, 'card', None)
+    partes = [f'<url><loc>{escape(url_absoluta(reverse("item-view", args=[produto.pk])))}</loc>']
+    if card:
+        partes.append(f'<lastmod>{card.atualizado_em.isoformat()}</lastmod>')
+        if card.imagem:
+            partes.append(
+                f'<image:image><image:loc>{escape(url_absoluta(default_storage.url(card.imagem)))}</image:loc></image:image>'
+            )
+    partes.append('</url>\n')
+    return ''.join(partes)
+
+
+def gerar_shard(shard: int) -> int:
+    """Regrava o sitemap e as partes de feed de um shard; retorna o total de URLs"""
+    total = 0
+    with _ArquivoGzip(f'sitemap-{shard}.xml.gz') as sitemap, \
+            _ArquivoGzip(f'partes/feed-{shard}.xml.gz') as parte_xml, \
+            _ArquivoGzip(f'partes/feed-{shard}.csv.gz') as parte_csv:
+        sitemap.write(
+            f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<urlset xmlns={quoteattr(_NS_SITEMAP)} xmlns:image={quoteattr(_NS_IMAGEM)}>\n'
+        )
+        escritor = csv.DictWriter(parte_csv, fieldnames=COLUNAS_CSV, extrasaction='ignore')
+        for produto in produtos_do_shard(shard):
+            sitemap.write(_url_sitemap(produto))
+            for item in itens_do_produto(produto):
+                parte_xml.write(_item_xml(item))
+                escritor.writerow(item)
+            total += 1
+        sitemap.write('</urlset>\n')
+    return total
+
+
+def _remover_shard(shard: int) -> None:
+    for nome in (f'sitemap-{shard}.xml.gz', f'partes/feed-{shard}.xml.gz', f'partes/feed-{shard}.csv.gz'):
+        if os.path.exists(caminho_arquivo(nome)):
+            os.remove(caminho_arquivo(nome))
+
+
+def _membro_gzip(texto: str) -> bytes:
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as arquivo:
+        arquivo.write(texto.encode('utf-8'))
+    return buffer.getvalue()
+
+
+def _montar_feed(nome: str, shards: List[int], extensao: str, cabecalho: str, rodape: str = '') -> None:
+    """Concatena cabeçalho, partes e rodapé (membros gzip) no feed final"""
+    destino = caminho_arquivo(nome)
+    with open(f'{destino}.tmp', 'wb') as saida:
+        saida.write(_membro_gzip(cabecalho))
+        for shard in shards:
+            with open(caminho_arquivo(f'partes/feed-{shard}.{extensao}.gz'), 'rb') as parte:
+                shutil.copyfileobj(parte, saida)
+        if rodape:
+            saida.write(_membro_gzip(rodape))
+    os.replace(f'{destino}.tmp', destino)
+
+
+def url_arquivo(nome: str) -> str:
+    return url_absoluta(f"{settings.MEDIA_URL}{FEEDS_CONFIG['DIRETORIO']}/{nome}")
+
+
+def _gravar_indice(manifesto: dict) -> None:
+    entradas = ''.join(
+        f'<sitemap><loc>{escape(url_arquivo(f"sitemap-{shard}.xml.gz"))}</loc>'
+        f'<lastmod>{dados["lastmod"]}</lastmod></sitemap>\n'
+        for shard, dados in sorted(manifesto['shards'].items(), key=lambda item: int(item[0]))
+    )
+    destino = caminho_arquivo('sitemap.xml')
+    with open(f'{destino}.tmp', 'w', encoding='utf-8') as arquivo:
+        arquivo.write(
+            f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<sitemapindex xmlns={quoteattr(_NS_SITEMAP)}>\n{entradas}</sitemapindex>\n'
+        )
+    os.replace(f'{destino}.tmp', destino)
+
+
+def ler_manifesto() -> dict:
+    try:
+        with open(caminho_arquivo(FEEDS_CONFIG['MANIFESTO']), encoding='utf-8') as arquivo:
+            return json.load(arquivo)
+    except (FileNotFoundError, ValueError):
+        return {'shards': {}}
+
+
+def gerar(forcar: bool = False) -> dict:
+    """Regrava os shards alterados desde a última execução e remonta índice e feeds"""
+    os.makedirs(caminho_arquivo('partes'), exist_ok=True)
+    manifesto = ler_manifesto()
+    anteriores = manifesto['shards']
+    atuais = assinaturas()
+    agora = timezone.now().isoformat()
+    # Renomear uma categoria ou marca não regrava cards: refaz todos os shards
+    classificacoes = versao_classificacoes()
+    forcar = forcar or manifesto.get('classificacoes') != classificacoes
+
+    regravados = 0
+    shards = {}
+    for shard, assinatura in sorted(atuais.items()):
+        chave = str(shard)
+        anterior = anteriores.get(chave)
+        existe = os.path.exists(caminho_arquivo(f'partes/feed-{shard}.csv.gz'))
+        if forcar or not existe or anterior is None or anterior['assinatura'] != assinatura:
+            urls = gerar_shard(shard)
+            shards[chave] = {'assinatura': assinatura, 'urls': urls, 'lastmod': assinatura[2] or agora}
+            regravados += 1
+        else:
+            shards[chave] = anterior
+
+    removidos = [int(chave) for chave in anteriores if chave not in shards]
+    for shard in removidos:
+        _remover_shard(shard)
+
+    manifesto = {'shards': shards, 'classificacoes': classificacoes, 'gerado_em': agora}
+    if regravados or removidos or not os.path.exists(caminho_arquivo('sitemap.xml')):
+        ordem = sorted(int(chave) for chave in shards)
+        _gravar_indice(manifesto)
+        _montar_feed(
+            'produtos.xml.gz', ordem, 'xml',
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0" xmlns:g={quoteattr(_NS_GOOGLE)}>'
+            f'<channel><title>{escape(FEEDS_CONFIG["TITULO"])}</title>'
+            f'<link>{escape(url_absoluta("/"))}</link>\n',
+            '</channel></rss>\n',
+        )
+        _montar_feed('produtos.csv.gz', ordem, 'csv', ','.join(COLUNAS_CSV) + '\r\n')
+
+    with open(caminho_arquivo(FEEDS_CONFIG['MANIFESTO']) + '.tmp', 'w', encoding='utf-8') as arquivo:
+        json.dump(manifesto, arquivo)
+    os.replace(caminho_arquivo(FEEDS_CONFIG['MANIFESTO']) + '.tmp', caminho_arquivo(FEEDS_CONFIG['MANIFESTO']))
+
+    logger.info(f"Feeds gerados: {regravados} shards regravados, {len(removidos)} removidos")
+    return {
+        'shards': len(shards),
+        'regravados': regravados,
+        'removidos': len(removidos),
+        'urls': sum(dados['urls'] for dados in shards.values()),
+    }
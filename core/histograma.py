@@ -0,0 +1,123 @@
+"""
+Histograma de preços da listagem.
+
+Calcula, em uma única consulta agregada sobre o queryset filtrado, o mínimo,
+o máximo, os tercis (usados nas faixas "Até R$ X" / "R$ X a R$ Y" / "Mais
+de R$ Y") e a contagem por faixa de largura fixa (width_bucket). O
+resultado é cacheado por estado de filtro (categoria, busca, tag). A
+listagem agrega o preço efetivo (com promoção), não o preço de tabela.
+"""
+import hashlib
+import json
+import logging
+import math
+from decimal import Decimal
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import QuerySet
+
+from core.cache import get_or_compute
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAMA_CONFIG = {
+    'FAIXAS': 10,
+    'TIMEOUT': 60 * 15,  # 15 minutos, igual ao cache da página
+    'PREFIXO_CACHE': 'histograma_precos_',
+}
+
+_SQL_HISTOGRAMA = """
+    WITH precos AS (
+        SELECT filtrados.{coluna} AS preco FROM ({subconsulta}) AS filtrados
+    ),
+    limites AS (
+        SELECT
+            min(preco) AS minimo,
+            max(preco) AS maximo,
+            count(*) AS total,
+            percentile_cont(ARRAY[0.33, 0.66]) WITHIN GROUP (ORDER BY preco) AS tercis
+        FROM precos
+    )
+    SELECT l.minimo, l.maximo, l.total, l.tercis, f.faixa, f.quantidade
+    FROM limites l
+    LEFT JOIN LATERAL (
+        SELECT
+            width_bucket(p.preco, l.minimo, l.maximo + 0.01, %s) AS faixa,
+            count(*) AS quantidade
+        FROM precos p
+        GROUP BY 1
+    ) f ON l.total > 0
+    ORDER BY f.faixa
+"""
+
+
+def _histograma_vazio() -> dict:
+    return {
+        'minimo': 0,
+        'maximo': 0,
+        'total': 0,
+        'faixa_preco_1': 0,
+        'faixa_preco_2': 0,
+        'faixas': [],
+    }
+
+
+def calcular_histograma(queryset: QuerySet, faixas: int = None, campo: str = 'preco') -> dict:
+    """
+    Executa a agregação de preços do queryset em uma única consulta.
+
+    campo pode ser uma anotação, como o preco_efetivo de with_preco_vigente().
+    """
+    faixas = faixas or HISTOGRAMA_CONFIG['FAIXAS']
+    try:
+        subconsulta, params = queryset.order_by().values(campo).query.sql_with_params()
+    except EmptyResultSet:
+        return _histograma_vazio()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _SQL_HISTOGRAMA.format(subconsulta=subconsulta, coluna=connection.ops.quote_name(campo)),
+            [*params, faixas]
+        )
+        linhas = cursor.fetchall()
+
+    if not linhas or not linhas[0][2]:
+        return _histograma_vazio()
+
+    minimo, maximo, total, tercis = linhas[0][:4]
+    quantidades = {faixa: quantidade for *_, faixa, quantidade in linhas if faixa is not None}
+    largura = (maximo + Decimal('0.01') - minimo) / faixas
+    maior = max(quantidades.values())
+
+    resultado = {
+        'minimo': math.floor(minimo),
+        'maximo': math.ceil(maximo),
+        'total': total,
+        'faixa_preco_1': int(tercis[0]),
+        'faixa_preco_2': int(tercis[1]),
+        'faixas': [],
+    }
+    for faixa in range(1, faixas + 1):
+        quantidade = quantidades.get(faixa, 0)
+        resultado['faixas'].append({
+            'inicio': round(minimo + largura * (faixa - 1), 2),
+            'fim': round(minimo + largura * faixa, 2),
+            'quantidade': quantidade,
+            'percentual': round(quantidade * 100 / maior),
+        })
+    return resultado
+
+
+def obter_histograma(queryset: QuerySet, estado: dict, campo: str = 'preco') -> dict:
+    """Retorna o histograma do estado de filtro com cache"""
+    estado = {**estado, 'campo': campo}
+    assinatura = hashlib.md5(json.dumps(estado, sort_keys=True, default=str).encode()).hexdigest()
+    cache_key = f"{HISTOGRAMA_CONFIG['PREFIXO_CACHE']}{assinatura}"
+    try:
+        return get_or_compute(
+            cache_key, lambda: calcular_histograma(queryset, campo=campo), HISTOGRAMA_CONFIG['TIMEOUT']
+        )
+    except Exception as e:
+        logger.error(f"Erro ao calcular histograma de preços: {str(e)}")
+        return _histograma_vazio()
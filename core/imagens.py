@@ -0,0 +1,198 @@
+"""
+Derivadas de imagem (miniaturas responsivas em WebP e JPEG).
+
+Para cada imagem original (Produto.imagem, ImagemProduto.imagem e
+Marca.logo) são geradas versões em larguras fixas, gravadas ao lado do
+original: "produtos/foto.jpg" gera "produtos/foto__card.webp",
+"produtos/foto__card.jpg" e assim por diante. Os signals, após o commit,
+enviam a imagem para uma única thread de fundo do processo (o Pillow solta
+o GIL ao decodificar, redimensionar e codificar), sem pool de processos nos
+workers web; o comando gerar_derivadas_imagem processa o MEDIA_ROOT inteiro
+em um pool de processos.
+
+Quem gera registra no manifesto (no cache, por imagem) quais derivadas
+existem, e os templatetags leem o manifesto em vez de consultar o storage
+derivada por derivada. Manifesto ausente é remontado do storage uma vez.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import FrozenSet, Iterable, List, Optional, Tuple
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from core.cache import CacheLocal
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+IMAGENS_CONFIG = {
+    # nome -> largura máxima em pixels (nunca amplia o original)
+    'TAMANHOS': {'card': 400, 'galeria': 800, 'zoom': 1600},
+    # extensão -> (formato do Pillow, qualidade)
+    'FORMATOS': {'webp': ('WEBP', 80), 'jpg': ('JPEG', 85)},
+    'EXTENSOES_ORIGINAIS': ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp'),
+    'SEPARADOR': '__',
+    'PROCESSOS': max(1, (os.cpu_count() or 2) // 2),  # pool do comando gerar_derivadas_imagem
+    'PREFIXO_MANIFESTO': 'imagens_manifesto_',
+    'TTL_MANIFESTO_LOCAL': 60,  # segundos em que o processo reaproveita o manifesto lido
+}
+
+_executor = None
+# Manifestos lidos há pouco, na memória do processo (três filtros por card no template)
+_manifestos_locais = CacheLocal(1000, IMAGENS_CONFIG['TTL_MANIFESTO_LOCAL'])
+
+
+def nome_derivada(nome: str, tamanho: str, extensao: str) -> str:
+    """Nome no storage da derivada de uma imagem original"""
+    raiz, _ = os.path.splitext(nome)
+    return f"{raiz}{IMAGENS_CONFIG['SEPARADOR']}{tamanho}.{extensao}"
+
+
+def eh_derivada(nome: str) -> bool:
+    raiz = os.path.splitext(os.path.basename(nome))[0]
+    return any(
+        raiz.endswith(f"{IMAGENS_CONFIG['SEPARADOR']}{tamanho}") for tamanho in IMAGENS_CONFIG['TAMANHOS']
+    )
+
+
+def destinos_derivadas(nome: str) -> List[Tuple[str, int, str, int]]:
+    """(caminho, largura, formato, qualidade) de cada derivada da imagem"""
+    return [
+        (default_storage.path(nome_derivada(nome, tamanho, extensao)), largura, formato, qualidade)
+        for tamanho, largura in IMAGENS_CONFIG['TAMANHOS'].items()
+        for extensao, (formato, qualidade) in IMAGENS_CONFIG['FORMATOS'].items()
+    ]
+
+
+def processar_imagem(origem: str, destinos: List[Tuple[str, int, str, int]], forcar: bool = False) -> int:
+    """
+    Gera as derivadas de um arquivo. Roda nos processos do pool, por isso
+    recebe só caminhos absolutos e não usa Django.
+    """
+    pendentes = [destino for destino in destinos if forcar or not os.path.exists(destino[0])]
+    if not pendentes:
+        return 0
+
+    with Image.open(origem) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+
+        for caminho, largura, formato, qualidade in pendentes:
+            imagem = original.copy()
+            if imagem.width > largura:
+                imagem.thumbnail((largura, largura * 10), Image.LANCZOS)
+            if formato == 'JPEG' and imagem.mode == 'RGBA':
+                fundo = Image.new('RGB', imagem.size, (255, 255, 255))
+                fundo.paste(imagem, mask=imagem.getchannel('A'))
+                imagem = fundo
+            temporario = f'{caminho}.tmp'
+            imagem.save(temporario, formato, quality=qualidade, optimize=True)
+            os.replace(temporario, caminho)
+    return len(pendentes)
+
+
+def _chave_manifesto(nome: str) -> str:
+    return f"{IMAGENS_CONFIG['PREFIXO_MANIFESTO']}{nome}"
+
+
+def registrar_manifesto(nome: str) -> FrozenSet[Tuple[str, str]]:
+    """Grava no manifesto os (tamanho, extensão) das derivadas que existem no storage"""
+    existentes = frozenset(
+        (tamanho, extensao)
+        for tamanho in IMAGENS_CONFIG['TAMANHOS']
+        for extensao in IMAGENS_CONFIG['FORMATOS']
+        if default_storage.exists(nome_derivada(nome, tamanho, extensao))
+    )
+    cache.set(_chave_manifesto(nome), existentes, None)
+    _manifestos_locais.gravar(nome, existentes)
+    return existentes
+
+
+def manifesto(nome: str) -> FrozenSet[Tuple[str, str]]:
+    """(tamanho, extensão) das derivadas já geradas da imagem"""
+    existentes = _manifestos_locais.obter(nome)
+    if isinstance(existentes, frozenset):
+        return existentes
+    existentes = cache.get(_chave_manifesto(nome))
+    if existentes is None:
+        return registrar_manifesto(nome)
+    _manifestos_locais.gravar(nome, existentes)
+    return existentes
+
+
+def gerar_derivadas(nome: str, forcar: bool = False) -> int:
+    """Gera, no processo atual, as derivadas da imagem informada e atualiza o manifesto"""
+    if not nome or eh_derivada(nome) or not default_storage.exists(nome):
+        return 0
+    geradas = processar_imagem(default_storage.path(nome), destinos_derivadas(nome), forcar)
+    if geradas or forcar:
+        registrar_manifesto(nome)
+    return geradas
+
+
+def _obter_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='derivadas')
+    return _executor
+
+
+def _gerar_em_segundo_plano(nome: str) -> None:
+    try:
+        gerar_derivadas(nome)
+    except Exception as e:
+        logger.error(f"Erro ao gerar derivadas de {nome}: {str(e)}")
+
+
+def agendar_derivadas(nomes: Iterable[Optional[str]]) -> None:
+    """Envia as imagens sem derivadas completas para a thread de fundo após o commit da transação"""
+    nomes = {nome for nome in nomes if nome and not eh_derivada(nome)}
+    if not nomes:
+        return
+    for nome in nomes:
+        apos_commit(_enviar_se_incompleta, nome, erro=f"Erro ao agendar derivadas de {nome}")
+
+
+def _enviar_se_incompleta(nome: str) -> None:
+    if len(manifesto(nome)) < len(IMAGENS_CONFIG['TAMANHOS']) * len(IMAGENS_CONFIG['FORMATOS']):
+        _obter_executor().submit(_gerar_em_segundo_plano, nome)
+
+
+def remover_derivadas(nome: Optional[str]) -> None:
+    """Apaga as derivadas de uma imagem original"""
+    if not nome:
+        return
+    for tamanho in IMAGENS_CONFIG['TAMANHOS']:
+        for extensao in IMAGENS_CONFIG['FORMATOS']:
+            derivada = nome_derivada(nome, tamanho, extensao)
+            if default_storage.exists(derivada):
+                default_storage.delete(derivada)
+    cache.delete(_chave_manifesto(nome))
+    _manifestos_locais.descartar(nome)
+
+
+def derivadas_disponiveis(nome: Optional[str], extensao: str) -> List[Tuple[str, int]]:
+    """(url, largura) das derivadas já geradas da imagem, da menor para a maior"""
+    if not nome:
+        return []
+    existentes = manifesto(nome)
+    return [
+        (default_storage.url(nome_derivada(nome, tamanho, extensao)), largura)
+        for tamanho, largura in sorted(IMAGENS_CONFIG['TAMANHOS'].items(), key=lambda item: item[1])
+        if (tamanho, extensao) in existentes
+    ]
+
+
+def listar_originais(raiz: str) -> Iterable[str]:
+    """Percorre o MEDIA_ROOT devolvendo os nomes (relativos) das imagens originais"""
+    for diretorio, _, arquivos in os.walk(raiz):
+        for arquivo in arquivos:
+            if not arquivo.lower().endswith(IMAGENS_CONFIG['EXTENSOES_ORIGINAIS']):
+                continue
+            nome = os.path.relpath(os.path.join(diretorio, arquivo), raiz).replace(os.sep, '/')
+            if not eh_derivada(nome):
+                yield nome
@@ -0,0 +1,482 @@
+"""
+Importação em massa do catálogo (CSV ou JSONL).
+
+Cada linha descreve um produto, identificado pelo SKU, e opcionalmente uma
+de suas variações (coluna atributos, ex.: "Cor=Azul;Tamanho=M"). O arquivo
+é lido em streaming e processado em lotes de tamanho fixo, então a memória
+não cresce com o arquivo:
+
+- categorias, marcas, tags e valores de atributo são resolvidos por mapas
+  em memória carregados uma vez (marcas, tags e valores novos são criados);
+- cada lote busca os produtos e variações já existentes em uma consulta,
+  valida as linhas e grava com bulk_create/bulk_update, inclusive nas
+  tabelas de ligação de atributos e tags;
+- se o banco recusar o lote (ex.: SKU de variação repetido), ele é
+  regravado linha a linha para apontar a linha com erro, com a mesma regra
+  do lote: a primeira linha de um SKU grava o produto e as seguintes só
+  acrescentam variações e tags.
+
+Célula vazia (ou coluna ausente) deixa o campo como está; para limpar um
+campo use null no JSONL.
+
+Como bulk_create não dispara signals, busca, facetas, cards, matrizes de
+variação e caches de preço dos produtos do lote são atualizados em seguida.
+Os produtos do lote ficam marcados para os similares na transação do lote,
+e o comando calcular_similares --pendentes os recalcula depois; nada do
+arquivo é acumulado até o fim da importação.
+"""
+import csv
+import json
+import logging
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, models, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from core import busca, cards, categorias, facetas, similares, sugestoes
+from core.cache import invalidar_escopos, invalidar_namespace
+from core.models import (
+    AtributoTipo, AtributoValor, Categoria, HistoricoPreco, Marca, Produto, ProdutoVariacao, Tag
+)
+from core.promocoes import atualizar_descontos, escopos_afetados
+
+logger = logging.getLogger(__name__)
+
+IMPORTACAO_CONFIG = {
+    'TAMANHO_LOTE': 500,
+    'SEPARADOR_LISTA': ';',
+    'SEPARADOR_ATRIBUTO': '=',
+    'VERDADEIROS': {'1', 'true', 't', 'sim', 's', 'yes', 'y'},
+    'FALSOS': {'0', 'false', 'f', 'nao', 'não', 'n', 'no'},
+}
+
+# Colunas do arquivo gravadas diretamente no produto
+CAMPOS_PRODUTO = [
+    'nome', 'descricao', 'preco', 'preco_original', 'preco_promocional', 'promocao_inicio',
+    'promocao_fim', 'peso', 'width', 'height', 'length', 'codigo_barras', 'genero', 'temporada',
+    'cuidados', 'origem', 'seo_description', 'ativo', 'destaque', 'visivel',
+]
+CAMPOS_GRAVADOS_PRODUTO = CAMPOS_PRODUTO + ['categoria', 'marca', 'slug', 'seo_title', 'updated_at']
+
+# Coluna do arquivo -> campo da variação
+COLUNAS_VARIACAO = {
+    'variacao_sku': 'sku',
+    'estoque': 'estoque',
+    'preco_adicional': 'preco_adicional',
+    'variacao_ativo': 'ativo',
+    'variacao_peso': 'peso',
+    'variacao_preco_promocional': 'preco_promocional',
+    'variacao_promocao_inicio': 'promocao_inicio',
+    'variacao_promocao_fim': 'promocao_fim',
+}
+CAMPOS_GRAVADOS_VARIACAO = list(COLUNAS_VARIACAO.values()) + ['updated_at']
+
+
+def ler_arquivo(caminho: str, formato: Optional[str] = None) -> Iterator[Tuple[int, object]]:
+    """Gera (número da linha, dados) sem carregar o arquivo inteiro"""
+    formato = formato or ('jsonl' if caminho.lower().endswith(('.jsonl', '.json')) else 'csv')
+    with open(caminho, encoding='utf-8-sig', newline='') as arquivo:
+        if formato == 'csv':
+            for numero, linha in enumerate(csv.DictReader(arquivo), start=2):
+                yield numero, linha
+        else:
+            # O JSON é decodificado no processamento, para o erro sair na linha certa
+            for numero, texto in enumerate(arquivo, start=1):
+                if texto.strip():
+                    yield numero, texto
+
+
+def _mensagem(erro: Exception) -> str:
+    if isinstance(erro, ValidationError):
+        if hasattr(erro, 'error_dict'):
+            return '; '.join(
+                f"{campo}: {' '.join(mensagens)}" for campo, mensagens in erro.message_dict.items()
+            )
+        return ' '.join(erro.messages)
+    return str(erro).strip().splitlines()[0] if str(erro).strip() else erro.__class__.__name__
+
+
+def _texto(valor) -> str:
+    return str(valor).strip() if valor is not None else ''
+
+
+def _lista(valor) -> List[str]:
+    if isinstance(valor, (list, tuple)):
+        itens = valor
+    else:
+        itens = _texto(valor).split(IMPORTACAO_CONFIG['SEPARADOR_LISTA'])
+    return [_texto(item) for item in itens if _texto(item)]
+
+
+def _atributos(valor) -> List[Tuple[str, str]]:
+    """Aceita {"Cor": "Azul"}, ["Cor=Azul", ...] ou "Cor=Azul;Tamanho=M" """
+    if isinstance(valor, dict):
+        pares = [(_texto(tipo), _texto(item)) for tipo, item in valor.items()]
+    else:
+        pares = []
+        for item in _lista(valor):
+            tipo, separador, item = item.partition(IMPORTACAO_CONFIG['SEPARADOR_ATRIBUTO'])
+            if not separador:
+                raise ValidationError(f"Atributo '{tipo}' sem valor (use Tipo=Valor).")
+            pares.append((tipo.strip(), item.strip()))
+    return [(tipo, item) for tipo, item in pares if tipo and item]
+
+
+def _converter(modelo, campo: str, valor):
+    """Normaliza o valor lido do arquivo; a conversão final é do clean_fields"""
+    if isinstance(valor, str):
+        valor = valor.strip()
+        if valor == '':
+            return None
+    field = modelo._meta.get_field(campo)
+    if isinstance(field, models.BooleanField) and isinstance(valor, str):
+        if valor.lower() in IMPORTACAO_CONFIG['VERDADEIROS']:
+            return True
+        if valor.lower() in IMPORTACAO_CONFIG['FALSOS']:
+            return False
+    if isinstance(field, models.DecimalField) and isinstance(valor, str) and '.' not in valor:
+        valor = valor.replace(',', '.')  # "129,90"
+    return valor
+
+
+def _aplicar(instancia, valores: dict) -> None:
+    for campo, valor in valores.items():
+        field = instancia._meta.get_field(campo)
+        if valor is None and not field.null:
+            valor = field.get_default()
+        setattr(instancia, campo, valor)
+
+
+class ImportadorCatalogo:
+    """Importa linhas de catálogo em lotes; erros de linha vão para ao_errar(numero, mensagem)"""
+
+    def __init__(
+        self,
+        tamanho_lote: Optional[int] = None,
+        ao_errar: Optional[Callable[[int, str], None]] = None,
+        criar_faltantes: bool = True,
+    ):
+        self.tamanho_lote = max(1, tamanho_lote or IMPORTACAO_CONFIG['TAMANHO_LOTE'])
+        self.ao_errar = ao_errar or (lambda numero, mensagem: None)
+        self.criar_faltantes = criar_faltantes
+        self.totais = {'linhas': 0, 'produtos': 0, 'variacoes': 0, 'erros': 0}
+        self._carregar_mapas()
+
+    def _carregar_mapas(self) -> None:
+        self.categorias = {}
+        for categoria_id, nome, slug in Categoria.objects.order_by('ordem', 'id').values_list('id', 'nome', 'slug'):
+            self.categorias.setdefault(nome.strip().lower(), categoria_id)
+            self.categorias.setdefault(slug, categoria_id)
+        self.marcas = {nome.lower(): marca_id for marca_id, nome in Marca.objects.values_list('id', 'nome')}
+        self.tags = {nome.lower(): tag_id for tag_id, nome in Tag.objects.values_list('id', 'nome')}
+        self.tipos = {tipo.nome.lower(): tipo for tipo in AtributoTipo.objects.all()}
+        self.obrigatorios = {tipo.id: tipo.nome for tipo in self.tipos.values() if tipo.obrigatorio}
+        self.valores = {}
+        self.sufixos = {}
+        for valor in AtributoValor.objects.select_related('tipo'):
+            self._registrar_valor(valor)
+
+    def _registrar_valor(self, valor: AtributoValor) -> None:
+        self.valores[(valor.tipo_id, valor.valor.lower())] = valor.id
+        # Mesma regra de ProdutoVariacao.gerar_sku_automatico
+        self.sufixos[valor.id] = (valor.tipo.ordem, valor.tipo.nome, valor.codigo or valor.valor[:3].upper())
+
+    # Resolução por mapa (cria o que faltar)
+
+    def _faltante(self, descricao: str) -> None:
+        if not self.criar_faltantes:
+            raise ValidationError(f"{descricao} não encontrada.")
+
+    def _marca(self, nome: str) -> Optional[int]:
+        if not nome:
+            return None
+        if nome.lower() not in self.marcas:
+            self._faltante(f"Marca '{nome}'")
+            marca = Marca(nome=nome)
+            marca.save()
+            self.marcas[nome.lower()] = marca.id
+        return self.marcas[nome.lower()]
+
+    def _tag(self, nome: str) -> int:
+        if nome.lower() not in self.tags:
+            self._faltante(f"Tag '{nome}'")
+            tag = Tag(nome=nome)
+            tag.full_clean()
+            tag.save()
+            self.tags[nome.lower()] = tag.id
+        return self.tags[nome.lower()]
+
+    def _valor_atributo(self, tipo: AtributoTipo, valor: str) -> int:
+        if (tipo.id, valor.lower()) not in self.valores:
+            self._faltante(f"Valor '{valor}' de '{tipo.nome}'")
+            novo = AtributoValor(tipo=tipo, valor=valor)
+            novo.save()
+            self._registrar_valor(novo)
+        return self.valores[(tipo.id, valor.lower())]
+
+    # Preparação (sem gravar produtos)
+
+    def _preparar(self, numero: int, dados) -> dict:
+        # No CSV, None é coluna faltando no fim da linha; no JSONL, null limpa o campo
+        vazios = ('',) if isinstance(dados, str) else ('', None)
+        if isinstance(dados, str):
+            try:
+                dados = json.loads(dados)
+            except ValueError as e:
+                raise ValidationError(f"JSON inválido: {e}")
+        if not isinstance(dados, dict):
+            raise ValidationError("A linha deve ser um objeto com as colunas do produto.")
+        dados = {
+            _texto(chave).lower(): valor for chave, valor in dados.items()
+            if chave and (valor.strip() if isinstance(valor, str) else valor) not in vazios
+        }
+
+        sku = _texto(dados.get('sku'))
+        if not sku:
+            raise ValidationError("SKU do produto não informado.")
+
+        linha = {
+            'numero': numero,
+            'sku': sku,
+            'produto': {
+                campo: _converter(Produto, campo, dados[campo]) for campo in CAMPOS_PRODUTO if campo in dados
+            },
+            'categoria_id': None,
+            'tag_ids': [self._tag(nome) for nome in _lista(dados.get('tags'))],
+            'variacao': None,
+            'valor_ids': [],
+        }
+
+        categoria = _texto(dados.get('categoria'))
+        if categoria:
+            linha['categoria_id'] = self.categorias.get(categoria.lower())
+            if linha['categoria_id'] is None:
+                raise ValidationError(f"Categoria '{categoria}' não encontrada.")
+        if 'marca' in dados:
+            linha['marca_id'] = self._marca(_texto(dados['marca']))
+
+        atributos = _atributos(dados.get('atributos'))
+        if atributos:
+            vistos = set()
+            for nome_tipo, valor in atributos:
+                tipo = self.tipos.get(nome_tipo.lower())
+                if tipo is None:
+                    raise ValidationError(f"Tipo de atributo '{nome_tipo}' não encontrado.")
+                if tipo.id in vistos:
+                    raise ValidationError(f"Múltiplos valores para '{tipo.nome}' não são permitidos.")
+                vistos.add(tipo.id)
+                linha['valor_ids'].append(self._valor_atributo(tipo, valor))
+            for tipo_id, nome_tipo in self.obrigatorios.items():
+                if tipo_id not in vistos:
+                    raise ValidationError(f"Atributo obrigatório '{nome_tipo}' não foi selecionado.")
+
+            valores = {
+                campo: _converter(ProdutoVariacao, campo, dados[coluna])
+                for coluna, campo in COLUNAS_VARIACAO.items() if coluna in dados
+            }
+            variacao = ProdutoVariacao()
+            _aplicar(variacao, valores)
+            variacao.clean_fields(exclude=[
+                field.name for field in ProdutoVariacao._meta.fields if field.name not in valores
+            ])
+            linha['variacao'] = {campo: getattr(variacao, campo) for campo in valores}
+
+        return linha
+
+    # Gravação do lote
+
+    def _montar_produto(self, linha: dict, produto: Optional[Produto]) -> Produto:
+        preco_anterior = produto.preco if produto else None
+        if produto is None:
+            produto = Produto(sku=linha['sku'])
+        _aplicar(produto, linha['produto'])
+        if linha['categoria_id']:
+            produto.categoria_id = linha['categoria_id']
+        if 'marca_id' in linha:
+            produto.marca_id = linha['marca_id']
+
+        produto.clean_fields(exclude=['categoria', 'marca', 'slug', 'imagem', 'desconto'])
+        if not produto.categoria_id:
+            raise ValidationError({'categoria': ["Categoria não informada."]})
+        produto.clean()
+        if not produto.preco_original:
+            produto.preco_original = produto.preco
+        if not produto.seo_title:
+            produto.seo_title = produto.nome[:70]
+        produto._preco_anterior = preco_anterior
+        return produto
+
+    def _definir_slugs(self, novos: List[Produto]) -> None:
+        """Slug pelo nome, como no save(); se já existir, usa o SKU como sufixo"""
+        candidatos = [(produto, slugify(produto.nome)[:200]) for produto in novos]
+        ocupados = set(
+            Produto.objects.filter(slug__in={slug for _, slug in candidatos}).values_list('slug', flat=True)
+        )
+        for produto, slug in candidatos:
+            if slug in ocupados:
+                slug = f"{slug}-{slugify(produto.sku)}"[:255]
+            ocupados.add(slug)
+            produto.slug = slug
+
+    def _sku_variacao(self, sku_produto: str, valor_ids: List[int]) -> str:
+        sufixos = [self.sufixos[valor_id] for valor_id in valor_ids]
+        return f"{sku_produto}-{'-'.join(sufixo for _, _, sufixo in sorted(sufixos))}"[:50]
+
+    def _gravar(self, linhas: List[dict]) -> Tuple[set, set]:
+        """Grava o lote; retorna ids dos produtos e das variações gravados"""
+        agora = timezone.now()
+        existentes = {
+            produto.sku: produto for produto in Produto.objects.filter(sku__in={linha['sku'] for linha in linhas})
+        }
+
+        produtos, validas, sem_alteracao = {}, [], set()
+        for linha in linhas:
+            if linha.get('continuacao') and linha['sku'] not in produtos:
+                # Regravação linha a linha: o produto veio da primeira linha do SKU, já gravada
+                produtos[linha['sku']] = existentes.get(linha['sku'])
+                sem_alteracao.add(linha['sku'])
+            if linha['sku'] in produtos:
+                # Linhas seguintes do mesmo produto só acrescentam variações e tags
+                if produtos[linha['sku']] is None:
+                    self._erro(linha['numero'], ValidationError(f"Produto {linha['sku']} inválido em linha anterior."))
+                else:
+                    validas.append(linha)
+                continue
+            try:
+                produtos[linha['sku']] = self._montar_produto(linha, existentes.get(linha['sku']))
+                validas.append(linha)
+            except ValidationError as e:
+                produtos[linha['sku']] = None
+                self._erro(linha['numero'], e)
+
+        produtos = {sku: produto for sku, produto in produtos.items() if produto is not None}
+        novos = [produto for produto in produtos.values() if produto.pk is None]
+        alterados = [
+            produto for sku, produto in produtos.items() if produto.pk is not None and sku not in sem_alteracao
+        ]
+        self._definir_slugs(novos)
+        Produto.objects.bulk_create(novos)
+        for produto in alterados:
+            produto.updated_at = agora
+        Produto.objects.bulk_update(alterados, CAMPOS_GRAVADOS_PRODUTO)
+        HistoricoPreco.objects.bulk_create([
+            HistoricoPreco(produto_id=produto.id, preco=produto.preco)
+            for produto in alterados if produto._preco_anterior != produto.preco
+        ])
+        produto_ids = {produto.id for produto in produtos.values()}
+        atualizar_descontos(produto_ids, agora)
+
+        Produto.tags.through.objects.bulk_create([
+            Produto.tags.through(produto_id=produtos[linha['sku']].id, tag_id=tag_id)
+            for linha in validas for tag_id in linha['tag_ids']
+        ], ignore_conflicts=True)
+
+        # Variações: a combinação de atributos (atributos_hash) identifica a variação do produto
+        por_combinacao = {}
+        for linha in validas:
+            if linha['variacao'] is not None:
+                produto = produtos[linha['sku']]
+                chave = (produto.id, ProdutoVariacao.hash_de_atributos(linha['valor_ids']))
+                por_combinacao[chave] = linha
+        existentes = {
+            (variacao.produto_id, variacao.atributos_hash): variacao
+            for variacao in ProdutoVariacao.objects.filter(
+                produto_id__in={produto_id for produto_id, _ in por_combinacao},
+                atributos_hash__in={atributos_hash for _, atributos_hash in por_combinacao},
+            )
+        }
+        novas, alteradas, ligacoes = [], [], []
+        for (produto_id, atributos_hash), linha in por_combinacao.items():
+            variacao = existentes.get((produto_id, atributos_hash))
+            if variacao is None:
+                variacao = ProdutoVariacao(produto_id=produto_id, atributos_hash=atributos_hash)
+                novas.append(variacao)
+                ligacoes.append((variacao, linha['valor_ids']))
+            else:
+                variacao.updated_at = agora
+                alteradas.append(variacao)
+            _aplicar(variacao, linha['variacao'])
+            if not variacao.sku:
+                variacao.sku = self._sku_variacao(linha['sku'], linha['valor_ids'])
+
+        ProdutoVariacao.objects.bulk_create(novas)
+        ProdutoVariacao.objects.bulk_update(alteradas, CAMPOS_GRAVADOS_VARIACAO)
+        ProdutoVariacao.atributos.through.objects.bulk_create([
+            ProdutoVariacao.atributos.through(produtovariacao_id=variacao.id, atributovalor_id=valor_id)
+            for variacao, valor_ids in ligacoes for valor_id in valor_ids
+        ], ignore_conflicts=True)
+
+        self.totais['produtos'] += len(produtos) - len(sem_alteracao & set(produtos))
+        self.totais['variacoes'] += len(novas) + len(alteradas)
+        return produto_ids, {variacao.id for variacao in novas + alteradas}
+
+    def _atualizar_derivados(self, produto_ids: set, variacao_ids: set) -> None:
+        """O que os signals fariam em save() de cada produto e variação"""
+        # Preços, variações e matriz ficam no escopo do produto
+        escopos_produto, escopos_carrinho = escopos_afetados(produto_ids, variacao_ids)
+        invalidar_escopos('produto', escopos_produto)
+        invalidar_escopos('carrinho', escopos_carrinho)
+        busca.atualizar_documentos(produto_ids)
+        facetas.atualizar_produtos(produto_ids)
+        cards.atualizar_cards(produto_ids)
+
+    def _erro(self, numero: int, erro: Exception) -> None:
+        self.totais['erros'] += 1
+        self.ao_errar(numero, _mensagem(erro))
+
+    def _processar_lote(self, lote: List[Tuple[int, object]]) -> None:
+        linhas = []
+        for numero, dados in lote:
+            try:
+                linhas.append(self._preparar(numero, dados))
+            except ValidationError as e:
+                self._erro(numero, e)
+        self._gravar_linhas(linhas)
+
+    def _gravar_linhas(self, linhas: List[dict]) -> None:
+        if not linhas:
+            return
+        totais = dict(self.totais)
+        try:
+            with transaction.atomic():
+                produto_ids, variacao_ids = self._gravar(linhas)
+                similares.marcar_pendentes(produto_ids)
+        except DatabaseError as e:
+            self.totais.update({'produtos': totais['produtos'], 'variacoes': totais['variacoes']})
+            if len(linhas) == 1:
+                self._erro(linhas[0]['numero'], e)
+                return
+            # Regrava linha a linha para isolar a que o banco recusou
+            logger.warning(f"Lote de importação recusado, regravando linha a linha: {_mensagem(e)}")
+            vistos, falhos = set(), set()
+            for linha in linhas:
+                if linha['sku'] in falhos:
+                    self._erro(linha['numero'], ValidationError(f"Produto {linha['sku']} inválido em linha anterior."))
+                    continue
+                linha['continuacao'] = linha['sku'] in vistos
+                vistos.add(linha['sku'])
+                erros = self.totais['erros']
+                self._gravar_linhas([linha])
+                if self.totais['erros'] > erros and not linha['continuacao']:
+                    falhos.add(linha['sku'])
+            return
+        self._atualizar_derivados(produto_ids, variacao_ids)
+
+    def importar(self, linhas: Iterable[Tuple[int, object]]) -> dict:
+        """Processa (número, dados) em lotes e retorna os totais"""
+        lote = []
+        for numero, dados in linhas:
+            self.totais['linhas'] += 1
+            lote.append((numero, dados))
+            if len(lote) >= self.tamanho_lote:
+                self._processar_lote(lote)
+                lote = []
+        self._processar_lote(lote)
+
+        categorias.recalcular_totais()
+        sugestoes.invalidar_indice()
+        sugestoes.publicar_indice()
+        invalidar_namespace('catalogo')
+        return self.totais
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import PRECO_CACHE_TIMEOUT
+from core.promocoes import PROMOCOES_CONFIG, aplicar_fronteiras, proxima_fronteira
+
+
+class Command(BaseCommand):
+    help = "Invalida os caches de preço exatamente quando promoções começam ou terminam"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--uma-vez',
+            action='store_true',
+            help="Aplica as fronteiras já cruzadas e sai (para uso via cron)"
+        )
+        parser.add_argument(
+            '--intervalo-maximo',
+            type=int,
+            default=PROMOCOES_CONFIG['INTERVALO_MAXIMO'],
+            help="Tempo máximo de espera, em segundos, entre duas verificações"
+        )
+
+    def handle(self, *args, **options):
+        intervalo_maximo = max(1, options['intervalo_maximo'])
+        # Na partida, qualquer fronteira dentro do TTL dos preços pode ter deixado valor defasado
+        desde = timezone.now() - timezone.timedelta(seconds=PRECO_CACHE_TIMEOUT)
+
+        while True:
+            agora = timezone.now()
+            total = aplicar_fronteiras(desde, agora)
+            if total:
+                self.stdout.write(f"{agora:%Y-%m-%d %H:%M:%S}: {total} chaves invalidadas")
+            desde = agora
+
+            if options['uma_vez']:
+                break
+
+            espera = intervalo_maximo
+            proxima = proxima_fronteira(agora)
+            if proxima is not None:
+                espera = min(espera, (proxima - agora).total_seconds() + PROMOCOES_CONFIG['TOLERANCIA'])
+            time.sleep(max(espera, 0))
+
+        self.stdout.write(self.style.SUCCESS("Fronteiras de promoção aplicadas"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from core.cards import CARDS_CONFIG, atualizar_cards
+from core.models import Produto
+
+
+class Command(BaseCommand):
+    help = "Regrava os cards de produto (home e listagem) em lotes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=CARDS_CONFIG['TAMANHO_LOTE'],
+            help="Quantidade de produtos processados por lote"
+        )
+
+    def handle(self, *args, **options):
+        lote = max(1, options['lote'])
+        ultimo_id = 0
+        total = 0
+
+        # Paginação por id mantém o custo de cada lote constante
+        while True:
+            ids = list(
+                Produto.objects.filter(id__gt=ultimo_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:lote]
+            )
+            if not ids:
+                break
+            total += atualizar_cards(ids)
+            ultimo_id = ids[-1]
+            self.stdout.write(f"{total} cards atualizados...")
+
+        self.stdout.write(self.style.SUCCESS(f"Cards de produto atualizados: {total}"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.recomendacoes import RECOMENDACOES_CONFIG, reconstruir
+
+
+class Command(BaseCommand):
+    help = "Recalcula as coocorrências e os produtos comprados juntos a partir dos pedidos pagos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=RECOMENDACOES_CONFIG['TOP_K'])
+        parser.add_argument('--minimo', type=int, default=RECOMENDACOES_CONFIG['MIN_COOCORRENCIAS'])
+        parser.add_argument('--metrica', choices=['cosseno', 'lift'], default=RECOMENDACOES_CONFIG['METRICA'])
+
+    def handle(self, *args, **options):
+        resultado = reconstruir(options['top_k'], options['minimo'], options['metrica'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{resultado['pedidos']} pedidos, {resultado['produtos']} produtos, "
+            f"{resultado['pares']} pares e {resultado['vizinhos']} vizinhos gravados"
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from core.similares import atualizar_pendentes, recalcular_catalogo
+
+
+class Command(BaseCommand):
+    help = "Recalcula os produtos similares (por categoria, marca, tags e atributos) de todo o catálogo"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pendentes', action='store_true',
+            help="Recalcula só os produtos alterados desde a última execução (para rodar agendado)",
+        )
+        parser.add_argument('--limite', type=int, help="Máximo de produtos pendentes por execução")
+
+    def handle(self, *args, **options):
+        if options['pendentes']:
+            total = atualizar_pendentes(options['limite'])
+        else:
+            total = recalcular_catalogo()
+        if total is None:
+            self.stdout.write(self.style.WARNING("Outro cálculo de similares em andamento; nada feito"))
+            return
+        self.stdout.write(self.style.SUCCESS(f"{total} produtos similares gravados"))
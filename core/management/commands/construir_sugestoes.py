@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.sugestoes import publicar_indice
+
+
+class Command(BaseCommand):
+    help = "Constrói o índice de sugestões de busca e o publica no cache para os processos web"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--forcar', action='store_true',
+            help="Reconstrói mesmo se o índice publicado estiver em dia (ex.: para atualizar os pesos)",
+        )
+
+    def handle(self, *args, **options):
+        indice = publicar_indice(forcar=options['forcar'])
+        if indice is None:
+            self.stdout.write("Índice de sugestões em dia ou em construção em outro processo")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Índice de sugestões publicado: {len(indice['entradas'])} entradas"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.midia import mover_para_conteudo, recalcular_referencias
+from core.models import ImagemProduto, Produto
+
+
+class Command(BaseCommand):
+    help = "Move as imagens de produto para nomes por conteúdo, apagando duplicadas, e recalcula as referências"
+
+    def handle(self, *args, **options):
+        nomes = set(Produto.objects.values_list('imagem', flat=True).distinct())
+        nomes |= set(ImagemProduto.objects.values_list('imagem', flat=True).distinct())
+
+        movidos = 0
+        destinos = set()
+        for nome in sorted(nome for nome in nomes if nome):
+            novo = mover_para_conteudo(nome)
+            if novo is None:
+                continue
+            destinos.add(novo)
+            if novo != nome:
+                movidos += 1
+
+        total = recalcular_referencias()
+        self.stdout.write(self.style.SUCCESS(
+            f"{movidos} arquivos renomeados, {len(destinos)} arquivos únicos, {total} com referência. "
+            "Rode gerar_derivadas_imagem para recriar as derivadas."
+        ))
@@ -0,0 +1,43 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from core.imagens import IMAGENS_CONFIG, destinos_derivadas, listar_originais, processar_imagem, registrar_manifesto
+
+
+class Command(BaseCommand):
+    help = "Gera em paralelo as derivadas (card, galeria, zoom em WebP/JPEG) de todas as imagens do MEDIA_ROOT"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processos',
+            type=int,
+            default=IMAGENS_CONFIG['PROCESSOS'],
+            help="Quantidade de processos do pool"
+        )
+        parser.add_argument(
+            '--forcar',
+            action='store_true',
+            help="Regera derivadas que já existem"
+        )
+
+    def handle(self, *args, **options):
+        geradas = 0
+        falhas = 0
+
+        with ProcessPoolExecutor(max_workers=max(1, options['processos'])) as pool:
+            futuros = {
+                pool.submit(processar_imagem, default_storage.path(nome), destinos_derivadas(nome), options['forcar']): nome
+                for nome in listar_originais(settings.MEDIA_ROOT)
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    geradas += futuro.result()
+                    registrar_manifesto(futuros[futuro])
+                except Exception as e:
+                    falhas += 1
+                    self.stderr.write(f"Erro em {futuros[futuro]}: {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f"Derivadas geradas: {geradas} ({falhas} imagens com erro)"))
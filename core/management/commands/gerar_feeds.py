@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.feeds import gerar
+
+
+class Command(BaseCommand):
+    help = "Gera o feed de produtos (XML e CSV) e o sitemap, regravando só os shards alterados"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forcar', action='store_true', help="Regrava todos os shards")
+
+    def handle(self, *args, **options):
+        resultado = gerar(forcar=options['forcar'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{resultado['urls']} produtos em {resultado['shards']} shards "
+            f"({resultado['regravados']} regravados, {resultado['removidos']} removidos)"
+        ))
@@ -0,0 +1,62 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.importacao import IMPORTACAO_CONFIG, ImportadorCatalogo, ler_arquivo
+
+
+class Command(BaseCommand):
+    help = "Importa produtos e variações de um arquivo CSV ou JSONL em lotes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo', help="Caminho do arquivo .csv ou .jsonl")
+        parser.add_argument(
+            '--formato',
+            choices=['csv', 'jsonl'],
+            help="Formato do arquivo (padrão: pela extensão)"
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=IMPORTACAO_CONFIG['TAMANHO_LOTE'],
+            help="Quantidade de linhas gravadas por lote"
+        )
+        parser.add_argument(
+            '--erros',
+            help="Grava as linhas com erro (linha, mensagem) neste arquivo CSV"
+        )
+        parser.add_argument(
+            '--sem-criar',
+            action='store_true',
+            help="Não cria marcas, tags e valores de atributo ausentes; a linha vira erro"
+        )
+
+    def handle(self, *args, **options):
+        saida_erros = open(options['erros'], 'w', encoding='utf-8', newline='') if options['erros'] else None
+        escritor = csv.writer(saida_erros) if saida_erros else None
+        if escritor:
+            escritor.writerow(['linha', 'erro'])
+
+        def ao_errar(numero, mensagem):
+            if escritor:
+                escritor.writerow([numero, mensagem])
+            else:
+                self.stderr.write(f"Linha {numero}: {mensagem}")
+
+        importador = ImportadorCatalogo(
+            tamanho_lote=options['lote'],
+            ao_errar=ao_errar,
+            criar_faltantes=not options['sem_criar'],
+        )
+        try:
+            totais = importador.importar(ler_arquivo(options['arquivo'], options['formato']))
+        except OSError as e:
+            raise CommandError(f"Não foi possível ler {options['arquivo']}: {e}")
+        finally:
+            if saida_erros:
+                saida_erros.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{totais['linhas']} linhas lidas: {totais['produtos']} produtos e "
+            f"{totais['variacoes']} variações gravados, {totais['erros']} erros"
+        ))
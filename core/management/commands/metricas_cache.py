@@ -0,0 +1,37 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.metricas_cache import obter_metricas, zerar_metricas
+
+
+class Command(BaseCommand):
+    help = "Mostra acertos, faltas, gravações, tamanho e latência do cache por prefixo de chave"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help="Saída em JSON")
+        parser.add_argument('--zerar', action='store_true', help="Zera os contadores depois de mostrar")
+
+    def handle(self, *args, **options):
+        metricas = obter_metricas()
+        if options['json']:
+            self.stdout.write(json.dumps(metricas, indent=2))
+        elif not metricas:
+            self.stdout.write("Nenhuma métrica registrada")
+        else:
+            self.stdout.write(
+                f"{'prefixo':<32} {'operações':>10} {'acertos':>9} {'faltas':>9} {'taxa':>6} "
+                f"{'gravações':>10} {'remoções':>9} {'bytes/valor':>12} {'ms/op':>8}"
+            )
+            for prefixo, linha in metricas.items():
+                taxa = f"{linha['taxa_acerto']:.0%}" if linha['taxa_acerto'] is not None else '-'
+                self.stdout.write(
+                    f"{prefixo[:32]:<32} {linha['operacoes']:>10} {linha['acertos']:>9} {linha['faltas']:>9} "
+                    f"{taxa:>6} {linha['gravacoes']:>10} {linha['remocoes']:>9} "
+                    f"{linha['tamanho_medio_bytes'] if linha['tamanho_medio_bytes'] is not None else '-':>12} "
+                    f"{linha['latencia_media_ms'] if linha['latencia_media_ms'] is not None else '-':>8}"
+                )
+
+        if options['zerar']:
+            zerar_metricas()
+            self.stdout.write(self.style.SUCCESS("Métricas do cache zeradas"))
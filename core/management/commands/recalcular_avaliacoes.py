@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.avaliacoes import recalcular_avaliacoes
+from core.cards import atualizar_cards
+from core.models import Produto
+
+
+class Command(BaseCommand):
+    help = "Recalcula os agregados de avaliação (total, soma e notas) de todos os produtos"
+
+    def handle(self, *args, **options):
+        total = recalcular_avaliacoes()
+        atualizar_cards(Produto.objects.values_list('id', flat=True))
+        self.stdout.write(self.style.SUCCESS(f"Avaliações recalculadas para {total} produtos"))
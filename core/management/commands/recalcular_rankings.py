@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.rankings import reconstruir
+
+
+class Command(BaseCommand):
+    help = "Recalcula os rankings de mais vendidos e em alta a partir dos pedidos pagos"
+
+    def handle(self, *args, **options):
+        resultado = reconstruir()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rankings recalculados: {resultado['produtos']} produtos, {resultado['unidades']} unidades vendidas"
+        ))
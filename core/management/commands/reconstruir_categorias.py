@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.categorias import reconstruir_arvore
+from core.models import CategoriaFechamento
+
+
+class Command(BaseCommand):
+    help = "Reconstrói a tabela de fechamento das categorias e os totais de produtos por subárvore"
+
+    def handle(self, *args, **options):
+        reconstruir_arvore()
+        total = CategoriaFechamento.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Árvore de categorias reconstruída: {total} caminhos"))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from core.busca import BUSCA_CONFIG, atualizar_documentos
+from core.models import Produto
+
+
+class Command(BaseCommand):
+    help = "Reconstrói o índice de busca textual dos produtos em lotes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=BUSCA_CONFIG['TAMANHO_LOTE'],
+            help="Quantidade de produtos processados por lote"
+        )
+
+    def handle(self, *args, **options):
+        lote = max(1, options['lote'])
+        ultimo_id = 0
+        total = 0
+
+        # Paginação por id mantém o custo de cada lote constante
+        while True:
+            ids = list(
+                Produto.objects.filter(id__gt=ultimo_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:lote]
+            )
+            if not ids:
+                break
+            total += atualizar_documentos(ids)
+            ultimo_id = ids[-1]
+            self.stdout.write(f"{total} produtos indexados...")
+
+        self.stdout.write(self.style.SUCCESS(f"Índice de busca atualizado: {total} produtos"))
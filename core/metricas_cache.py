@@ -0,0 +1,283 @@
+"""
+Métricas do cache por prefixo de chave.
+
+CacheInstrumentado é o backend 'default' (ver CACHES em settings) e
+embrulha o backend real, informado em OPTIONS. Para cada operação conta,
+por prefixo da chave, acertos, faltas, gravações, remoções, bytes
+gravados (tamanho do valor serializado) e o tempo gasto no backend. Os bytes
+são estimados: só 1 a cada AMOSTRA_TAMANHO gravações é serializada, e o
+tamanho medido conta por todas elas.
+
+O prefixo é o trecho antes do primeiro '_' ('produto', 'carrinho',
+'catalogo', ...), com dois trechos para locks e gerações ('lock_produto',
+'geracao_carrinho'), ou o nome da função nas chaves de cache_dois_niveis
+(antes do ':').
+
+Os contadores ficam na memória do processo e a cada INTERVALO_ENVIO
+segundos são somados no próprio cache, direto no backend real (sem passar
+pela instrumentação): um get_many e um set_many sob um lock curto, em vez
+de uma ida ao cache por contador. Se outro worker estiver enviando, os
+contadores esperam o próximo envio. Assim o comando metricas_cache e o
+endpoint /api/cache/metricas/ enxergam todos os workers.
+"""
+import itertools
+import logging
+import pickle
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Optional
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+METRICAS_CACHE_CONFIG = {
+    'PREFIXO_CHAVE': 'metricas_cache_',
+    'INTERVALO_ENVIO': 10,  # segundos entre envios dos contadores do processo
+    'AMOSTRA_TAMANHO': 10,  # serializa 1 a cada N gravações para estimar os bytes
+    'TIMEOUT_LOCK_ENVIO': 5,  # segundos
+    'PREFIXOS_COMPOSTOS': ('lock', 'geracao'),
+    'CAMPOS': ('operacoes', 'acertos', 'faltas', 'gravacoes', 'remocoes', 'bytes_gravados', 'latencia_us'),
+}
+
+_AUSENTE = object()
+
+
+def prefixo_da_chave(chave: str) -> str:
+    """Prefixo em que a operação é contada, ex.: 'produto_1712_12_preco' -> 'produto'"""
+    if ':' in chave:
+        return chave.split(':', 1)[0]
+    partes = chave.split('_', 2)
+    if partes[0] in METRICAS_CACHE_CONFIG['PREFIXOS_COMPOSTOS'] and len(partes) > 1:
+        return f"{partes[0]}_{partes[1]}"
+    return partes[0]
+
+
+def _tamanho(valor) -> int:
+    try:
+        return len(pickle.dumps(valor, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def _chave_metrica(prefixo: str, campo: str) -> str:
+    return f"{METRICAS_CACHE_CONFIG['PREFIXO_CHAVE']}{prefixo}_{campo}"
+
+
+def _chave_prefixos() -> str:
+    return f"{METRICAS_CACHE_CONFIG['PREFIXO_CHAVE']}prefixos"
+
+
+def _chave_lock_envio() -> str:
+    return f"{METRICAS_CACHE_CONFIG['PREFIXO_CHAVE']}lock_envio"
+
+
+class CacheInstrumentado(BaseCache):
+    """
+    Backend que repassa tudo ao backend real e conta as operações.
+    OPTIONS: BACKEND e LOCATION do backend real e, em OPTIONS, as opções dele.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        opcoes = params.get('OPTIONS', {})
+        parametros = {
+            chave: valor for chave, valor in params.items() if chave not in ('BACKEND', 'LOCATION', 'OPTIONS')
+        }
+        parametros['OPTIONS'] = opcoes.get('OPTIONS', {})
+        backend = opcoes.get('BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+        self.interno = import_string(backend)(opcoes.get('LOCATION', location), parametros)
+        self._pendentes = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._ultimo_envio = time.monotonic()
+        self._gravacoes = itertools.count()
+
+    # Contadores
+
+    def _tamanhos(self, valores: dict) -> Dict[str, int]:
+        """Tamanho estimado das gravações amostradas, já multiplicado pela amostra"""
+        amostra = METRICAS_CACHE_CONFIG['AMOSTRA_TAMANHO']
+        return {
+            chave: _tamanho(valor) * amostra
+            for chave, valor in valores.items() if next(self._gravacoes) % amostra == 0
+        }
+
+    def _registrar(self, inicio: float, chaves: Iterable[str], campo: Optional[str] = None,
+                   acertos: Optional[set] = None, valores: Optional[dict] = None) -> None:
+        """Uma operação por chave, com a latência dividida entre elas"""
+        chaves = list(chaves)
+        latencia = int((time.perf_counter() - inicio) * 1_000_000 / max(len(chaves), 1))
+        tamanhos = self._tamanhos(valores) if valores else {}
+        with self._lock:
+            for chave in chaves:
+                contadores = self._pendentes[prefixo_da_chave(chave)]
+                contadores['operacoes'] += 1
+                contadores['latencia_us'] += latencia
+                if campo:
+                    contadores[campo] += 1
+                if acertos is not None:
+                    contadores['acertos' if chave in acertos else 'faltas'] += 1
+                if chave in tamanhos:
+                    contadores['bytes_gravados'] += tamanhos[chave]
+        if time.monotonic() - self._ultimo_envio >= METRICAS_CACHE_CONFIG['INTERVALO_ENVIO']:
+            self.enviar_metricas()
+
+    def enviar_metricas(self) -> None:
+        """Soma os contadores deste processo nos do cache compartilhado"""
+        with self._lock:
+            pendentes, self._pendentes = self._pendentes, defaultdict(Counter)
+            self._ultimo_envio = time.monotonic()
+        if not pendentes:
+            return
+        try:
+            if not self.interno.add(_chave_lock_envio(), 1, METRICAS_CACHE_CONFIG['TIMEOUT_LOCK_ENVIO']):
+                self._devolver(pendentes)
+                return
+            try:
+                chaves = {
+                    _chave_metrica(prefixo, campo): quantidade
+                    for prefixo, contadores in pendentes.items() for campo, quantidade in contadores.items()
+                }
+                atuais = self.interno.get_many(list(chaves) + [_chave_prefixos()])
+                novos = {chave: atuais.get(chave, 0) + quantidade for chave, quantidade in chaves.items()}
+                conhecidos = atuais.get(_chave_prefixos()) or set()
+                if not set(pendentes) <= conhecidos:
+                    novos[_chave_prefixos()] = conhecidos | set(pendentes)
+                self.interno.set_many(novos, None)
+            finally:
+                self.interno.delete(_chave_lock_envio())
+        except Exception as e:
+            logger.error(f"Erro ao enviar métricas do cache: {str(e)}")
+
+    def _devolver(self, pendentes: dict) -> None:
+        """Devolve contadores não enviados para o próximo envio"""
+        with self._lock:
+            for prefixo, contadores in pendentes.items():
+                self._pendentes[prefixo].update(contadores)
+
+    def descartar_pendentes(self) -> None:
+        with self._lock:
+            self._pendentes = defaultdict(Counter)
+            self._gravacoes = itertools.count()
+
+    # Operações repassadas
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        inicio = time.perf_counter()
+        adicionado = self.interno.add(key, value, timeout, version)
+        if adicionado:
+            self._registrar(inicio, [key], 'gravacoes', valores={key: value})
+        else:
+            self._registrar(inicio, [key])
+        return adicionado
+
+    def get(self, key, default=None, version=None):
+        inicio = time.perf_counter()
+        valor = self.interno.get(key, _AUSENTE, version)
+        self._registrar(inicio, [key], acertos=set() if valor is _AUSENTE else {key})
+        return default if valor is _AUSENTE else valor
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        inicio = time.perf_counter()
+        self.interno.set(key, value, timeout, version)
+        self._registrar(inicio, [key], 'gravacoes', valores={key: value})
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        inicio = time.perf_counter()
+        resultado = self.interno.touch(key, timeout, version)
+        self._registrar(inicio, [key])
+        return resultado
+
+    def delete(self, key, version=None):
+        inicio = time.perf_counter()
+        resultado = self.interno.delete(key, version)
+        self._registrar(inicio, [key], 'remocoes')
+        return resultado
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        inicio = time.perf_counter()
+        valores = self.interno.get_many(keys, version)
+        self._registrar(inicio, keys, acertos=set(valores))
+        return valores
+
+    def has_key(self, key, version=None):
+        inicio = time.perf_counter()
+        resultado = self.interno.has_key(key, version)
+        self._registrar(inicio, [key], acertos={key} if resultado else set())
+        return resultado
+
+    def incr(self, key, delta=1, version=None):
+        inicio = time.perf_counter()
+        try:
+            return self.interno.incr(key, delta, version)
+        finally:
+            self._registrar(inicio, [key], 'gravacoes')
+
+    def decr(self, key, delta=1, version=None):
+        inicio = time.perf_counter()
+        try:
+            return self.interno.decr(key, delta, version)
+        finally:
+            self._registrar(inicio, [key], 'gravacoes')
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        inicio = time.perf_counter()
+        falhas = self.interno.set_many(data, timeout, version)
+        self._registrar(inicio, data, 'gravacoes', valores=data)
+        return falhas
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        inicio = time.perf_counter()
+        self.interno.delete_many(keys, version)
+        self._registrar(inicio, keys, 'remocoes')
+
+    def clear(self):
+        self.interno.clear()
+
+    def close(self, **kwargs):
+        self.interno.close(**kwargs)
+
+
+def _backend(alias: str = 'default') -> Optional[CacheInstrumentado]:
+    backend = caches[alias]
+    return backend if isinstance(backend, CacheInstrumentado) else None
+
+
+def obter_metricas(alias: str = 'default') -> Dict[str, dict]:
+    """Métricas somadas de todos os workers, por prefixo, das mais usadas para as menos"""
+    backend = _backend(alias)
+    if backend is None:
+        return {}
+    backend.enviar_metricas()
+
+    prefixos = sorted(backend.interno.get(_chave_prefixos()) or set())
+    campos = METRICAS_CACHE_CONFIG['CAMPOS']
+    valores = backend.interno.get_many([_chave_metrica(prefixo, campo) for prefixo in prefixos for campo in campos])
+
+    metricas = {}
+    for prefixo in prefixos:
+        linha = {campo: valores.get(_chave_metrica(prefixo, campo), 0) for campo in campos}
+        leituras = linha['acertos'] + linha['faltas']
+        linha['taxa_acerto'] = round(linha['acertos'] / leituras, 4) if leituras else None
+        linha['tamanho_medio_bytes'] = round(linha['bytes_gravados'] / linha['gravacoes']) if linha['gravacoes'] else None
+        linha['latencia_media_ms'] = round(linha['latencia_us'] / linha['operacoes'] / 1000, 3) if linha['operacoes'] else None
+        metricas[prefixo] = linha
+    return dict(sorted(metricas.items(), key=lambda item: -item[1]['operacoes']))
+
+
+def zerar_metricas(alias: str = 'default') -> None:
+    """Apaga os contadores compartilhados e os pendentes deste processo"""
+    backend = _backend(alias)
+    if backend is None:
+        return
+    backend.descartar_pendentes()
+    prefixos = backend.interno.get(_chave_prefixos()) or set()
+    backend.interno.delete_many(
+        [_chave_metrica(prefixo, campo) for prefixo in prefixos for campo in METRICAS_CACHE_CONFIG['CAMPOS']]
+        + [_chave_prefixos()]
+    )
@@ -0,0 +1,196 @@
+"""
+Contagem de referências dos arquivos de imagem.
+
+Com o storage endereçado por conteúdo (core.storage), vários Produto e
+ImagemProduto podem apontar para o mesmo arquivo. ArquivoMidia guarda
+quantas referências cada arquivo tem; os signals ajustam a contagem quando
+uma imagem é atribuída, trocada ou removida, e o arquivo (com suas
+derivadas) só é apagado depois do commit que zerar a contagem.
+
+O upload conta a sua referência já em ArmazenamentoPorConteudo.save, com a
+linha do arquivo travada, antes de decidir entre gravar e reaproveitar o
+arquivo existente; o post_save do modelo consome essa reserva em vez de
+contar de novo. Assim um apagar_se_orfao concorrente, que também trava a
+linha, nunca apaga um arquivo que um upload acabou de reaproveitar.
+
+Upload, save do modelo e post_save rodam numa só transação
+(transacao_de_upload, usada por Produto.save e ImagemProduto.save): se o
+save falhar, a contagem é desfeita no rollback, a reserva é descartada e o
+arquivo recém-gravado é apagado se ficou sem referências.
+"""
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from django.core.files import File
+from django.db import transaction
+from django.db.transaction import TransactionManagementError
+from django.db.models import Count, F
+
+from core import imagens
+from core.models import ArquivoMidia, ImagemProduto, Produto
+from core.storage import armazenamento_por_conteudo
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+MIDIA_CONFIG = {
+    # Arquivos compartilhados que nunca são apagados
+    'PRESERVADOS': {Produto._meta.get_field('imagem').default},
+}
+
+
+# Referências já contadas no upload e ainda não consumidas pelo post_save, por thread
+_reservas = threading.local()
+
+
+def _contavel(nome: Optional[str]) -> bool:
+    return bool(nome) and nome not in MIDIA_CONFIG['PRESERVADOS']
+
+
+def _reservas_da_thread() -> Counter:
+    if not hasattr(_reservas, 'nomes'):
+        _reservas.nomes = Counter()
+    return _reservas.nomes
+
+
+def _consumir_reserva(nome: Optional[str]) -> bool:
+    reservas = _reservas_da_thread()
+    if reservas[nome] <= 0:
+        return False
+    reservas[nome] -= 1
+    return True
+
+
+def gravar_com_referencia(nome: str, gravar: Callable[[], str]) -> str:
+    """
+    Conta a referência do upload com a linha do arquivo travada e só então
+    grava o conteúdo (ou reaproveita o existente) por gravar(). Chamado por
+    ArmazenamentoPorConteudo.save, dentro de transacao_de_upload.
+    """
+    if not _contavel(nome):
+        return gravar()
+    if not transaction.get_connection().in_atomic_block:
+        # Em autocommit a contagem ficaria gravada mesmo que o save do modelo falhe
+        raise TransactionManagementError("Upload de imagem fora de transação; use transacao_de_upload().")
+    with transaction.atomic():
+        arquivo, _ = ArquivoMidia.objects.select_for_update().get_or_create(nome=nome)
+        ArquivoMidia.objects.filter(pk=arquivo.pk).update(referencias=F('referencias') + 1)
+        nome = gravar()
+    _reservas_da_thread()[nome] += 1
+    return nome
+
+
+@contextmanager
+def transacao_de_upload():
+    """
+    Transação em volta do save de um modelo com imagem. Se ele falhar, as
+    reservas feitas dentro dela são descartadas e os arquivos que ficaram
+    sem referência são apagados após o rollback.
+    """
+    antes = Counter(_reservas_da_thread())
+    try:
+        with transaction.atomic():
+            yield
+    except Exception:
+        novos = _reservas_da_thread() - antes
+        _reservas.nomes = antes
+        for nome in novos:
+            apos_commit(apagar_se_orfao, nome, erro=f"Erro ao apagar upload desfeito {nome}")
+        raise
+
+
+def descartar_reserva(nome: Optional[str]) -> None:
+    """Desfaz a contagem do upload que não mudou a imagem (mesmo arquivo enviado de novo)"""
+    if _consumir_reserva(nome):
+        remover_referencia(nome)
+
+
+def adicionar_referencia(nome: Optional[str]) -> None:
+    if not _contavel(nome) or _consumir_reserva(nome):
+        return
+    with transaction.atomic():
+        arquivo, _ = ArquivoMidia.objects.select_for_update().get_or_create(nome=nome)
+        ArquivoMidia.objects.filter(pk=arquivo.pk).update(referencias=F('referencias') + 1)
+
+
+def remover_referencia(nome: Optional[str]) -> None:
+    """Decrementa a contagem e agenda a remoção do arquivo se ela chegar a zero"""
+    if not _contavel(nome):
+        return
+    with transaction.atomic():
+        arquivo = ArquivoMidia.objects.select_for_update().filter(nome=nome).first()
+        if arquivo is None:
+            return
+        arquivo.referencias = max(arquivo.referencias - 1, 0)
+        arquivo.save(update_fields=['referencias', 'updated_at'])
+    if arquivo.referencias == 0:
+        transaction.on_commit(lambda: apagar_se_orfao(nome))
+
+
+def apagar_se_orfao(nome: str) -> bool:
+    """Apaga arquivo e derivadas se nenhuma referência surgiu até agora"""
+    try:
+        with transaction.atomic():
+            # Sempre há linha para travar: um upload do mesmo conteúdo espera o fim da remoção
+            arquivo, _ = ArquivoMidia.objects.select_for_update().get_or_create(nome=nome)
+            if arquivo.referencias > 0:
+                return False
+            arquivo.delete()
+            if armazenamento_por_conteudo.exists(nome):
+                armazenamento_por_conteudo.delete(nome)
+            imagens.remover_derivadas(nome)
+        return True
+    except Exception as e:
+        logger.error(f"Erro ao remover arquivo de mídia {nome}: {str(e)}")
+        return False
+
+
+def recalcular_referencias() -> int:
+    """Reconstrói a tabela de referências a partir das imagens gravadas"""
+    contagens = {}
+    for modelo in (Produto, ImagemProduto):
+        for linha in modelo.objects.exclude(imagem='').values('imagem').annotate(total=Count('id')):
+            if _contavel(linha['imagem']):
+                contagens[linha['imagem']] = contagens.get(linha['imagem'], 0) + linha['total']
+
+    with transaction.atomic():
+        ArquivoMidia.objects.exclude(nome__in=list(contagens)).update(referencias=0)
+        ArquivoMidia.objects.bulk_create(
+            [ArquivoMidia(nome=nome, referencias=total) for nome, total in contagens.items()],
+            update_conflicts=True,
+            unique_fields=['nome'],
+            update_fields=['referencias'],
+        )
+    return len(contagens)
+
+
+def mover_para_conteudo(nome: str) -> Optional[str]:
+    """
+    Renomeia um arquivo antigo (nomeado por caminho) para o nome por conteúdo
+    e aponta as imagens para ele. Se o conteúdo já existir, o duplicado é
+    apagado. Retorna o novo nome, ou None se o arquivo não existir.
+    """
+    if not _contavel(nome) or not armazenamento_por_conteudo.exists(nome):
+        return None
+    with armazenamento_por_conteudo.open(nome, 'rb') as arquivo:
+        novo = armazenamento_por_conteudo.nome_por_conteudo(nome, File(arquivo))
+    if novo == nome:
+        return nome
+
+    if armazenamento_por_conteudo.exists(novo):
+        armazenamento_por_conteudo.delete(nome)
+    else:
+        destino = armazenamento_por_conteudo.path(novo)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(armazenamento_por_conteudo.path(nome), destino)
+    imagens.remover_derivadas(nome)
+
+    with transaction.atomic():
+        Produto.objects.filter(imagem=nome).update(imagem=novo)
+        ImagemProduto.objects.filter(imagem=nome).update(imagem=novo)
+        ArquivoMidia.objects.filter(nome=nome).delete()
+    return novo
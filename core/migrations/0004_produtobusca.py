@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-16 23:56
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_auditoriapreco_protecaocarrinho_reservaestoque_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProdutoBusca',
+            fields=[
+                ('produto', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='busca', serialize=False, to='core.produto')),
+                ('nome', models.TextField(blank=True)),
+                ('classificacao', models.TextField(blank=True)),
+                ('complementos', models.TextField(blank=True)),
+                ('descricao', models.TextField(blank=True)),
+                ('vetor', django.contrib.postgres.search.SearchVectorField(null=True)),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Documento de Busca',
+                'verbose_name_plural': 'Documentos de Busca',
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['vetor'], name='produto_busca_vetor_gin')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-17 00:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_produtobusca'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProdutoCard',
+            fields=[
+                ('produto', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to='core.produto')),
+                ('nome', models.CharField(max_length=255)),
+                ('slug', models.SlugField(max_length=255)),
+                ('preco', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('preco_original', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('preco_promocional', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('promocao_inicio', models.DateTimeField(blank=True, null=True)),
+                ('promocao_fim', models.DateTimeField(blank=True, null=True)),
+                ('media_avaliacoes', models.DecimalField(decimal_places=2, default=0, max_digits=3)),
+                ('total_avaliacoes', models.PositiveIntegerField(default=0)),
+                ('imagem', models.CharField(blank=True, max_length=255)),
+                ('cores', models.JSONField(blank=True, default=list)),
+                ('tamanhos', models.JSONField(blank=True, default=list)),
+                ('variacao_padrao_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('em_estoque', models.BooleanField(default=False)),
+                ('ativo', models.BooleanField(default=True)),
+                ('destaque', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField()),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+                ('categoria', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.categoria')),
+                ('marca', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.marca')),
+            ],
+            options={
+                'verbose_name': 'Card de Produto',
+                'verbose_name_plural': 'Cards de Produtos',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['ativo', '-created_at'], name='core_produt_ativo_6852b1_idx'), models.Index(fields=['ativo', 'categoria', '-created_at'], name='core_produt_ativo_c6fe61_idx'), models.Index(fields=['ativo', 'destaque', '-created_at'], name='core_produt_ativo_a7667c_idx'), models.Index(fields=['ativo', 'preco'], name='core_produt_ativo_ca01e6_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2 on 2026-10-17 00:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+def construir_fechamento(apps, schema_editor):
+    """Monta a tabela de fechamento e os totais por subárvore das categorias existentes"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO core_categoriafechamento (ancestral_id, descendente_id, profundidade)
+            WITH RECURSIVE arvore (ancestral_id, descendente_id, profundidade) AS (
+                SELECT id, id, 0 FROM core_categoria
+                UNION ALL
+                SELECT arvore.ancestral_id, filha.id, arvore.profundidade + 1
+                FROM arvore
+                JOIN core_categoria filha ON filha.categoria_pai_id = arvore.descendente_id
+                WHERE arvore.profundidade < 32
+            )
+            SELECT ancestral_id, descendente_id, profundidade FROM arvore
+        """)
+        cursor.execute("""
+            UPDATE core_categoria AS c SET total_produtos = (
+                SELECT count(*)
+                FROM core_produto p
+                JOIN core_categoriafechamento f ON f.descendente_id = p.categoria_id
+                WHERE f.ancestral_id = c.id AND p.ativo
+            )
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_produtocard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categoria',
+            name='total_produtos',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Produtos ativos nesta categoria e em todas as subcategorias'),
+        ),
+        migrations.CreateModel(
+            name='CategoriaFechamento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profundidade', models.PositiveSmallIntegerField()),
+                ('ancestral', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fechamento_descendentes', to='core.categoria')),
+                ('descendente', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fechamento_ancestrais', to='core.categoria')),
+            ],
+            options={
+                'verbose_name': 'Fechamento de Categoria',
+                'verbose_name_plural': 'Fechamentos de Categorias',
+                'indexes': [models.Index(fields=['descendente', 'profundidade'], name='core_catego_descend_b12c37_idx')],
+                'constraints': [models.UniqueConstraint(fields=('ancestral', 'descendente'), name='unique_categoria_fechamento')],
+            },
+        ),
+        migrations.RunPython(
+            construir_fechamento,
+            migrations.RunPython.noop,
+        ),
+    ]
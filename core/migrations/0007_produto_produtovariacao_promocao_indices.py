@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-17 00:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_categoria_total_produtos_categoriafechamento'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='produto',
+            index=models.Index(fields=['promocao_inicio'], name='core_produt_promoca_573f05_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='produto',
+            index=models.Index(fields=['promocao_fim'], name='core_produt_promoca_153ef7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='produtovariacao',
+            index=models.Index(fields=['promocao_inicio'], name='core_produt_promoca_2e30d9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='produtovariacao',
+            index=models.Index(fields=['promocao_fim'], name='core_produt_promoca_2ae7f2_idx'),
+        ),
+    ]
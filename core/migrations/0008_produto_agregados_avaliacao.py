@@ -0,0 +1,81 @@
+# Generated by Django 5.2 on 2026-10-17 00:14
+
+from django.db import migrations, models
+
+def preencher_agregados(apps, schema_editor):
+    """Calcula os agregados a partir das avaliações aprovadas existentes"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE core_produto AS p SET
+                total_avaliacoes = a.total,
+                soma_notas = a.soma,
+                avaliacoes_nota_1 = a.nota_1,
+                avaliacoes_nota_2 = a.nota_2,
+                avaliacoes_nota_3 = a.nota_3,
+                avaliacoes_nota_4 = a.nota_4,
+                avaliacoes_nota_5 = a.nota_5
+            FROM (
+                SELECT
+                    produto_id,
+                    count(*) AS total,
+                    sum(nota) AS soma,
+                    count(*) FILTER (WHERE nota = 1) AS nota_1,
+                    count(*) FILTER (WHERE nota = 2) AS nota_2,
+                    count(*) FILTER (WHERE nota = 3) AS nota_3,
+                    count(*) FILTER (WHERE nota = 4) AS nota_4,
+                    count(*) FILTER (WHERE nota = 5) AS nota_5
+                FROM core_avaliacaoproduto
+                WHERE aprovada
+                GROUP BY produto_id
+            ) AS a
+            WHERE a.produto_id = p.id
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_produto_produtovariacao_promocao_indices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='produto',
+            name='avaliacoes_nota_1',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='avaliacoes_nota_2',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='avaliacoes_nota_3',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='avaliacoes_nota_4',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='avaliacoes_nota_5',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='soma_notas',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='produto',
+            name='total_avaliacoes',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            preencher_agregados,
+            migrations.RunPython.noop,
+        ),
+    ]
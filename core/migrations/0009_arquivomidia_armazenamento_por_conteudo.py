@@ -0,0 +1,58 @@
+# Generated by Django 5.2 on 2026-10-17 00:20
+
+import core.storage
+from django.db import migrations, models
+
+def contar_referencias(apps, schema_editor):
+    """Preenche a contagem de referências das imagens já gravadas"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO core_arquivomidia (nome, referencias, created_at, updated_at)
+            SELECT imagem, count(*), now(), now()
+            FROM (
+                SELECT imagem FROM core_produto
+                UNION ALL
+                SELECT imagem FROM core_imagemproduto
+            ) AS imagens
+            WHERE imagem <> '' AND imagem <> 'produtos/default.jpg'
+            GROUP BY imagem
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_produto_agregados_avaliacao'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imagemproduto',
+            name='imagem',
+            field=models.ImageField(storage=core.storage.obter_armazenamento, upload_to='produtos/galeria/'),
+        ),
+        migrations.AlterField(
+            model_name='produto',
+            name='imagem',
+            field=models.ImageField(default='produtos/default.jpg', storage=core.storage.obter_armazenamento, upload_to='produtos/'),
+        ),
+        migrations.CreateModel(
+            name='ArquivoMidia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome', models.CharField(max_length=255, unique=True)),
+                ('referencias', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Arquivo de Mídia',
+                'verbose_name_plural': 'Arquivos de Mídia',
+                'indexes': [models.Index(fields=['referencias'], name='core_arquiv_referen_58b1c1_idx')],
+            },
+        ),
+        migrations.RunPython(
+            contar_referencias,
+            migrations.RunPython.noop,
+        ),
+    ]
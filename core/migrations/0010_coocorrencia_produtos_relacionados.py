@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-17 00:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_arquivomidia_armazenamento_por_conteudo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoocorrenciaProduto',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pedidos', models.PositiveIntegerField(default=0)),
+                ('produto_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.produto')),
+                ('produto_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.produto')),
+            ],
+            options={
+                'verbose_name': 'Coocorrência de Produtos',
+                'verbose_name_plural': 'Coocorrências de Produtos',
+                'indexes': [models.Index(fields=['produto_b', 'produto_a'], name='core_coocor_produto_cadb5b_idx')],
+                'constraints': [models.UniqueConstraint(fields=('produto_a', 'produto_b'), name='unique_coocorrencia_produtos')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProdutoRelacionado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('comprados_juntos', 'Comprados juntos')], max_length=20)),
+                ('posicao', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('produto', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relacionados', to='core.produto')),
+                ('relacionado', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relacionado_em', to='core.produto')),
+            ],
+            options={
+                'verbose_name': 'Produto Relacionado',
+                'verbose_name_plural': 'Produtos Relacionados',
+                'indexes': [models.Index(fields=['produto', 'tipo', 'posicao'], name='core_produt_produto_9ab66f_idx')],
+                'constraints': [models.UniqueConstraint(fields=('produto', 'tipo', 'relacionado'), name='unique_produto_relacionado')],
+            },
+        ),
+    ]
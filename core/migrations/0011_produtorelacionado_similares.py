@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-17 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_coocorrencia_produtos_relacionados'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='produtorelacionado',
+            name='tipo',
+            field=models.CharField(choices=[('comprados_juntos', 'Comprados juntos'), ('similares', 'Similares')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-17 00:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_produtorelacionado_similares'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='produtocard',
+            name='tendencia',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='produtocard',
+            name='unidades_vendidas',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='produtocard',
+            index=models.Index(fields=['ativo', '-unidades_vendidas', '-produto'], name='core_produt_ativo_dffa71_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='produtocard',
+            index=models.Index(fields=['ativo', '-tendencia', '-produto'], name='core_produt_ativo_c31849_idx'),
+        ),
+    ]
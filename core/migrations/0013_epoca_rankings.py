@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-17 01:23
+
+import datetime
+
+from django.db import migrations, models
+
+def criar_epoca(apps, schema_editor):
+    """Linha única travada por core.rankings; a época é a EPOCA_INICIAL dos scores já gravados"""
+    EpocaRankings = apps.get_model('core', 'EpocaRankings')
+    EpocaRankings.objects.get_or_create(
+        pk=1, defaults={'epoca': datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)}
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_rankings_produto_card'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EpocaRankings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoca', models.DateTimeField()),
+                ('atualizado_em', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Época dos Rankings',
+                'verbose_name_plural': 'Época dos Rankings',
+            },
+        ),
+        migrations.RunPython(
+            criar_epoca,
+            migrations.RunPython.noop,
+        ),
+    ]
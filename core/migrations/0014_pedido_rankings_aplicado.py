@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-17 01:41
+
+from django.db import migrations, models
+
+def marcar_pedidos_pagos(apps, schema_editor):
+    """Os pedidos pagos já estão nos rankings gravados até aqui"""
+    Pedido = apps.get_model('core', 'Pedido')
+    Pedido.objects.filter(status__in=("PA", "E", "T", "C")).update(rankings_aplicado=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_epoca_rankings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pedido',
+            name='rankings_aplicado',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(
+            marcar_pedidos_pagos,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-17 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_pedido_rankings_aplicado'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarPendente',
+            fields=[
+                ('produto_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('marcado_em', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Similar Pendente',
+                'verbose_name_plural': 'Similares Pendentes',
+            },
+        ),
+    ]
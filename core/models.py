@@ -6,29 +6,39 @@ from django.core.validators import (
     MaxValueValidator,
 )
 from django.conf import settings
-from django.db.models import Avg
+from django.db.models import Case, DecimalField, F, IntegerField, Q, Value, When
+from django.db.models.functions import Cast, Coalesce, Round
+from django.db.models.lookups import GreaterThan
+from decimal import Decimal
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.utils.text import slugify
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import transaction
 import hashlib
-import os
 import logging
 from typing import Optional, List
-from functools import lru_cache
 from uuid import uuid4
 import json
 
+from core.cache import (
+    cache_dois_niveis, get_or_compute, invalidar_escopos, invalidar_namespace, montar_chave, tag
+)
+from core.storage import obter_armazenamento
+
 
 # Configuração de logging
 logger = logging.getLogger(__name__)
 
 # Constantes
 CACHE_TIMEOUT = 3600  # 1 hora
-MAX_CACHE_SIZE = 1000
+# Preços e descontos são invalidados nas fronteiras de promoção pelo agendador_promocoes
+PRECO_CACHE_TIMEOUT = 60 * 60 * 24  # 24 horas
 PRODUTO_CONFIG = {
     'MAX_PESO': 100.0,  # kg
     'MAX_DIMENSAO': 200,  # cm
@@ -36,6 +46,58 @@ PRODUTO_CONFIG = {
     'MIN_PRECO': 0.01,  # R$
 }
 
+
+def campos_exceto(instance, excluidos) -> List[str]:
+    """
+    update_fields de um save() completo sem os campos excluídos, usado para
+    não regravar contadores mantidos com F() a partir de uma instância antiga.
+    """
+    return [
+        campo.name for campo in instance._meta.concrete_fields
+        if not campo.primary_key and campo.name not in excluidos
+    ]
+
+
+def promocao_ativa(agora=None) -> Q:
+    """Condição SQL de promoção vigente (mesma regra de Produto.preco_vigente)"""
+    agora = agora or timezone.now()
+    return Q(
+        preco_promocional__gt=0,
+        promocao_inicio__lte=agora,
+        promocao_fim__gte=agora,
+    )
+
+
+class PrecoVigenteQuerySet(models.QuerySet):
+    """QuerySet de modelos com preço promocional (Produto e ProdutoCard)"""
+
+    def with_preco_vigente(self, agora=None):
+        """
+        Anota preco_efetivo e desconto_efetivo calculados no banco.
+
+        Permite filtrar e ordenar pelo preço que o cliente paga sem consultar
+        o cache objeto a objeto.
+        """
+        preco_efetivo = Case(
+            When(promocao_ativa(agora), then=F('preco_promocional')),
+            default=F('preco'),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+        preco_base = Coalesce(F('preco_original'), F('preco'))
+        return self.annotate(preco_efetivo=preco_efetivo).annotate(
+            desconto_efetivo=Case(
+                When(
+                    GreaterThan(preco_base, F('preco_efetivo')),
+                    then=Cast(
+                        Round(Value(Decimal(100)) - F('preco_efetivo') * Value(Decimal(100)) / preco_base),
+                        IntegerField()
+                    ),
+                ),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+
 class Categoria(models.Model):
     nome = models.CharField(max_length=255, db_index=True)
     slug = models.SlugField(max_length=255, unique=True, blank=True, db_index=True)
@@ -50,9 +112,17 @@ class Categoria(models.Model):
     )
     ativo = models.BooleanField(default=True, db_index=True)
     ordem = models.PositiveIntegerField(default=0, db_index=True)
+    total_produtos = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Produtos ativos nesta categoria e em todas as subcategorias"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Mantido por core.categorias com F(); save() comum não o regrava
+    CAMPOS_CONTADORES = ('total_produtos',)
+
     class Meta:
         ordering = ['ordem', 'nome']
         indexes = [
@@ -68,6 +138,11 @@ class Categoria(models.Model):
             raise ValidationError("O nome da categoria deve ter pelo menos 2 caracteres.")
         if self.categoria_pai and self.categoria_pai == self:
             raise ValidationError("A categoria não pode ser pai dela mesma.")
+        if self.pk and self.categoria_pai_id and CategoriaFechamento.objects.filter(
+            ancestral_id=self.pk,
+            descendente_id=self.categoria_pai_id
+        ).exists():
+            raise ValidationError("A categoria não pode ficar abaixo de uma de suas subcategorias.")
 
     def save(self, *args, **kwargs):
         self.full_clean()
@@ -79,32 +154,49 @@ class Categoria(models.Model):
                 slug = f"{base_slug}-{counter}"
                 counter += 1
             self.slug = slug
-        
-        # Invalida cache
-        cache.delete(f'categoria_{self.pk}')
-        cache.delete('categorias_ativas')
-        
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campos_exceto(self, self.CAMPOS_CONTADORES)
         super().save(*args, **kwargs)
 
     @classmethod
-    @lru_cache(maxsize=MAX_CACHE_SIZE)
+    @cache_dois_niveis([tag('categoria')], CACHE_TIMEOUT)
     def get_categorias_ativas(cls) -> List['Categoria']:
-        """Retorna categorias ativas com cache"""
-        cache_key = 'categorias_ativas'
-        categorias = cache.get(cache_key)
-        
-        if categorias is None:
-            categorias = list(cls.objects.filter(
-                ativo=True
-            ).select_related(
-                'categoria_pai'
-            ).prefetch_related(
-                'subcategorias'
-            ).order_by('ordem', 'nome'))
-            
-            cache.set(cache_key, categorias, CACHE_TIMEOUT)
-            
-        return categorias
+        """Retorna categorias ativas com cache em dois níveis (core.cache)"""
+        return list(cls.objects.filter(
+            ativo=True
+        ).select_related(
+            'categoria_pai'
+        ).prefetch_related(
+            'subcategorias'
+        ).order_by('ordem', 'nome'))
+
+class CategoriaFechamento(models.Model):
+    """Tabela de fechamento da árvore de categorias (mantida por core.categorias)"""
+    ancestral = models.ForeignKey(
+        Categoria,
+        on_delete=models.CASCADE,
+        related_name='fechamento_descendentes'
+    )
+    descendente = models.ForeignKey(
+        Categoria,
+        on_delete=models.CASCADE,
+        related_name='fechamento_ancestrais'
+    )
+    profundidade = models.PositiveSmallIntegerField()
+
+    class Meta:
+        verbose_name = "Fechamento de Categoria"
+        verbose_name_plural = "Fechamentos de Categorias"
+        constraints = [
+            models.UniqueConstraint(fields=['ancestral', 'descendente'], name='unique_categoria_fechamento')
+        ]
+        indexes = [
+            models.Index(fields=['descendente', 'profundidade']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestral_id} -> {self.descendente_id} ({self.profundidade})"
 
 class Marca(models.Model):
     nome = models.CharField(max_length=50, unique=True, db_index=True)
@@ -139,24 +231,13 @@ class Marca(models.Model):
                 counter += 1
             self.slug = slug
             
-        # Invalida cache
-        cache.delete(f'marca_{self.pk}')
-        cache.delete('marcas_ativas')
-        
         super().save(*args, **kwargs)
 
     @classmethod
-    @lru_cache(maxsize=MAX_CACHE_SIZE)
+    @cache_dois_niveis([tag('marca')], CACHE_TIMEOUT)
     def get_marcas_ativas(cls) -> List['Marca']:
-        """Retorna marcas ativas com cache"""
-        cache_key = 'marcas_ativas'
-        marcas = cache.get(cache_key)
-        
-        if marcas is None:
-            marcas = list(cls.objects.filter(ativo=True).order_by('nome'))
-            cache.set(cache_key, marcas, CACHE_TIMEOUT)
-            
-        return marcas
+        """Retorna marcas ativas com cache em dois níveis (core.cache)"""
+        return list(cls.objects.filter(ativo=True).order_by('nome'))
 
 class AtributoTipo(models.Model):
     nome = models.CharField(max_length=50, unique=True, db_index=True)
@@ -190,28 +271,28 @@ class AtributoTipo(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        # Invalida cache
-        cache.delete(f'atributo_tipo_{self.pk}')
-        cache.delete('atributos_tipos_ativos')
         super().save(*args, **kwargs)
 
     @classmethod
-    @lru_cache(maxsize=MAX_CACHE_SIZE)
+    def get_obrigatorios(cls) -> dict:
+        """Retorna {id: nome} dos tipos obrigatórios com cache"""
+        cache_key = montar_chave('atributo', 'tipos_obrigatorios')
+
+        def _calcular():
+            tipos = dict(cls.objects.filter(obrigatorio=True).values_list('id', 'nome'))
+            return tipos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
+
+    @classmethod
+    @cache_dois_niveis([tag('atributo')], CACHE_TIMEOUT)
     def get_atributos_tipos_ativos(cls) -> List['AtributoTipo']:
-        """Retorna tipos de atributos ativos com cache"""
-        cache_key = 'atributos_tipos_ativos'
-        tipos = cache.get(cache_key)
-        
-        if tipos is None:
-            tipos = list(cls.objects.filter(
-                ativo=True
-            ).prefetch_related(
-                'valores'
-            ).order_by('ordem', 'nome'))
-            
-            cache.set(cache_key, tipos, CACHE_TIMEOUT)
-            
-        return tipos
+        """Retorna tipos de atributos ativos com cache em dois níveis (core.cache)"""
+        return list(cls.objects.filter(
+            ativo=True
+        ).prefetch_related(
+            'valores'
+        ).order_by('ordem', 'nome'))
 
 class AtributoValor(models.Model):
     tipo = models.ForeignKey(
@@ -255,27 +336,16 @@ class AtributoValor(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        # Invalida cache
-        cache.delete(f'atributo_valor_{self.pk}')
-        cache.delete(f'atributo_tipo_{self.tipo_id}_valores')
         super().save(*args, **kwargs)
 
     @classmethod
-    @lru_cache(maxsize=MAX_CACHE_SIZE)
+    @cache_dois_niveis([tag('atributo')], CACHE_TIMEOUT)
     def get_valores_ativos_por_tipo(cls, tipo_id: int) -> List['AtributoValor']:
-        """Retorna valores ativos de um tipo com cache"""
-        cache_key = f'atributo_tipo_{tipo_id}_valores'
-        valores = cache.get(cache_key)
-        
-        if valores is None:
-            valores = list(cls.objects.filter(
-                tipo_id=tipo_id,
-                ativo=True
-            ).order_by('ordem', 'valor'))
-            
-            cache.set(cache_key, valores, CACHE_TIMEOUT)
-            
-        return valores
+        """Retorna valores ativos de um tipo com cache em dois níveis (core.cache)"""
+        return list(cls.objects.filter(
+            tipo_id=tipo_id,
+            ativo=True
+        ).order_by('ordem', 'valor'))
 
 class Produto(models.Model):
     visivel = models.BooleanField(default=True, db_index=True)
@@ -322,7 +392,7 @@ class Produto(models.Model):
         blank=True, 
         help_text="Comprimento em cm"
     )
-    imagem = models.ImageField(upload_to="produtos/", default="produtos/default.jpg")
+    imagem = models.ImageField(upload_to="produtos/", default="produtos/default.jpg", storage=obter_armazenamento)
     sku = models.CharField(max_length=50, unique=True, blank=True, null=True, db_index=True, help_text="SKU do produto")
     codigo_barras = models.CharField(max_length=50, blank=True, null=True, db_index=True, help_text="Código de barras")
     seo_title = models.CharField(max_length=70, blank=True, null=True)
@@ -367,6 +437,22 @@ class Produto(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     slug = models.SlugField(max_length=255, unique=True, blank=True, db_index=True)
+    # Agregados das avaliações aprovadas, mantidos por core.avaliacoes
+    total_avaliacoes = models.PositiveIntegerField(default=0, editable=False)
+    soma_notas = models.PositiveIntegerField(default=0, editable=False)
+    avaliacoes_nota_1 = models.PositiveIntegerField(default=0, editable=False)
+    avaliacoes_nota_2 = models.PositiveIntegerField(default=0, editable=False)
+    avaliacoes_nota_3 = models.PositiveIntegerField(default=0, editable=False)
+    avaliacoes_nota_4 = models.PositiveIntegerField(default=0, editable=False)
+    avaliacoes_nota_5 = models.PositiveIntegerField(default=0, editable=False)
+
+    # Mantidos por core.avaliacoes com F(); save() comum não os regrava
+    CAMPOS_CONTADORES = (
+        'total_avaliacoes', 'soma_notas', 'avaliacoes_nota_1', 'avaliacoes_nota_2',
+        'avaliacoes_nota_3', 'avaliacoes_nota_4', 'avaliacoes_nota_5',
+    )
+
+    objects = PrecoVigenteQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
@@ -376,26 +462,21 @@ class Produto(models.Model):
             models.Index(fields=['marca', 'ativo']),
             models.Index(fields=['preco', 'ativo']),
             models.Index(fields=['destaque', 'ativo']),
+            models.Index(fields=['promocao_inicio']),
+            models.Index(fields=['promocao_fim']),
         ]
 
     def __str__(self):
         return f"{self.nome} (R${self.preco})"
     
     def delete(self, *args, **kwargs):
-        if self.imagem and self.imagem.name != "produtos/default.jpg":
-            if os.path.isfile(self.imagem.path):
-                os.remove(self.imagem.path)
-        # Invalida cache
-        cache.delete(f'produto_{self.pk}')
-        cache.delete(f'produto_slug_{self.slug}')
+        # O arquivo da imagem é removido por core.midia quando perde a última referência
+        # e o cache pelas tags do produto (core.cache)
         super().delete(*args, **kwargs)
 
     def preco_vigente(self):
-        """Retorna o preço atual do produto com cache"""
-        cache_key = f'produto_{self.pk}_preco'
-        preco = cache.get(cache_key)
-        
-        if preco is None:
+        """Retorna o preço atual do produto com cache (sem cache antes do primeiro save)"""
+        def _calcular():
             agora = timezone.now()
             if self.preco_promocional and self.promocao_inicio and self.promocao_fim:
                 if self.promocao_inicio <= agora <= self.promocao_fim:
@@ -404,43 +485,31 @@ class Produto(models.Model):
                     preco = self.preco
             else:
                 preco = self.preco
-                
-            cache.set(cache_key, preco, CACHE_TIMEOUT)
-            
-        return preco
+            return preco
+
+        if not self.pk:
+            return _calcular()
+        return get_or_compute(montar_chave('produto', 'preco', escopo=self.pk), _calcular, PRECO_CACHE_TIMEOUT)
     
     def calcular_desconto(self):
-        """Calcula o percentual de desconto com cache"""
-        cache_key = f'produto_{self.pk}_desconto'
-        desconto = cache.get(cache_key)
-        
-        if desconto is None:
+        """Calcula o percentual de desconto com cache (sem cache antes do primeiro save)"""
+        def _calcular():
             preco_base = self.preco_original or self.preco
             preco_atual = self.preco_vigente()
             if preco_base > preco_atual:
                 desconto = round((1 - (preco_atual / preco_base)) * 100)
             else:
                 desconto = 0
-                
-            cache.set(cache_key, desconto, CACHE_TIMEOUT)
-            
-        return desconto
+            return desconto
+
+        if not self.pk:
+            return _calcular()
+        return get_or_compute(montar_chave('produto', 'desconto', escopo=self.pk), _calcular, PRECO_CACHE_TIMEOUT)
     
     def get_tamanhos_disponiveis(self):
-        """Retorna tamanhos disponíveis com cache"""
-        cache_key = f'produto_{self.pk}_tamanhos'
-        tamanhos = cache.get(cache_key)
-        
-        if tamanhos is None:
-            tamanhos = []
-            for variacao in self.variacoes.filter(estoque__gt=0):
-                for atributo in variacao.atributos.filter(tipo__tipo='size'):
-                    if atributo.valor not in tamanhos:
-                        tamanhos.append(atributo.valor)
-                        
-            cache.set(cache_key, tamanhos, CACHE_TIMEOUT)
-            
-        return tamanhos
+        """Retorna tamanhos disponíveis a partir da matriz de variações (com cache)"""
+        from core.variacoes import obter_matriz
+        return [tamanho['valor'] for tamanho in obter_matriz(self.pk)['tamanhos']]
     
     def clean(self):
         super().clean()
@@ -473,15 +542,22 @@ class Produto(models.Model):
             raise ValidationError(f"O preço não pode ser maior que R${PRODUTO_CONFIG['MAX_PRECO']}.")
 
     def media_avaliacoes(self):
-        """Retorna média das avaliações com cache"""
-        cache_key = f'produto_{self.pk}_media_avaliacoes'
-        media = cache.get(cache_key)
-        
-        if media is None:
-            media = self.avaliacoes.aggregate(media=Avg('nota'))['media'] or 0.0
-            cache.set(cache_key, media, CACHE_TIMEOUT)
-            
-        return media
+        """Retorna a média das avaliações aprovadas, sem consulta"""
+        if not self.total_avaliacoes:
+            return 0.0
+        return round(self.soma_notas / self.total_avaliacoes, 2)
+
+    def distribuicao_avaliacoes(self):
+        """Retorna quantidade e percentual de avaliações aprovadas por nota (5 a 1)"""
+        distribuicao = []
+        for nota in range(5, 0, -1):
+            quantidade = getattr(self, f'avaliacoes_nota_{nota}')
+            distribuicao.append({
+                'nota': nota,
+                'quantidade': quantidade,
+                'percentual': round(quantidade * 100 / self.total_avaliacoes) if self.total_avaliacoes else 0,
+            })
+        return distribuicao
 
     def save(self, *args, **kwargs):
         self.full_clean()
@@ -499,23 +575,21 @@ class Produto(models.Model):
         if not self.preco_original:
             self.preco_original = self.preco
         
-        # Só calcular desconto se necessário
+        # Invalida antes do desconto, que lê o preço vigente cacheado
+        if self.pk:
+            invalidar_namespace('produto', self.pk)
         self.desconto = self.calcular_desconto()
         
         # Só verificar preço antigo se for uma atualização
         preco_antigo = None
         if self.pk:
             preco_antigo = self.__class__.objects.filter(pk=self.pk).values_list('preco', flat=True).first()
-        
-        # Invalida cache
-        cache.delete(f'produto_{self.pk}')
-        cache.delete(f'produto_slug_{self.slug}')
-        cache.delete(f'produto_{self.pk}_preco')
-        cache.delete(f'produto_{self.pk}_desconto')
-        cache.delete(f'produto_{self.pk}_tamanhos')
-        cache.delete(f'produto_{self.pk}_media_avaliacoes')
-        
-        super().save(*args, **kwargs)
+
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campos_exceto(self, self.CAMPOS_CONTADORES)
+        from core.midia import transacao_de_upload  # core.midia importa os modelos
+        with transacao_de_upload():
+            super().save(*args, **kwargs)
         
         # Só criar histórico se preço mudou
         if preco_antigo is not None and preco_antigo != self.preco:
@@ -524,10 +598,9 @@ class Produto(models.Model):
     @classmethod
     def get_produtos_ativos(cls) -> List['Produto']:
         """Retorna produtos ativos com cache"""
-        cache_key = 'produtos_ativos'
-        produtos = cache.get(cache_key)
-        
-        if produtos is None:
+        cache_key = montar_chave('catalogo', 'produtos_ativos')
+
+        def _calcular():
             produtos = list(cls.objects.filter(
                 ativo=True,
                 visivel=True
@@ -538,18 +611,16 @@ class Produto(models.Model):
                 'tags',
                 'variacoes'
             ).order_by('-created_at'))
-            
-            cache.set(cache_key, produtos, CACHE_TIMEOUT)
-            
-        return produtos
+            return produtos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     @classmethod
     def get_produtos_destaque(cls) -> List['Produto']:
         """Retorna produtos em destaque com cache"""
-        cache_key = 'produtos_destaque'
-        produtos = cache.get(cache_key)
-        
-        if produtos is None:
+        cache_key = montar_chave('catalogo', 'produtos_destaque')
+
+        def _calcular():
             produtos = list(cls.objects.filter(
                 ativo=True,
                 visivel=True,
@@ -561,10 +632,9 @@ class Produto(models.Model):
                 'tags',
                 'variacoes'
             ).order_by('-created_at'))
-            
-            cache.set(cache_key, produtos, CACHE_TIMEOUT)
-            
-        return produtos
+            return produtos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ProdutoVariacao(models.Model):
     produto = models.ForeignKey(
@@ -625,6 +695,8 @@ class ProdutoVariacao(models.Model):
             models.Index(fields=['produto', 'ativo']),
             models.Index(fields=['estoque', 'ativo']),
             models.Index(fields=['sku', 'ativo']),
+            models.Index(fields=['promocao_inicio']),
+            models.Index(fields=['promocao_fim']),
         ]
         constraints = [
             models.UniqueConstraint(fields=['produto', 'atributos_hash'], name='unique_produto_atributos')
@@ -642,33 +714,25 @@ class ProdutoVariacao(models.Model):
     def clean(self):
         super().clean()
         
-        # Validar atributos obrigatórios
-        tipos_obrigatorios = AtributoTipo.objects.filter(obrigatorio=True)
-        atributos_tipos = [attr.tipo for attr in self.atributos.all()]
-        
-        for tipo in tipos_obrigatorios:
-            if tipo not in atributos_tipos:
-                raise ValidationError(f"Atributo obrigatório '{tipo.nome}' não foi selecionado.")
-        
-        # Validar atributos duplicados
-        tipos_selecionados = []
-        for attr in self.atributos.all():
-            if attr.tipo in tipos_selecionados:
-                raise ValidationError(f"Múltiplos valores para '{attr.tipo.nome}' não são permitidos.")
-            tipos_selecionados.append(attr.tipo)
-            
-        # Validar combinação única
+        # Sem pk ainda não há atributos: a ligação M2M é gravada depois do save
         if self.pk:
-            variacoes_existentes = ProdutoVariacao.objects.filter(produto=self.produto).exclude(pk=self.pk)
-        else:
-            variacoes_existentes = ProdutoVariacao.objects.filter(produto=self.produto)
-            
-        for variacao_existente in variacoes_existentes:
-            atributos_existentes = set(variacao_existente.atributos.all())
-            atributos_novos = set(self.atributos.all())
-            
-            if atributos_existentes == atributos_novos:
-                raise ValidationError("Já existe uma variação com essa combinação de atributos para este produto.")
+            valores = list(self.atributos.select_related('tipo'))
+            tipos_selecionados = set()
+
+            # Validar atributos obrigatórios
+            tipos_presentes = {valor.tipo_id for valor in valores}
+            for tipo_id, nome in AtributoTipo.get_obrigatorios().items():
+                if tipo_id not in tipos_presentes:
+                    raise ValidationError(f"Atributo obrigatório '{nome}' não foi selecionado.")
+
+            # Validar atributos duplicados
+            for valor in valores:
+                if valor.tipo_id in tipos_selecionados:
+                    raise ValidationError(f"Múltiplos valores para '{valor.tipo.nome}' não são permitidos.")
+                tipos_selecionados.add(valor.tipo_id)
+
+            # Validar combinação única pelo hash (índice unique_produto_atributos)
+            self.validar_combinacao(self.produto_id, (valor.id for valor in valores), self.pk)
                 
         # Validar dimensões
         if self.peso and self.peso > PRODUTO_CONFIG['MAX_PESO']:
@@ -680,41 +744,54 @@ class ProdutoVariacao(models.Model):
         if self.length and self.length > PRODUTO_CONFIG['MAX_DIMENSAO']:
             raise ValidationError(f"O comprimento não pode ser maior que {PRODUTO_CONFIG['MAX_DIMENSAO']}cm.")
     
+    @staticmethod
+    def sku_de_atributos(sku_produto: Optional[str], valores) -> Optional[str]:
+        """SKU da variação: SKU do produto + código (ou 3 letras) de cada valor, na ordem dos tipos"""
+        sufixos = [
+            valor.codigo or valor.valor[:3].upper()
+            for valor in sorted(valores, key=lambda valor: (valor.tipo.ordem, valor.tipo.nome))
+        ]
+        if not sku_produto or not sufixos:
+            return None
+        return f"{sku_produto}-{'-'.join(sufixos)}"
+
     def gerar_sku_automatico(self):
         """Gera SKU automaticamente baseado no produto e atributos"""
         if not self.sku and self.produto.sku:
-            sufixos = []
-            for attr in self.atributos.all().order_by('tipo__ordem', 'tipo__nome'):
-                if attr.codigo:
-                    sufixos.append(attr.codigo)
-                else:
-                    sufixos.append(attr.valor[:3].upper())
-            
-            if sufixos:
-                self.sku = f"{self.produto.sku}-{'-'.join(sufixos)}"
+            sku = self.sku_de_atributos(self.produto.sku, self.atributos.select_related('tipo'))
+            if sku:
+                self.sku = sku
+        return self.sku
     
+    @staticmethod
+    def hash_de_atributos(valor_ids) -> str:
+        """Hash da combinação de valores de atributo, independente da ordem"""
+        ids = sorted(str(valor_id) for valor_id in valor_ids)
+        return hashlib.sha256("-".join(ids).encode()).hexdigest()
+
     def calcular_hash_atributos(self):
         """Calcula hash único para combinação de atributos"""
-        ids = sorted(str(attr.id) for attr in self.atributos.all())
-        return hashlib.sha256("-".join(ids).encode()).hexdigest()
+        return self.hash_de_atributos(attr.id for attr in self.atributos.all())
+
+    @classmethod
+    def validar_combinacao(cls, produto_id, valor_ids, excluir_pk=None) -> str:
+        """Hash da combinação; ValidationError se outra variação do produto já a usa"""
+        atributos_hash = cls.hash_de_atributos(valor_ids)
+        if cls.objects.filter(produto_id=produto_id, atributos_hash=atributos_hash).exclude(pk=excluir_pk).exists():
+            raise ValidationError("Já existe uma variação com essa combinação de atributos para este produto.")
+        return atributos_hash
 
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
         self.atributos_hash = self.calcular_hash_atributos()
         super().save(update_fields=['atributos_hash'])
-        
-        # Invalida cache
-        cache.delete(f'produto_{self.produto_id}')
-        cache.delete(f'produto_{self.produto_id}_variacoes')
-        cache.delete(f'variacao_{self.pk}')
     
     def preco_final(self):
         """Retorna preço final com cache"""
-        cache_key = f'variacao_{self.pk}_preco'
-        preco = cache.get(cache_key)
-        
-        if preco is None:
+        cache_key = montar_chave('produto', 'variacao', self.pk, 'preco', escopo=self.produto_id)
+
+        def _calcular():
             agora = timezone.now()
             if self.preco_promocional and self.promocao_inicio and self.promocao_fim:
                 if self.promocao_inicio <= agora <= self.promocao_fim:
@@ -723,10 +800,9 @@ class ProdutoVariacao(models.Model):
                     preco = self.produto.preco_vigente() + self.preco_adicional
             else:
                 preco = self.produto.preco_vigente() + self.preco_adicional
-                
-            cache.set(cache_key, preco, CACHE_TIMEOUT)
-            
-        return preco
+            return preco
+
+        return get_or_compute(cache_key, _calcular, PRECO_CACHE_TIMEOUT)
 
     def diminuir_estoque(self, quantidade: int):
         """Diminui estoque com validação e log"""
@@ -764,10 +840,9 @@ class ProdutoVariacao(models.Model):
     @classmethod
     def get_variacoes_ativas(cls, produto_id: int) -> List['ProdutoVariacao']:
         """Retorna variações ativas de um produto com cache"""
-        cache_key = f'produto_{produto_id}_variacoes'
-        variacoes = cache.get(cache_key)
-        
-        if variacoes is None:
+        cache_key = montar_chave('produto', 'variacoes', escopo=produto_id)
+
+        def _calcular():
             variacoes = list(cls.objects.filter(
                 produto_id=produto_id,
                 ativo=True
@@ -775,10 +850,9 @@ class ProdutoVariacao(models.Model):
                 'atributos',
                 'atributos__tipo'
             ).order_by('atributos__tipo__ordem', 'atributos__ordem'))
-            
-            cache.set(cache_key, variacoes, CACHE_TIMEOUT)
-            
-        return variacoes
+            return variacoes
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ImagemProduto(models.Model):
     produto = models.ForeignKey(
@@ -787,7 +861,7 @@ class ImagemProduto(models.Model):
         related_name='imagens',
         db_index=True
     )
-    imagem = models.ImageField(upload_to="produtos/galeria/")
+    imagem = models.ImageField(upload_to="produtos/galeria/", storage=obter_armazenamento)
     destaque = models.BooleanField(default=False, db_index=True)
     ordem = models.PositiveIntegerField(default=0, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -807,32 +881,44 @@ class ImagemProduto(models.Model):
             raise ValidationError("A imagem é obrigatória.")
 
     def delete(self, *args, **kwargs):
-        if self.imagem and os.path.isfile(self.imagem.path):
-            os.remove(self.imagem.path)
-        # Invalida cache
-        cache.delete(f'produto_{self.produto_id}_imagens')
+        # O arquivo é removido por core.midia quando perde a última referência
         super().delete(*args, **kwargs)
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        # Invalida cache
-        cache.delete(f'produto_{self.produto_id}_imagens')
-        super().save(*args, **kwargs)
+        from core.midia import transacao_de_upload  # core.midia importa os modelos
+        with transacao_de_upload():
+            super().save(*args, **kwargs)
 
     @classmethod
     def get_imagens_produto(cls, produto_id: int) -> List['ImagemProduto']:
         """Retorna imagens de um produto com cache"""
-        cache_key = f'produto_{produto_id}_imagens'
-        imagens = cache.get(cache_key)
-        
-        if imagens is None:
+        cache_key = montar_chave('produto', 'imagens', escopo=produto_id)
+
+        def _calcular():
             imagens = list(cls.objects.filter(
                 produto_id=produto_id
             ).order_by('ordem'))
-            
-            cache.set(cache_key, imagens, CACHE_TIMEOUT)
-            
-        return imagens
+            return imagens
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
+
+class ArquivoMidia(models.Model):
+    """Contagem de referências de um arquivo de imagem (mantida por core.midia)"""
+    nome = models.CharField(max_length=255, unique=True)
+    referencias = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Arquivo de Mídia"
+        verbose_name_plural = "Arquivos de Mídia"
+        indexes = [
+            models.Index(fields=['referencias']),
+        ]
+
+    def __str__(self):
+        return f"{self.nome} ({self.referencias})"
 
 class AvaliacaoProduto(models.Model):
     produto = models.ForeignKey(
@@ -870,28 +956,207 @@ class AvaliacaoProduto(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        # Invalida cache
-        cache.delete(f'produto_{self.produto_id}_avaliacoes')
-        cache.delete(f'produto_{self.produto_id}_media_avaliacoes')
-        super().save(*args, **kwargs)
+        # Atômico para que os agregados do produto (signals) acompanhem a avaliação
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
 
     @classmethod
     def get_avaliacoes_produto(cls, produto_id: int) -> List['AvaliacaoProduto']:
         """Retorna avaliações de um produto com cache"""
-        cache_key = f'produto_{produto_id}_avaliacoes'
-        avaliacoes = cache.get(cache_key)
-        
-        if avaliacoes is None:
+        cache_key = montar_chave('produto', 'avaliacoes', escopo=produto_id)
+
+        def _calcular():
             avaliacoes = list(cls.objects.filter(
                 produto_id=produto_id,
                 aprovada=True
             ).select_related(
                 'usuario'
             ).order_by('-criado_em'))
-            
-            cache.set(cache_key, avaliacoes, CACHE_TIMEOUT)
-            
-        return avaliacoes
+            return avaliacoes
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
+
+class ProdutoBusca(models.Model):
+    """Documento de busca textual de um produto (mantido por core.busca)"""
+    produto = models.OneToOneField(
+        Produto,
+        on_delete=models.CASCADE,
+        related_name='busca',
+        primary_key=True
+    )
+    nome = models.TextField(blank=True)
+    classificacao = models.TextField(blank=True)
+    complementos = models.TextField(blank=True)
+    descricao = models.TextField(blank=True)
+    vetor = SearchVectorField(null=True)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Documento de Busca"
+        verbose_name_plural = "Documentos de Busca"
+        indexes = [
+            GinIndex(fields=['vetor'], name='produto_busca_vetor_gin'),
+        ]
+
+    def __str__(self):
+        return f"Busca de {self.produto_id}"
+
+class ProdutoCard(models.Model):
+    """Projeção desnormalizada do que um card de produto exibe (mantida por core.cards)"""
+    produto = models.OneToOneField(
+        Produto,
+        on_delete=models.CASCADE,
+        related_name='card',
+        primary_key=True
+    )
+    nome = models.CharField(max_length=255)
+    slug = models.SlugField(max_length=255)
+    categoria = models.ForeignKey(
+        Categoria,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    marca = models.ForeignKey(
+        Marca,
+        on_delete=models.SET_NULL,
+        related_name='+',
+        null=True,
+        blank=True
+    )
+    preco = models.DecimalField(max_digits=10, decimal_places=2)
+    preco_original = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    preco_promocional = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    promocao_inicio = models.DateTimeField(null=True, blank=True)
+    promocao_fim = models.DateTimeField(null=True, blank=True)
+    media_avaliacoes = models.DecimalField(max_digits=3, decimal_places=2, default=0)
+    total_avaliacoes = models.PositiveIntegerField(default=0)
+    imagem = models.CharField(max_length=255, blank=True)
+    cores = models.JSONField(default=list, blank=True)
+    tamanhos = models.JSONField(default=list, blank=True)
+    variacao_padrao_id = models.PositiveIntegerField(null=True, blank=True)
+    em_estoque = models.BooleanField(default=False)
+    ativo = models.BooleanField(default=True)
+    destaque = models.BooleanField(default=False)
+    # Chaves de ordenação mantidas por core.rankings (fora de CAMPOS_ATUALIZAVEIS)
+    unidades_vendidas = models.PositiveIntegerField(default=0)
+    tendencia = models.FloatField(default=0)
+    created_at = models.DateTimeField()
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    objects = PrecoVigenteQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Card de Produto"
+        verbose_name_plural = "Cards de Produtos"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['ativo', '-created_at']),
+            models.Index(fields=['ativo', 'categoria', '-created_at']),
+            models.Index(fields=['ativo', 'destaque', '-created_at']),
+            models.Index(fields=['ativo', 'preco']),
+            models.Index(fields=['ativo', '-unidades_vendidas', '-produto']),
+            models.Index(fields=['ativo', '-tendencia', '-produto']),
+        ]
+
+    def __str__(self):
+        return f"Card de {self.nome}"
+
+    @property
+    def imagem_url(self):
+        return default_storage.url(self.imagem) if self.imagem else ''
+
+    def preco_vigente(self):
+        """Retorna o preço atual a partir dos campos copiados do produto"""
+        agora = timezone.now()
+        if self.preco_promocional and self.promocao_inicio and self.promocao_fim:
+            if self.promocao_inicio <= agora <= self.promocao_fim:
+                return self.preco_promocional
+        return self.preco
+
+    def calcular_desconto(self):
+        """Calcula o percentual de desconto sobre o preço original"""
+        preco_base = self.preco_original or self.preco
+        preco_atual = self.preco_vigente()
+        if preco_base > preco_atual:
+            return round((1 - (preco_atual / preco_base)) * 100)
+        return 0
+
+class EpocaRankings(models.Model):
+    """Época dos pesos de ProdutoCard.tendencia (linha única, mantida por core.rankings)"""
+    epoca = models.DateTimeField()
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Época dos Rankings"
+        verbose_name_plural = "Época dos Rankings"
+
+    def __str__(self):
+        return f"Época dos rankings: {self.epoca:%d/%m/%Y %H:%M}"
+
+class CoocorrenciaProduto(models.Model):
+    """
+    Pedidos pagos que contêm os dois produtos (produto_a <= produto_b); com
+    produto_a == produto_b, pedidos pagos do produto. Mantido por core.recomendacoes.
+    """
+    produto_a = models.ForeignKey(Produto, on_delete=models.CASCADE, related_name='+')
+    produto_b = models.ForeignKey(Produto, on_delete=models.CASCADE, related_name='+')
+    pedidos = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Coocorrência de Produtos"
+        verbose_name_plural = "Coocorrências de Produtos"
+        constraints = [
+            models.UniqueConstraint(fields=['produto_a', 'produto_b'], name='unique_coocorrencia_produtos')
+        ]
+        indexes = [
+            models.Index(fields=['produto_b', 'produto_a']),
+        ]
+
+    def __str__(self):
+        return f"{self.produto_a_id} + {self.produto_b_id}: {self.pedidos}"
+
+class ProdutoRelacionado(models.Model):
+    """K vizinhos pré-calculados de um produto, por tipo de recomendação (core.recomendacoes)"""
+    TIPO_CHOICES = [
+        ('comprados_juntos', 'Comprados juntos'),
+        ('similares', 'Similares'),
+    ]
+
+    produto = models.ForeignKey(Produto, on_delete=models.CASCADE, related_name='relacionados')
+    relacionado = models.ForeignKey(Produto, on_delete=models.CASCADE, related_name='relacionado_em')
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES)
+    posicao = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        verbose_name = "Produto Relacionado"
+        verbose_name_plural = "Produtos Relacionados"
+        constraints = [
+            models.UniqueConstraint(fields=['produto', 'tipo', 'relacionado'], name='unique_produto_relacionado')
+        ]
+        indexes = [
+            models.Index(fields=['produto', 'tipo', 'posicao']),
+        ]
+
+    def __str__(self):
+        return f"{self.produto_id} -> {self.relacionado_id} ({self.tipo}, {self.score:.3f})"
+
+class SimilarPendente(models.Model):
+    """Produto com similares a recalcular (core.similares, comando calcular_similares --pendentes)"""
+    # Sem FK: produto removido também precisa sair da lista dos vizinhos
+    produto_id = models.BigIntegerField(primary_key=True)
+    marcado_em = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Similar Pendente"
+        verbose_name_plural = "Similares Pendentes"
+
+    def __str__(self):
+        return f"{self.produto_id} (marcado em {self.marcado_em:%d/%m/%Y %H:%M})"
 
 class Endereco(models.Model):
     ESTADO_CHOICES = [
@@ -1030,33 +1295,28 @@ class Endereco(models.Model):
     def get_enderecos_usuario(cls, usuario_id: int) -> List['Endereco']:
         """Retorna endereços de um usuário com cache"""
         cache_key = f'usuario_{usuario_id}_enderecos'
-        enderecos = cache.get(cache_key)
-        
-        if enderecos is None:
+
+        def _calcular():
             enderecos = list(cls.objects.filter(
                 usuario_id=usuario_id
             ).order_by('-principal', '-criado_em'))
-            
-            cache.set(cache_key, enderecos, CACHE_TIMEOUT)
-            
-        return enderecos
+            return enderecos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     @classmethod
     def get_endereco_principal(cls, usuario_id: int) -> Optional['Endereco']:
         """Retorna endereço principal de um usuário com cache"""
         cache_key = f'usuario_{usuario_id}_endereco_principal'
-        endereco = cache.get(cache_key)
-        
-        if endereco is None:
+
+        def _calcular():
             endereco = cls.objects.filter(
                 usuario_id=usuario_id,
                 principal=True
             ).first()
-            
-            if endereco:
-                cache.set(cache_key, endereco, CACHE_TIMEOUT)
-            
-        return endereco
+            return endereco
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class Cupom(models.Model):
     TIPO_CHOICES = [
@@ -1289,8 +1549,6 @@ class Cupom(models.Model):
         """Incrementa o contador de usos do cupom"""
         self.usos += 1
         self.save(update_fields=['usos'])
-        # Invalida cache
-        cache.delete(f'cupom_{self.codigo}')
 
     def clean(self):
         if not self.codigo or len(self.codigo.strip()) < 3:
@@ -1322,17 +1580,14 @@ class Cupom(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()
-        # Invalida cache
-        cache.delete(f'cupom_{self.codigo}')
         super().save(*args, **kwargs)
 
     @classmethod
     def get_cupom_por_codigo(cls, codigo: str) -> Optional['Cupom']:
         """Retorna cupom por código com cache"""
-        cache_key = f'cupom_{codigo}'
-        cupom = cache.get(cache_key)
-        
-        if cupom is None:
+        cache_key = montar_chave('cupom', 'objeto', escopo=codigo)
+
+        def _calcular():
             cupom = cls.objects.filter(
                 codigo=codigo,
                 ativo=True
@@ -1340,11 +1595,9 @@ class Cupom(models.Model):
                 'produtos_aplicaveis',
                 'categorias_aplicaveis'
             ).first()
-            
-            if cupom:
-                cache.set(cache_key, cupom, CACHE_TIMEOUT)
-            
-        return cupom
+            return cupom
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class Pedido(models.Model):
     STATUS_CHOICES = [
@@ -1356,6 +1609,11 @@ class Pedido(models.Model):
         ("X", "Cancelado"),
         ("D", "Devolvido"),
     ]
+    # Status em que o pedido conta como venda
+    STATUS_PAGOS = ("PA", "E", "T", "C")
+
+    # Mantido por core.rankings com a época travada; save() comum não o regrava
+    CAMPOS_CONTADORES = ('rankings_aplicado',)
 
     usuario = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -1412,6 +1670,8 @@ class Pedido(models.Model):
     )
     data_criacao = models.DateTimeField(auto_now_add=True, db_index=True)
     atualizado_em = models.DateTimeField(auto_now=True)
+    # Se as unidades do pedido estão nos rankings de ProdutoCard (mantido por core.rankings)
+    rankings_aplicado = models.BooleanField(default=False, editable=False)
     cupom = models.ForeignKey(
         Cupom, 
         null=True, 
@@ -1449,12 +1709,14 @@ class Pedido(models.Model):
     def __str__(self):
         return f"Pedido {self.codigo}"
     
+    def _tags_cupom(self) -> List[str]:
+        return [tag('cupom', self.cupom.codigo)] if self.cupom_id else []
+
     def calcular_total(self):
         """Calcula o total do pedido incluindo frete e descontos de cupom com cache"""
-        cache_key = f'pedido_{self.pk}_total'
-        total = cache.get(cache_key)
-        
-        if total is None:
+        cache_key = montar_chave('pedido', 'total', escopo=self.pk)
+
+        def _calcular():
             # Soma o valor dos itens
             total_itens = sum(item.preco_unitario * item.quantidade for item in self.itens.all())
             total_com_frete = total_itens + self.frete_valor
@@ -1477,17 +1739,15 @@ class Pedido(models.Model):
                     total = total_com_frete
             else:
                 total = total_com_frete
-                
-            cache.set(cache_key, total, CACHE_TIMEOUT)
-            
-        return total
+            return total
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT, tags=self._tags_cupom())
         
     def calcular_desconto_cupom(self):
         """Retorna informações sobre o desconto aplicado pelo cupom com cache"""
-        cache_key = f'pedido_{self.pk}_desconto_cupom'
-        info_desconto = cache.get(cache_key)
-        
-        if info_desconto is None:
+        cache_key = montar_chave('pedido', 'desconto_cupom', escopo=self.pk)
+
+        def _calcular():
             if not self.cupom:
                 info_desconto = {'tem_desconto': False, 'valor_desconto': 0, 'tipo': None}
             else:
@@ -1502,10 +1762,9 @@ class Pedido(models.Model):
                     'tipo': self.cupom.tipo,
                     'codigo': self.cupom.codigo
                 }
-                
-            cache.set(cache_key, info_desconto, CACHE_TIMEOUT)
-            
-        return info_desconto
+            return info_desconto
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT, tags=self._tags_cupom())
         
     def atualizar_estoque(self, operacao="diminuir"):
         """Atualiza o estoque das variações dos itens do pedido com validação"""
@@ -1550,6 +1809,8 @@ class Pedido(models.Model):
             status_antigo = Pedido.objects.get(pk=self.pk).status
         
         self.full_clean()
+        if not creating and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = campos_exceto(self, self.CAMPOS_CONTADORES)
         super().save(*args, **kwargs)
         
         if not creating:
@@ -1558,9 +1819,9 @@ class Pedido(models.Model):
             
             # Lógica de atualização de estoque baseada na mudança de status
             if status_antigo and status_antigo != self.status:
-                if status_antigo not in ["PA", "E", "T", "C"] and self.status == "PA":
+                if status_antigo not in self.STATUS_PAGOS and self.status == "PA":
                     self.atualizar_estoque("diminuir")
-                elif status_antigo in ["PA", "E", "T", "C"] and self.status in ["X", "D"]:
+                elif status_antigo in self.STATUS_PAGOS and self.status in ["X", "D"]:
                     self.atualizar_estoque("aumentar")
         
         # Cria log de alteração de status
@@ -1573,20 +1834,16 @@ class Pedido(models.Model):
                 notas=f"Status alterado de {dict(self.STATUS_CHOICES).get(status_antigo)} para {dict(self.STATUS_CHOICES).get(self.status)}"
             )
             
-        # Invalida cache
-        cache.delete(f'pedido_{self.pk}_total')
-        cache.delete(f'pedido_{self.pk}_desconto_cupom')
-        if self.usuario:
-            cache.delete(f'usuario_{self.usuario_id}_pedidos')
-            cache.delete(f'usuario_{self.usuario_id}_pedidos_ativos')
+        # O cache do pedido é invalidado pelas tags; as listas do usuário, aqui
+        if self.usuario_id:
+            invalidar_namespace('pedido', f'usuario_{self.usuario_id}')
 
     @classmethod
     def get_pedidos_usuario(cls, usuario_id: int) -> List['Pedido']:
         """Retorna pedidos de um usuário com cache"""
-        cache_key = f'usuario_{usuario_id}_pedidos'
-        pedidos = cache.get(cache_key)
-        
-        if pedidos is None:
+        cache_key = montar_chave('pedido', 'lista', escopo=f'usuario_{usuario_id}')
+
+        def _calcular():
             pedidos = list(cls.objects.filter(
                 usuario_id=usuario_id
             ).select_related(
@@ -1597,18 +1854,16 @@ class Pedido(models.Model):
                 'itens__produto',
                 'itens__variacao'
             ).order_by('-data_criacao'))
-            
-            cache.set(cache_key, pedidos, CACHE_TIMEOUT)
-            
-        return pedidos
+            return pedidos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     @classmethod
     def get_pedidos_ativos(cls, usuario_id: int) -> List['Pedido']:
         """Retorna pedidos ativos de um usuário com cache"""
-        cache_key = f'usuario_{usuario_id}_pedidos_ativos'
-        pedidos = cache.get(cache_key)
-        
-        if pedidos is None:
+        cache_key = montar_chave('pedido', 'ativos', escopo=f'usuario_{usuario_id}')
+
+        def _calcular():
             pedidos = list(cls.objects.filter(
                 usuario_id=usuario_id,
                 status__in=['P', 'PA', 'E', 'T']
@@ -1620,10 +1875,9 @@ class Pedido(models.Model):
                 'itens__produto',
                 'itens__variacao'
             ).order_by('-data_criacao'))
-            
-            cache.set(cache_key, pedidos, CACHE_TIMEOUT)
-            
-        return pedidos
+            return pedidos
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ItemPedido(models.Model):
     pedido = models.ForeignKey(
@@ -1662,14 +1916,13 @@ class ItemPedido(models.Model):
 
     def preco_total(self):
         """Calcula o preço total do item com cache"""
-        cache_key = f'item_pedido_{self.pk}_preco_total'
-        preco_total = cache.get(cache_key)
-        
-        if preco_total is None:
+        cache_key = montar_chave('pedido', 'item', self.pk, 'preco_total', escopo=self.pedido_id)
+
+        def _calcular():
             preco_total = self.preco_unitario * self.quantidade
-            cache.set(cache_key, preco_total, CACHE_TIMEOUT)
-            
-        return preco_total
+            return preco_total
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     def clean(self):
         if self.quantidade < 1:
@@ -1689,21 +1942,12 @@ class ItemPedido(models.Model):
         
         super().save(*args, **kwargs)
         self.pedido.save()  # Atualiza o total do pedido
-        
-        # Invalida cache
-        cache.delete(f'item_pedido_{self.pk}_preco_total')
-        cache.delete(f'pedido_{self.pedido_id}_total')
-        cache.delete(f'pedido_{self.pedido_id}_desconto_cupom')
 
     def delete(self, *args, **kwargs):
         """Atualiza o total do pedido após deletar item"""
         pedido = self.pedido
         super().delete(*args, **kwargs)
         pedido.save()
-        
-        # Invalida cache
-        cache.delete(f'pedido_{pedido.id}_total')
-        cache.delete(f'pedido_{pedido.id}_desconto_cupom')
 
 class HistoricoPreco(models.Model):
     produto = models.ForeignKey(Produto, on_delete=models.CASCADE, related_name='historico_precos')
@@ -1795,25 +2039,27 @@ class Carrinho(models.Model):
 
     def calcular_total(self):
         """Calcula o total do carrinho com cache"""
-        cache_key = f'carrinho_{self.pk}_total'
-        total = cache.get(cache_key)
-        
-        if total is None:
-            total = sum(item.preco_total() for item in self.itens.all())
-            cache.set(cache_key, total, CACHE_TIMEOUT)
-            
-        return total
+        cache_key = montar_chave('carrinho', 'total', escopo=self.usuario_id)
+        itens = []
+
+        def _calcular():
+            itens[:] = self.itens.all()
+            return sum(item.preco_total() for item in itens)
+
+        return get_or_compute(
+            cache_key, _calcular, CACHE_TIMEOUT,
+            tags=lambda total: [nome for item in itens for nome in item.tags_cache()]
+        )
 
     def quantidade_total(self):
         """Calcula quantidade total de itens com cache"""
-        cache_key = f'carrinho_{self.pk}_quantidade'
-        quantidade = cache.get(cache_key)
-        
-        if quantidade is None:
+        cache_key = montar_chave('carrinho', 'quantidade', escopo=self.usuario_id)
+
+        def _calcular():
             quantidade = sum(item.quantidade for item in self.itens.all())
-            cache.set(cache_key, quantidade, CACHE_TIMEOUT)
-            
-        return quantidade
+            return quantidade
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     def clean(self):
         if not self.usuario_id:
@@ -1822,19 +2068,13 @@ class Carrinho(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'carrinho_{self.pk}_total')
-        cache.delete(f'carrinho_{self.pk}_quantidade')
-        if self.usuario:
-            cache.delete(f'usuario_{self.usuario_id}_carrinho')
 
     @classmethod
     def get_carrinho_usuario(cls, usuario_id: int) -> Optional['Carrinho']:
         """Retorna carrinho de um usuário com cache"""
-        cache_key = f'usuario_{usuario_id}_carrinho'
-        carrinho = cache.get(cache_key)
-        
-        if carrinho is None:
+        cache_key = montar_chave('carrinho', 'objeto', escopo=usuario_id)
+
+        def _calcular():
             carrinho = cls.objects.filter(
                 usuario_id=usuario_id
             ).prefetch_related(
@@ -1842,11 +2082,9 @@ class Carrinho(models.Model):
                 'itens__produto',
                 'itens__variacao'
             ).first()
-            
-            if carrinho:
-                cache.set(cache_key, carrinho, CACHE_TIMEOUT)
-            
-        return carrinho
+            return carrinho
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ItemCarrinho(models.Model):
     carrinho = models.ForeignKey(
@@ -1879,30 +2117,35 @@ class ItemCarrinho(models.Model):
             models.Index(fields=['produto', 'variacao']),
         ]
 
+    def tags_cache(self) -> List[str]:
+        """Tags dos objetos de que o preço do item depende"""
+        tags = [tag('produto', self.produto_id)]
+        if self.variacao_id:
+            tags.append(tag('variacao', self.variacao_id))
+        return tags
+
     def preco_unitario(self):
-        """Retorna preço unitário com cache"""
-        cache_key = f'item_carrinho_{self.pk}_preco_unitario'
-        preco = cache.get(cache_key)
-        
-        if preco is None:
+        """Retorna preço unitário com cache (invalidado se o produto ou a variação mudar)"""
+        cache_key = montar_chave('carrinho', 'item', self.pk, 'preco_unitario', escopo=self.carrinho.usuario_id)
+
+        def _calcular():
             if self.variacao:
                 preco = self.variacao.preco_final()
             else:
                 preco = self.produto.preco_vigente()
-            cache.set(cache_key, preco, CACHE_TIMEOUT)
-            
-        return preco
+            return preco
+
+        return get_or_compute(cache_key, _calcular, PRECO_CACHE_TIMEOUT, tags=self.tags_cache())
 
     def preco_total(self):
-        """Calcula preço total com cache"""
-        cache_key = f'item_carrinho_{self.pk}_preco_total'
-        total = cache.get(cache_key)
-        
-        if total is None:
+        """Calcula preço total com cache (invalidado se o produto ou a variação mudar)"""
+        cache_key = montar_chave('carrinho', 'item', self.pk, 'preco_total', escopo=self.carrinho.usuario_id)
+
+        def _calcular():
             total = self.preco_unitario() * self.quantidade
-            cache.set(cache_key, total, CACHE_TIMEOUT)
-            
-        return total
+            return total
+
+        return get_or_compute(cache_key, _calcular, PRECO_CACHE_TIMEOUT, tags=self.tags_cache())
 
     def clean(self):
         if self.quantidade < 1:
@@ -1915,18 +2158,6 @@ class ItemCarrinho(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'item_carrinho_{self.pk}_preco_unitario')
-        cache.delete(f'item_carrinho_{self.pk}_preco_total')
-        cache.delete(f'carrinho_{self.carrinho_id}_total')
-        cache.delete(f'carrinho_{self.carrinho_id}_quantidade')
-
-    def delete(self, *args, **kwargs):
-        carrinho = self.carrinho
-        super().delete(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'carrinho_{carrinho.id}_total')
-        cache.delete(f'carrinho_{carrinho.id}_quantidade')
 
 class Reembolso(models.Model):
     STATUS_CHOICES = (
@@ -1978,9 +2209,6 @@ class Reembolso(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'pedido_{self.pedido_id}_reembolso')
-        cache.delete(f'pedido_{self.pedido_id}_total')
 
 class Notification(models.Model):
     recipient = models.ForeignKey(
@@ -2037,27 +2265,24 @@ class Notification(models.Model):
     def get_notificacoes_usuario(cls, usuario_id: int) -> List['Notification']:
         """Retorna notificações de um usuário com cache"""
         cache_key = f'usuario_{usuario_id}_notificacoes'
-        notificacoes = cache.get(cache_key)
-        
-        if notificacoes is None:
+
+        def _calcular():
             notificacoes = list(cls.objects.filter(
                 recipient_id=usuario_id
             ).select_related(
                 'actor',
                 'target_content_type'
             ).order_by('-timestamp'))
-            
-            cache.set(cache_key, notificacoes, CACHE_TIMEOUT)
-            
-        return notificacoes
+            return notificacoes
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     @classmethod
     def get_notificacoes_nao_lidas(cls, usuario_id: int) -> List['Notification']:
         """Retorna notificações não lidas de um usuário com cache"""
         cache_key = f'usuario_{usuario_id}_notificacoes_nao_lidas'
-        notificacoes = cache.get(cache_key)
-        
-        if notificacoes is None:
+
+        def _calcular():
             notificacoes = list(cls.objects.filter(
                 recipient_id=usuario_id,
                 unread=True
@@ -2065,10 +2290,9 @@ class Notification(models.Model):
                 'actor',
                 'target_content_type'
             ).order_by('-timestamp'))
-            
-            cache.set(cache_key, notificacoes, CACHE_TIMEOUT)
-            
-        return notificacoes
+            return notificacoes
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class Wishlist(models.Model):
     usuario = models.ForeignKey(
@@ -2109,9 +2333,8 @@ class Wishlist(models.Model):
     def get_wishlists_usuario(cls, usuario_id: int) -> List['Wishlist']:
         """Retorna wishlists de um usuário com cache"""
         cache_key = f'usuario_{usuario_id}_wishlists'
-        wishlists = cache.get(cache_key)
-        
-        if wishlists is None:
+
+        def _calcular():
             wishlists = list(cls.objects.filter(
                 usuario_id=usuario_id
             ).prefetch_related(
@@ -2119,10 +2342,9 @@ class Wishlist(models.Model):
                 'itens__produto',
                 'itens__variacao'
             ).order_by('-criado_em'))
-            
-            cache.set(cache_key, wishlists, CACHE_TIMEOUT)
-            
-        return wishlists
+            return wishlists
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ItemWishlist(models.Model):
     wishlist = models.ForeignKey(
@@ -2208,46 +2430,38 @@ class LogEstoque(models.Model):
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'variacao_{self.variacao_id}_logs_estoque')
-        if self.pedido:
-            cache.delete(f'pedido_{self.pedido_id}_logs_estoque')
 
     @classmethod
     def get_logs_variacao(cls, variacao_id: int) -> List['LogEstoque']:
         """Retorna logs de estoque de uma variação com cache"""
-        cache_key = f'variacao_{variacao_id}_logs_estoque'
-        logs = cache.get(cache_key)
-        
-        if logs is None:
+        cache_key = montar_chave('variacao', 'logs_estoque', escopo=variacao_id)
+
+        def _calcular():
             logs = list(cls.objects.filter(
                 variacao_id=variacao_id
             ).select_related(
                 'usuario',
                 'pedido'
             ).order_by('-data'))
-            
-            cache.set(cache_key, logs, CACHE_TIMEOUT)
-            
-        return logs
+            return logs
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
     @classmethod
     def get_logs_pedido(cls, pedido_id: int) -> List['LogEstoque']:
         """Retorna logs de estoque de um pedido com cache"""
-        cache_key = f'pedido_{pedido_id}_logs_estoque'
-        logs = cache.get(cache_key)
-        
-        if logs is None:
+        cache_key = montar_chave('pedido', 'logs_estoque', escopo=pedido_id)
+
+        def _calcular():
             logs = list(cls.objects.filter(
                 pedido_id=pedido_id
             ).select_related(
                 'variacao',
                 'usuario'
             ).order_by('-data'))
-            
-            cache.set(cache_key, logs, CACHE_TIMEOUT)
-            
-        return logs
+            return logs
+
+        return get_or_compute(cache_key, _calcular, CACHE_TIMEOUT)
 
 class ReservaEstoque(models.Model):
     """Modelo para gerenciar reservas de estoque e prevenir overselling"""
@@ -2308,9 +2522,6 @@ class ReservaEstoque(models.Model):
         self.full_clean()
         self.lock_version += 1  # Incrementa versão do lock
         super().save(*args, **kwargs)
-        # Invalida cache
-        cache.delete(f'variacao_{self.variacao_id}_estoque_disponivel')
-        cache.delete(f'variacao_{self.variacao_id}_reservas_ativas')
 
     @classmethod
     def reservar_estoque(cls, variacao_id: int, quantidade: int, sessao_id: str, tempo_reserva: int = 30) -> 'ReservaEstoque':
@@ -2370,10 +2581,9 @@ class ReservaEstoque(models.Model):
     @classmethod
     def get_quantidade_reservada(cls, variacao_id: int) -> int:
         """Retorna quantidade total reservada de uma variação"""
-        cache_key = f'variacao_{variacao_id}_quantidade_reservada'
-        quantidade = cache.get(cache_key)
-        
-        if quantidade is None:
+        cache_key = montar_chave('variacao', 'quantidade_reservada', escopo=variacao_id)
+
+        def _calcular():
             quantidade = cls.objects.filter(
                 variacao_id=variacao_id,
                 status='P',
@@ -2381,10 +2591,9 @@ class ReservaEstoque(models.Model):
             ).aggregate(
                 total=models.Sum('quantidade')
             )['total'] or 0
-            
-            cache.set(cache_key, quantidade, 60)  # Cache por 1 minuto
-            
-        return quantidade
+            return quantidade
+
+        return get_or_compute(cache_key, _calcular, 60)  # Cache por 1 minuto
 
     @classmethod
     def liberar_reservas_expiradas(cls):
@@ -2394,13 +2603,17 @@ class ReservaEstoque(models.Model):
                 status='P',
                 data_expiracao__lte=timezone.now()
             ).select_for_update()
+            variacao_ids = set(reservas.values_list('variacao_id', flat=True))
             
-            for reserva in reservas:
-                reserva.status = 'E'
-                reserva.save()
-                
-            # Invalida cache
-            cache.delete_pattern('variacao_*_quantidade_reservada')
+            # update() em vez de save(): o full_clean recusa data_expiracao no passado
+            cls.objects.filter(
+                status='P',
+                variacao_id__in=variacao_ids,
+                data_expiracao__lte=timezone.now()
+            ).update(status='E', lock_version=F('lock_version') + 1)
+            
+        # Invalida só as variações que tinham reservas expiradas
+        invalidar_escopos('variacao', variacao_ids)
 
 
 class AuditoriaPreco(models.Model):
@@ -0,0 +1,141 @@
+"""
+Paginação por cursor (keyset) para listagens ordenadas.
+
+Em vez de OFFSET + COUNT, cada página filtra a partir da chave de ordenação
+do último item visto, por exemplo (created_at, pk). O cursor que vai na URL
+é assinado e opaco. As primeiras páginas continuam acessíveis por número
+(?page=N) para links diretos.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional, Sequence
+
+from django.core import signing
+from django.db.models import Q, QuerySet
+
+PAGINACAO_CONFIG = {
+    'SALT': 'core.paginacao',
+    'PAGINAS_OFFSET': 5,  # páginas ainda servidas por número
+}
+
+
+class Pagina:
+    """Página de resultados com os cursores de navegação"""
+
+    def __init__(self, itens: List, numero: Optional[int] = None,
+                 proximo: Optional[str] = None, anterior: Optional[str] = None,
+                 tem_proxima: bool = False, tem_anterior: bool = False):
+        self.itens = itens
+        self.numero = numero
+        self.proximo = proximo
+        self.anterior = anterior
+        self.tem_proxima = tem_proxima
+        self.tem_anterior = tem_anterior
+
+    def __iter__(self):
+        return iter(self.itens)
+
+    def __len__(self):
+        return len(self.itens)
+
+
+def _serializar(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return valor
+
+
+def _valores_chave(obj, ordenacao: Sequence[str]) -> list:
+    return [_serializar(getattr(obj, campo.lstrip('-'))) for campo in ordenacao]
+
+
+def _inverter(campo: str) -> str:
+    return campo[1:] if campo.startswith('-') else f'-{campo}'
+
+
+def codificar_cursor(obj, ordenacao: Sequence[str], direcao: str) -> str:
+    """Gera o cursor assinado a partir da chave de ordenação de obj"""
+    return signing.dumps(
+        {'o': list(ordenacao), 'v': _valores_chave(obj, ordenacao), 'd': direcao},
+        salt=PAGINACAO_CONFIG['SALT'],
+        compress=True
+    )
+
+
+def decodificar_cursor(token: str, ordenacao: Sequence[str]) -> Optional[dict]:
+    """Retorna os dados do cursor ou None se for inválido ou de outra ordenação"""
+    try:
+        dados = signing.loads(token, salt=PAGINACAO_CONFIG['SALT'])
+    except signing.BadSignature:
+        return None
+    if dados.get('o') != list(ordenacao) or dados.get('d') not in ('n', 'p'):
+        return None
+    if len(dados.get('v', [])) != len(ordenacao):
+        return None
+    return dados
+
+
+def filtro_apos(ordenacao: Sequence[str], valores: Sequence) -> Q:
+    """Condição lexicográfica "vem depois de valores" na ordenação informada"""
+    condicao = Q()
+    iguais = {}
+    for campo, valor in zip(ordenacao, valores):
+        nome = campo.lstrip('-')
+        operador = 'lt' if campo.startswith('-') else 'gt'
+        condicao |= Q(**iguais, **{f'{nome}__{operador}': valor})
+        iguais[nome] = valor
+    return condicao
+
+
+def paginar(queryset: QuerySet, ordenacao: Sequence[str], tamanho: int,
+            cursor: Optional[str] = None, numero: int = 1) -> Pagina:
+    """
+    Pagina o queryset sem COUNT, buscando tamanho + 1 itens.
+
+    ordenacao deve terminar em um campo único (pk) para que a chave seja
+    estável. Com cursor válido usa keyset; sem cursor usa a página numerada.
+    """
+    dados = decodificar_cursor(cursor, ordenacao) if cursor else None
+
+    if dados is None:
+        inicio = (numero - 1) * tamanho
+        itens = list(queryset.order_by(*ordenacao)[inicio:inicio + tamanho + 1])
+        tem_proxima = len(itens) > tamanho
+        itens = itens[:tamanho]
+        return Pagina(
+            itens,
+            numero=numero,
+            proximo=codificar_cursor(itens[-1], ordenacao, 'n') if tem_proxima else None,
+            tem_proxima=tem_proxima,
+            tem_anterior=numero > 1,
+        )
+
+    if dados['d'] == 'p':
+        invertida = [_inverter(campo) for campo in ordenacao]
+        itens = list(
+            queryset.order_by(*invertida).filter(filtro_apos(invertida, dados['v']))[:tamanho + 1]
+        )
+        tem_anterior = len(itens) > tamanho
+        itens = itens[:tamanho]
+        itens.reverse()
+        tem_proxima = True
+    else:
+        itens = list(
+            queryset.order_by(*ordenacao).filter(filtro_apos(ordenacao, dados['v']))[:tamanho + 1]
+        )
+        tem_proxima = len(itens) > tamanho
+        itens = itens[:tamanho]
+        tem_anterior = True
+
+    if not itens:
+        return Pagina(itens, tem_anterior=tem_anterior)
+
+    return Pagina(
+        itens,
+        proximo=codificar_cursor(itens[-1], ordenacao, 'n') if tem_proxima else None,
+        anterior=codificar_cursor(itens[0], ordenacao, 'p') if tem_anterior else None,
+        tem_proxima=tem_proxima,
+        tem_anterior=tem_anterior,
+    )
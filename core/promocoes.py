@@ -0,0 +1,96 @@
+"""
+Agendador das fronteiras de promoção.
+
+Preço vigente, desconto, preço final de variação e preços do carrinho são
+cacheados por PRECO_CACHE_TIMEOUT. Para que uma promoção comece e termine
+no instante certo, o comando agendador_promocoes dorme até a próxima
+fronteira (promocao_inicio ou promocao_fim de Produto e ProdutoVariacao,
+ambos indexados) e, ao acordar, invalida somente os escopos de cache
+(core.cache) dos produtos e carrinhos afetados.
+
+Uma promoção vale enquanto inicio <= agora <= fim: o início é cruzado
+quando desde < inicio <= ate e o fim quando desde <= fim < ate.
+"""
+import logging
+from datetime import datetime
+from typing import Iterable, List, Optional, Set, Tuple
+
+from django.db.models import Min, Q
+
+from core.cache import invalidar_escopos, invalidar_namespace
+from core.models import ItemCarrinho, Produto, ProdutoVariacao
+
+logger = logging.getLogger(__name__)
+
+PROMOCOES_CONFIG = {
+    'INTERVALO_MAXIMO': 300,  # segundos; também pega promoções cadastradas durante a espera
+    'TOLERANCIA': 1,  # segundos após a fronteira, para o fim já ter passado
+}
+
+
+def proxima_fronteira(apos: datetime) -> Optional[datetime]:
+    """Retorna o próximo início ou fim de promoção depois de apos"""
+    fronteiras = []
+    for modelo in (Produto, ProdutoVariacao):
+        resultado = modelo.objects.filter(preco_promocional__isnull=False).aggregate(
+            inicio=Min('promocao_inicio', filter=Q(promocao_inicio__gt=apos)),
+            fim=Min('promocao_fim', filter=Q(promocao_fim__gte=apos)),
+        )
+        fronteiras.extend(valor for valor in resultado.values() if valor is not None)
+    return min(fronteiras) if fronteiras else None
+
+
+def _cruzadas(modelo, desde: datetime, ate: datetime) -> List[int]:
+    return list(
+        modelo.objects.filter(
+            Q(promocao_inicio__gt=desde, promocao_inicio__lte=ate)
+            | Q(promocao_fim__gte=desde, promocao_fim__lt=ate)
+        ).values_list('id', flat=True)
+    )
+
+
+def fronteiras_cruzadas(desde: datetime, ate: datetime) -> Tuple[Set[int], Set[int]]:
+    """Ids de produtos e variações cuja promoção começou ou terminou no intervalo"""
+    return set(_cruzadas(Produto, desde, ate)), set(_cruzadas(ProdutoVariacao, desde, ate))
+
+
+def escopos_afetados(produto_ids: Set[int], variacao_ids: Set[int]) -> Tuple[Set[int], Set[int]]:
+    """Produtos e usuários (carrinhos) cujos escopos de cache dependem dos produtos/variações"""
+    # O preço final da variação fica no escopo do seu produto
+    produto_ids = produto_ids | set(
+        ProdutoVariacao.objects.filter(id__in=variacao_ids).values_list('produto_id', flat=True)
+    )
+    usuario_ids = set(
+        ItemCarrinho.objects.filter(
+            Q(produto_id__in=produto_ids) | Q(variacao_id__in=variacao_ids)
+        ).values_list('carrinho__usuario_id', flat=True)
+    )
+    return produto_ids, usuario_ids
+
+
+def atualizar_descontos(produto_ids: Iterable[int], agora: datetime) -> None:
+    """Regrava Produto.desconto, que é gravado no save e ficaria defasado"""
+    produtos = list(
+        Produto.objects.filter(id__in=produto_ids).with_preco_vigente(agora).only('id', 'desconto')
+    )
+    for produto in produtos:
+        produto.desconto = produto.desconto_efetivo
+    Produto.objects.bulk_update(produtos, ['desconto'])
+
+
+def aplicar_fronteiras(desde: datetime, ate: datetime) -> int:
+    """Invalida o que mudou de preço entre desde e ate; retorna o total de escopos"""
+    produto_ids, variacao_ids = fronteiras_cruzadas(desde, ate)
+    if not produto_ids and not variacao_ids:
+        return 0
+
+    atualizar_descontos(produto_ids, ate)
+    escopos_produto, escopos_carrinho = escopos_afetados(produto_ids, variacao_ids)
+    invalidar_escopos('produto', escopos_produto)
+    invalidar_escopos('carrinho', escopos_carrinho)
+    invalidar_namespace('catalogo')
+    logger.info(
+        f"Fronteiras de promoção aplicadas: {len(produto_ids)} produtos, "
+        f"{len(variacao_ids)} variações, {len(escopos_carrinho)} carrinhos"
+    )
+    return len(escopos_produto) + len(escopos_carrinho)
@@ -0,0 +1,161 @@
+"""
+Rankings de mais vendidos e em alta.
+
+As chaves de ordenação ficam no próprio ProdutoCard (unidades_vendidas e
+tendencia, com índices junto de ativo), então sort=bestsellers e
+sort=trending na listagem são uma leitura indexada, sem GROUP BY em
+ItemPedido por requisição.
+
+A tendência decai com meia-vida fixa. Para não regravar todos os produtos
+a cada instante, cada venda soma quantidade * 2^((momento - época) / meia-vida):
+o decaimento até "agora" multiplicaria todos os scores pelo mesmo fator, o
+que não muda a ordem. Assim a venda de um pedido pago só soma nos seus
+produtos, e o comando recalcular_rankings refaz tudo (ex.: à noite).
+Uma venda não incrementa a geração 'catalogo': as listagens ordenadas por
+venda se atualizam quando o cache_page e o ETag da janela vencem, e
+reconstruir invalida o catálogo.
+
+O peso dobra a cada meia-vida e passa do maior float64 (2^1024) cerca de
+19,6 anos depois da época. Por isso a época fica em EpocaRankings e cada
+reconstruir a traz para o instante da reconstrução, regravando os scores
+já nessa escala; aplicar_pedido trava a mesma linha, então nunca soma um
+peso de uma época em scores de outra.
+
+Pedido.rankings_aplicado diz se o pedido já está nos scores. reconstruir
+o acerta para todos os pedidos e soma só os marcados, com a linha da época
+travada; aplicar_pedido só soma (ou subtrai) se consegue trocar a marca.
+Assim um pedido pago enquanto a reconstrução roda entra uma única vez.
+"""
+import logging
+from datetime import datetime, timezone as dt_timezone
+from typing import Dict, Optional
+
+import numpy as np
+from django.db import transaction
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from core.cache import invalidar_namespace
+from core.models import EpocaRankings, ItemPedido, Pedido, ProdutoCard
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+RANKINGS_CONFIG = {
+    'MEIA_VIDA_DIAS': 7,
+    # Época até a primeira reconstrução; a 7 dias de meia-vida o float64 comporta ~19,6 anos a partir dela
+    'EPOCA_INICIAL': datetime(2025, 1, 1, tzinfo=dt_timezone.utc),
+    'JANELA_DIAS': 180,  # pedidos mais antigos pesam menos que 2^-25 de um de hoje
+    'TAMANHO_LOTE': 1000,
+}
+
+
+def epoca_atual(travar: bool = False) -> datetime:
+    """Época dos scores gravados; travar=True segura a linha até o fim da transação"""
+    if travar:
+        # A linha é criada pela migração 0013; get_or_create cobre um banco limpo por flush
+        return EpocaRankings.objects.select_for_update().get_or_create(
+            pk=1, defaults={'epoca': RANKINGS_CONFIG['EPOCA_INICIAL']}
+        )[0].epoca
+    epoca = EpocaRankings.objects.filter(pk=1).values_list('epoca', flat=True).first()
+    return epoca or RANKINGS_CONFIG['EPOCA_INICIAL']
+
+
+def peso_tendencia(momento: datetime, epoca: Optional[datetime] = None) -> float:
+    """Peso de uma unidade vendida em momento, relativo à época dos scores"""
+    meia_vida = RANKINGS_CONFIG['MEIA_VIDA_DIAS'] * 86400
+    return float(2 ** ((momento - (epoca or epoca_atual())).total_seconds() / meia_vida))
+
+
+def reconstruir(agora: Optional[datetime] = None) -> dict:
+    """Recalcula unidades vendidas e tendência de todos os cards a partir dos pedidos pagos"""
+    agora = agora or timezone.now()
+    inicio = agora - timezone.timedelta(days=RANKINGS_CONFIG['JANELA_DIAS'])
+
+    with transaction.atomic():
+        epoca_atual(travar=True)
+        # Marca antes de somar: pedido pago depois da marcação fica para o seu aplicar_pedido
+        Pedido.objects.filter(status__in=Pedido.STATUS_PAGOS, rankings_aplicado=False).update(rankings_aplicado=True)
+        Pedido.objects.exclude(status__in=Pedido.STATUS_PAGOS).filter(rankings_aplicado=True).update(
+            rankings_aplicado=False
+        )
+        pagos = ItemPedido.objects.filter(pedido__rankings_aplicado=True)
+
+        unidades = dict(
+            pagos.values('produto_id').annotate(total=Sum('quantidade')).values_list('produto_id', 'total')
+        )
+        linhas = list(
+            pagos.filter(pedido__data_criacao__gte=inicio).values_list(
+                'produto_id', 'quantidade', 'pedido__data_criacao'
+            )
+        )
+        tendencia = {}
+        if linhas:
+            produto_ids, posicoes = np.unique(
+                np.array([linha[0] for linha in linhas], dtype=np.int64), return_inverse=True
+            )
+            # Época nova = agora: as vendas da janela pesam entre 2^-25 e 1
+            segundos = np.array([(linha[2] - agora).total_seconds() for linha in linhas], dtype=np.float64)
+            pesos = np.array([linha[1] for linha in linhas], dtype=np.float64) * np.exp2(
+                segundos / (RANKINGS_CONFIG['MEIA_VIDA_DIAS'] * 86400)
+            )
+            tendencia = dict(zip(produto_ids.tolist(), np.bincount(posicoes, weights=pesos).tolist()))
+
+        cards = [
+            ProdutoCard(produto_id=produto_id, unidades_vendidas=unidades.get(produto_id, 0),
+                        tendencia=tendencia.get(produto_id, 0.0))
+            for produto_id in ProdutoCard.objects.filter(
+                produto_id__in=set(unidades) | set(tendencia)
+            ).values_list('produto_id', flat=True)
+        ]
+        ProdutoCard.objects.exclude(unidades_vendidas=0, tendencia=0).update(unidades_vendidas=0, tendencia=0)
+        ProdutoCard.objects.bulk_update(
+            cards, ['unidades_vendidas', 'tendencia'], batch_size=RANKINGS_CONFIG['TAMANHO_LOTE']
+        )
+        EpocaRankings.objects.filter(pk=1).update(epoca=agora)
+    invalidar_namespace('catalogo')
+    return {'produtos': len(cards), 'unidades': sum(unidades.values())}
+
+
+def aplicar_pedido(pedido_id: int, delta: int, quantidades: Optional[Dict[int, int]] = None,
+                   momento: Optional[datetime] = None) -> None:
+    """
+    Soma (delta=1) ou subtrai (delta=-1) as unidades do pedido nos rankings
+    dos seus produtos. Pedido.rankings_aplicado, trocado com a época travada,
+    evita contar duas vezes um pedido que um reconstruir já somou.
+    """
+    with transaction.atomic():
+        epoca = epoca_atual(travar=True)
+        pedidos = Pedido.objects.filter(pk=pedido_id, rankings_aplicado=delta < 0)
+        if delta > 0:
+            pedidos = pedidos.filter(status__in=Pedido.STATUS_PAGOS)
+        if not pedidos.update(rankings_aplicado=delta > 0):
+            return  # Já aplicado (ou já retirado) por um reconstruir
+
+        if quantidades is None:
+            quantidades = dict(
+                ItemPedido.objects.filter(pedido_id=pedido_id).values('produto_id').annotate(
+                    total=Sum('quantidade')
+                ).values_list('produto_id', 'total')
+            )
+        if momento is None:
+            momento = Pedido.objects.filter(pk=pedido_id).values_list('data_criacao', flat=True).first()
+        if not quantidades or momento is None:
+            return
+
+        peso = peso_tendencia(momento, epoca)
+        for produto_id, quantidade in quantidades.items():
+            ProdutoCard.objects.filter(pk=produto_id).update(
+                unidades_vendidas=Greatest(F('unidades_vendidas') + delta * quantidade, Value(0)),
+                tendencia=Greatest(F('tendencia') + delta * quantidade * peso, Value(0.0)),
+            )
+
+
+def agendar_pedido(pedido_id: int, delta: int, quantidades: Optional[Dict[int, int]] = None,
+                   momento: Optional[datetime] = None) -> None:
+    """Aplica o pedido aos rankings após o commit (os itens são gravados depois do pedido)"""
+    apos_commit(
+        aplicar_pedido, pedido_id, delta, quantidades, momento,
+        erro=f"Erro ao atualizar rankings do pedido {pedido_id}"
+    )
@@ -0,0 +1,265 @@
+"""
+Recomendações "comprados juntos".
+
+A matriz pedido x produto dos pedidos pagos (Pedido.STATUS_PAGOS) é
+montada como matriz esparsa do SciPy, e X^T X dá, em uma operação, em
+quantos pedidos cada par de produtos aparece junto (a diagonal é o total
+de pedidos de cada produto). Os pares são pontuados por cosseno ou lift e
+os K melhores vizinhos de cada produto vão para ProdutoRelacionado, lidos
+com uma consulta indexada na página do produto e no carrinho.
+
+As contagens ficam em CoocorrenciaProduto (triângulo superior e
+diagonal), o que permite atualização incremental: quando um pedido entra
+ou sai dos status pagos, os pares dele são somados ou subtraídos e só os
+vizinhos dos seus produtos são recalculados. O comando
+calcular_recomendacoes refaz tudo a partir dos pedidos (ex.: à noite).
+"""
+import logging
+from typing import Iterable, List, Optional
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Q, Sum
+from scipy import sparse
+
+from core.cache import get_or_compute
+from core.models import CoocorrenciaProduto, ItemPedido, Pedido, ProdutoCard, ProdutoRelacionado
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+RECOMENDACOES_CONFIG = {
+    'TOP_K': 12,
+    'METRICA': 'cosseno',  # 'cosseno' ou 'lift'
+    'MIN_COOCORRENCIAS': 2,  # pares mais raros que isso são ruído
+    'TAMANHO_LOTE': 5000,
+    'PREFIXO_CACHE': 'relacionados_',
+    'TIMEOUT': 60 * 60,  # 1 hora; regravar os vizinhos invalida antes
+    'LIMITE_EXIBICAO': 8,
+}
+
+TIPO = 'comprados_juntos'
+
+_SQL_SOMAR_PARES = """
+    INSERT INTO {tabela} (produto_a_id, produto_b_id, pedidos)
+    SELECT a.id, b.id, GREATEST(%s, 0)
+    FROM unnest(%s::bigint[]) AS a(id)
+    JOIN unnest(%s::bigint[]) AS b(id) ON a.id <= b.id
+    ON CONFLICT (produto_a_id, produto_b_id)
+    DO UPDATE SET pedidos = GREATEST({tabela}.pedidos + %s, 0)
+"""
+
+
+def pontuar(coocorrencias, suporte_a, suporte_b, total_pedidos: int, metrica: Optional[str] = None) -> np.ndarray:
+    """Pontua pares (vetorizado): cosseno = c/sqrt(sa*sb); lift = c*N/(sa*sb)"""
+    metrica = metrica or RECOMENDACOES_CONFIG['METRICA']
+    coocorrencias = np.asarray(coocorrencias, dtype=np.float64)
+    produto_suportes = np.maximum(
+        np.asarray(suporte_a, dtype=np.float64) * np.asarray(suporte_b, dtype=np.float64), 1.0
+    )
+    if metrica == 'lift':
+        return coocorrencias * max(total_pedidos, 1) / produto_suportes
+    return coocorrencias / np.sqrt(produto_suportes)
+
+
+def _melhores(indices: np.ndarray, scores: np.ndarray, top_k: int) -> List[tuple]:
+    """(índice, score) dos top_k maiores scores, do melhor para o pior"""
+    if len(scores) > top_k:
+        escolhidos = np.argpartition(-scores, top_k - 1)[:top_k]
+        indices, scores = indices[escolhidos], scores[escolhidos]
+    ordem = np.lexsort((indices, -scores))
+    return [(int(indices[i]), float(scores[i])) for i in ordem]
+
+
+def invalidar_relacionados(produto_ids: Iterable[int], tipo: str = TIPO) -> None:
+    cache.delete_many([f"{RECOMENDACOES_CONFIG['PREFIXO_CACHE']}{tipo}_{produto_id}" for produto_id in produto_ids])
+
+
+def gravar_vizinhos(vizinhos: dict, tipo: str = TIPO, substituir_tudo: bool = False) -> int:
+    """Regrava {produto_id: [(relacionado_id, score), ...]} em ProdutoRelacionado"""
+    linhas = [
+        ProdutoRelacionado(produto_id=produto_id, relacionado_id=relacionado_id, tipo=tipo, posicao=posicao, score=score)
+        for produto_id, lista in vizinhos.items()
+        for posicao, (relacionado_id, score) in enumerate(lista)
+    ]
+    with transaction.atomic():
+        antigos = ProdutoRelacionado.objects.filter(tipo=tipo)
+        if not substituir_tudo:
+            antigos = antigos.filter(produto_id__in=list(vizinhos))
+        antigos.delete()
+        ProdutoRelacionado.objects.bulk_create(linhas, batch_size=RECOMENDACOES_CONFIG['TAMANHO_LOTE'])
+    invalidar_relacionados(vizinhos, tipo)
+    return len(linhas)
+
+
+def _matriz_pedidos():
+    """Matriz esparsa binária pedido x produto dos pedidos pagos e o id de cada coluna"""
+    pares = ItemPedido.objects.filter(
+        pedido__status__in=Pedido.STATUS_PAGOS
+    ).values_list('pedido_id', 'produto_id').distinct().iterator(chunk_size=RECOMENDACOES_CONFIG['TAMANHO_LOTE'])
+    pedidos, produtos = [], []
+    for pedido_id, produto_id in pares:
+        pedidos.append(pedido_id)
+        produtos.append(produto_id)
+
+    pedido_ids, linhas = np.unique(np.array(pedidos, dtype=np.int64), return_inverse=True)
+    produto_ids, colunas = np.unique(np.array(produtos, dtype=np.int64), return_inverse=True)
+    matriz = sparse.csr_matrix(
+        (np.ones(len(linhas), dtype=np.int32), (linhas, colunas)),
+        shape=(len(pedido_ids), len(produto_ids)),
+    )
+    return matriz, produto_ids
+
+
+def reconstruir(top_k: Optional[int] = None, minimo: Optional[int] = None, metrica: Optional[str] = None) -> dict:
+    """Recalcula coocorrências e vizinhos de todos os produtos a partir dos pedidos pagos"""
+    top_k = top_k or RECOMENDACOES_CONFIG['TOP_K']
+    minimo = minimo or RECOMENDACOES_CONFIG['MIN_COOCORRENCIAS']
+
+    matriz, produto_ids = _matriz_pedidos()
+    total_pedidos = matriz.shape[0]
+    coocorrencias = (matriz.T @ matriz).tocsr()
+    suporte = coocorrencias.diagonal()
+
+    # Contagens persistidas (triângulo superior com diagonal) para as atualizações incrementais
+    triangulo = sparse.triu(coocorrencias).tocoo()
+    with transaction.atomic():
+        CoocorrenciaProduto.objects.all().delete()
+        CoocorrenciaProduto.objects.bulk_create(
+            (
+                CoocorrenciaProduto(produto_a_id=int(produto_ids[a]), produto_b_id=int(produto_ids[b]), pedidos=int(total))
+                for a, b, total in zip(triangulo.row, triangulo.col, triangulo.data)
+            ),
+            batch_size=RECOMENDACOES_CONFIG['TAMANHO_LOTE'],
+        )
+
+    # Vizinhos: fora a diagonal e os pares abaixo do mínimo, pontuados de uma vez
+    coocorrencias.setdiag(0)
+    coocorrencias.data[coocorrencias.data < minimo] = 0
+    coocorrencias.eliminate_zeros()
+    linhas = np.repeat(np.arange(coocorrencias.shape[0]), np.diff(coocorrencias.indptr))
+    scores = pontuar(
+        coocorrencias.data, suporte[linhas], suporte[coocorrencias.indices], total_pedidos, metrica
+    )
+
+    vizinhos = {}
+    for linha in range(coocorrencias.shape[0]):
+        inicio, fim = coocorrencias.indptr[linha], coocorrencias.indptr[linha + 1]
+        if inicio == fim:
+            continue
+        vizinhos[int(produto_ids[linha])] = [
+            (int(produto_ids[coluna]), score)
+            for coluna, score in _melhores(coocorrencias.indices[inicio:fim], scores[inicio:fim], top_k)
+        ]
+
+    total = gravar_vizinhos(vizinhos, substituir_tudo=True)
+    invalidar_relacionados(produto_ids.tolist())
+    return {'pedidos': total_pedidos, 'produtos': len(produto_ids), 'pares': triangulo.nnz, 'vizinhos': total}
+
+
+def recalcular_vizinhos(produto_ids: Iterable[int], top_k: Optional[int] = None,
+                        minimo: Optional[int] = None, metrica: Optional[str] = None) -> int:
+    """Recalcula os vizinhos dos produtos informados a partir de CoocorrenciaProduto"""
+    ids = set(produto_ids)
+    if not ids:
+        return 0
+    top_k = top_k or RECOMENDACOES_CONFIG['TOP_K']
+    minimo = minimo or RECOMENDACOES_CONFIG['MIN_COOCORRENCIAS']
+    total_pedidos = Pedido.objects.filter(status__in=Pedido.STATUS_PAGOS).count()
+
+    pares = list(
+        CoocorrenciaProduto.objects.filter(
+            Q(produto_a_id__in=ids) | Q(produto_b_id__in=ids),
+            pedidos__gte=minimo,
+        ).exclude(produto_a_id=F('produto_b_id')).values_list('produto_a_id', 'produto_b_id', 'pedidos')
+    )
+    envolvidos = ids | {a for a, _, _ in pares} | {b for _, b, _ in pares}
+    suporte = dict(
+        CoocorrenciaProduto.objects.filter(
+            produto_a_id__in=envolvidos, produto_b_id=F('produto_a_id')
+        ).values_list('produto_a_id', 'pedidos')
+    )
+
+    candidatos = {produto_id: [] for produto_id in ids}
+    for a, b, total in pares:
+        if a in ids:
+            candidatos[a].append((b, total))
+        if b in ids:
+            candidatos[b].append((a, total))
+
+    vizinhos = {}
+    for produto_id, lista in candidatos.items():
+        if not lista:
+            vizinhos[produto_id] = []
+            continue
+        outros = np.array([outro for outro, _ in lista], dtype=np.int64)
+        scores = pontuar(
+            [total for _, total in lista],
+            np.full(len(lista), suporte.get(produto_id, 0)),
+            [suporte.get(outro, 0) for outro in outros],
+            total_pedidos,
+            metrica,
+        )
+        vizinhos[produto_id] = _melhores(outros, scores, top_k)
+
+    return gravar_vizinhos(vizinhos)
+
+
+def aplicar_pedido(pedido_id: int, delta: int, produto_ids: Optional[Iterable[int]] = None) -> None:
+    """Soma (delta=1) ou subtrai (delta=-1) os pares de um pedido e recalcula seus produtos"""
+    if produto_ids is None:
+        produto_ids = ItemPedido.objects.filter(pedido_id=pedido_id).values_list('produto_id', flat=True)
+    produto_ids = sorted(set(produto_ids))
+    if not produto_ids:
+        return
+    tabela = connection.ops.quote_name(CoocorrenciaProduto._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(_SQL_SOMAR_PARES.format(tabela=tabela), [delta, produto_ids, produto_ids, delta])
+        CoocorrenciaProduto.objects.filter(produto_a_id__in=produto_ids, pedidos=0).delete()
+    recalcular_vizinhos(produto_ids)
+
+
+def agendar_pedido(pedido_id: int, delta: int, produto_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Aplica o pedido às coocorrências após o commit (os itens são gravados
+    depois do pedido); produto_ids é usado quando os itens não existirão mais.
+    """
+    produto_ids = list(produto_ids) if produto_ids is not None else None
+    apos_commit(
+        aplicar_pedido, pedido_id, delta, produto_ids,
+        erro=f"Erro ao atualizar recomendações do pedido {pedido_id}"
+    )
+
+
+def obter_relacionados(produto_id: int, tipo: str = TIPO, limite: Optional[int] = None) -> List[ProdutoCard]:
+    """Cards dos vizinhos do produto, na ordem gravada, com cache"""
+    limite = limite or RECOMENDACOES_CONFIG['LIMITE_EXIBICAO']
+    cache_key = f"{RECOMENDACOES_CONFIG['PREFIXO_CACHE']}{tipo}_{produto_id}"
+
+    def _calcular():
+        return list(
+            ProdutoCard.objects.filter(
+                produto__relacionado_em__produto_id=produto_id,
+                produto__relacionado_em__tipo=tipo,
+                ativo=True,
+            ).with_preco_vigente().order_by('produto__relacionado_em__posicao')[:RECOMENDACOES_CONFIG['TOP_K']]
+        )
+
+    return get_or_compute(cache_key, _calcular, RECOMENDACOES_CONFIG['TIMEOUT'])[:limite]
+
+
+def relacionados_carrinho(produto_ids: Iterable[int], tipo: str = TIPO, limite: Optional[int] = None) -> List[ProdutoCard]:
+    """Cards mais associados ao conjunto de produtos (ex.: carrinho), fora os próprios"""
+    ids = list(set(produto_ids))
+    if not ids:
+        return []
+    return list(
+        ProdutoCard.objects.filter(
+            produto__relacionado_em__produto_id__in=ids,
+            produto__relacionado_em__tipo=tipo,
+            ativo=True,
+        ).exclude(produto_id__in=ids).annotate(
+            pontuacao=Sum('produto__relacionado_em__score')
+        ).with_preco_vigente().order_by('-pontuacao', 'pk')[:limite or RECOMENDACOES_CONFIG['LIMITE_EXIBICAO']]
+    )
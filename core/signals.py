@@ -1,27 +1,29 @@
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed, post_init
 from django.dispatch import receiver
-from core.models import ItemPedido, ProdutoVariacao, Pedido
+from core.models import (
+    ItemPedido, ProdutoVariacao, Pedido, Produto, Categoria, Marca, Tag, AtributoValor,
+    ImagemProduto, AvaliacaoProduto
+)
+from core import (
+    avaliacoes, busca, cards, categorias, facetas, imagens, midia, rankings, recomendacoes, similares,
+    sugestoes, variacoes
+)
+from core.cache import CACHE_CONFIG, invalidar_namespace, invalidar_tags, tags_da_instancia
 from django.core.mail import send_mail
 from django.contrib.auth.signals import user_logged_in
 from user.models import Notificacao
 from django.core.cache import cache
 from django.conf import settings
 import logging
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from django.db.models import F, Q
-from functools import lru_cache
+from django.db.models import F, Q, Sum
 import asyncio
 from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
 
-# Cache para variações
-@lru_cache(maxsize=1000)
-def get_variacao_cache(variacao_id):
-    return ProdutoVariacao.objects.select_related('produto').get(id=variacao_id)
-
 # Diminui o estoque da variação ao criar um item de pedido
 @receiver(post_save, sender=ItemPedido)
 def diminuir_estoque_variacao(sender, instance, created, **kwargs):
@@ -43,15 +45,13 @@ def diminuir_estoque_variacao(sender, instance, created, **kwargs):
                     ProdutoVariacao.objects.filter(id=variacao.id).update(
                         estoque=F('estoque') - instance.quantidade
                     )
+                    facetas.agendar_atualizacao([variacao.produto_id])
+                    cards.agendar_atualizacao([variacao.produto_id])
+                    variacoes.agendar_invalidacao([variacao.produto_id])
                     
-                    # Invalidar caches em batch
-                    cache_keys = [
-                        f'variacao_{variacao.id}',
-                        f'produto_{variacao.produto.id}',
-                        'produtos_ativos',
-                        'estoque_total'
-                    ]
-                    cache.delete_many(cache_keys)
+                    invalidar_namespace('variacao', variacao.id)
+                    invalidar_namespace('produto', variacao.produto_id)
+                    # 'catalogo' só muda se o card mudar na listagem (ex.: estoque zerado)
                     
             except Exception as e:
                 logger.error(f"Erro ao diminuir estoque: {str(e)}")
@@ -71,15 +71,13 @@ def devolver_estoque_variacao(sender, instance, **kwargs):
                 ).update(
                     estoque=F('estoque') + instance.quantidade
                 )
+                facetas.agendar_atualizacao([variacao.produto_id])
+                cards.agendar_atualizacao([variacao.produto_id])
+                variacoes.agendar_invalidacao([variacao.produto_id])
                 
-                # Invalidar caches em batch
-                cache_keys = [
-                    f'variacao_{variacao.id}',
-                    f'produto_{variacao.produto.id}',
-                    'produtos_ativos',
-                    'estoque_total'
-                ]
-                cache.delete_many(cache_keys)
+                invalidar_namespace('variacao', variacao.id)
+                invalidar_namespace('produto', variacao.produto_id)
+                # 'catalogo' só muda se o card mudar na listagem (ex.: estoque zerado)
                 
         except Exception as e:
             logger.error(f"Erro ao devolver estoque: {str(e)}")
@@ -171,13 +169,330 @@ def migrar_carrinho_ao_login(sender, user, request, **kwargs):
                 # Usar bulk_create para melhor performance
                 migrar_carrinho_sessao_para_banco(request)
                 
-                # Invalidar caches relacionados
-                cache_keys = [
-                    f'carrinho_{request.user.id}',
-                    'carrinhos_ativos',
-                    f'itens_carrinho_{request.user.id}'
-                ]
-                cache.delete_many(cache_keys)
+                # bulk_create/bulk_update não disparam os signals de ItemCarrinho
+                invalidar_namespace('carrinho', request.user.id)
                 
         except Exception as e:
-            logger.error(f"Erro ao migrar carrinho: {str(e)}")
\ No newline at end of file
+            logger.error(f"Erro ao migrar carrinho: {str(e)}")
+
+
+# Mantém os índices derivados de produto (busca, facetas e cards) atualizados
+@receiver(post_save, sender=Produto)
+def atualizar_indices_produto(sender, instance, created, **kwargs):
+    busca.agendar_atualizacao([instance.id])
+    cards.agendar_atualizacao([instance.id])
+    if not created:
+        facetas.agendar_atualizacao([instance.id])
+
+@receiver(post_save, sender=ProdutoVariacao)
+@receiver(post_delete, sender=ProdutoVariacao)
+def atualizar_indices_variacao(sender, instance, **kwargs):
+    busca.agendar_atualizacao([instance.produto_id])
+    facetas.agendar_atualizacao([instance.produto_id])
+    cards.agendar_atualizacao([instance.produto_id])
+    variacoes.agendar_invalidacao([instance.produto_id])
+
+@receiver(m2m_changed, sender=ProdutoVariacao.atributos.through)
+def atualizar_indices_atributos_variacao(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        produto_ids = [instance.produto_id]
+        alteradas = [instance]
+    else:
+        alteradas = list(ProdutoVariacao.objects.filter(id__in=pk_set or []))
+        produto_ids = [variacao.produto_id for variacao in alteradas]
+        transaction.on_commit(facetas.invalidar_indice)
+    # Mantém o atributos_hash (usado no clean e no índice unique_produto_atributos) em dia;
+    # combinação repetida vira ValidationError e desfaz a alteração do M2M
+    for variacao in alteradas:
+        atributos_hash = ProdutoVariacao.validar_combinacao(
+            variacao.produto_id, variacao.atributos.values_list('id', flat=True), variacao.pk
+        )
+        try:
+            with transaction.atomic():
+                ProdutoVariacao.objects.filter(pk=variacao.pk).update(atributos_hash=atributos_hash)
+        except IntegrityError:
+            # Outra transação gravou a mesma combinação depois da validação
+            raise ValidationError("Já existe uma variação com essa combinação de atributos para este produto.")
+    busca.agendar_atualizacao(produto_ids)
+    facetas.agendar_atualizacao(produto_ids)
+    cards.agendar_atualizacao(produto_ids)
+    variacoes.agendar_invalidacao(produto_ids)
+
+@receiver(m2m_changed, sender=Produto.tags.through)
+def indexar_tags_produto(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        busca.agendar_atualizacao([instance.pk])
+    elif pk_set:
+        busca.agendar_atualizacao(pk_set)
+
+@receiver(post_save, sender=Categoria)
+@receiver(post_save, sender=Marca)
+def indexar_produtos_da_classificacao(sender, instance, created, **kwargs):
+    if not created:
+        busca.agendar_atualizacao(instance.produtos.values_list('id', flat=True))
+
+@receiver(post_save, sender=Tag)
+def indexar_produtos_da_tag(sender, instance, created, **kwargs):
+    if not created:
+        busca.agendar_atualizacao(instance.produtos.values_list('id', flat=True))
+
+@receiver(post_save, sender=AtributoValor)
+def atualizar_indices_atributo(sender, instance, created, **kwargs):
+    transaction.on_commit(facetas.invalidar_indice)
+    if not created:
+        produto_ids = list(
+            Produto.objects.filter(variacoes__atributos=instance).values_list('id', flat=True).distinct()
+        )
+        busca.agendar_atualizacao(produto_ids)
+        cards.agendar_atualizacao(produto_ids)
+        variacoes.agendar_invalidacao(produto_ids)
+
+@receiver(post_delete, sender=AtributoValor)
+def invalidar_facetas_atributo(sender, instance, **kwargs):
+    transaction.on_commit(facetas.invalidar_indice)
+
+@receiver(post_save, sender=ImagemProduto)
+@receiver(post_delete, sender=ImagemProduto)
+@receiver(post_save, sender=AvaliacaoProduto)
+@receiver(post_delete, sender=AvaliacaoProduto)
+def atualizar_card_produto(sender, instance, **kwargs):
+    cards.agendar_atualizacao([instance.produto_id])
+
+
+# Mantém a árvore de categorias e os totais por subárvore
+@receiver(post_init, sender=Produto)
+def guardar_estado_categoria_produto(sender, instance, **kwargs):
+    instance._estado_categoria = (
+        instance.__dict__.get('categoria_id'),
+        instance.__dict__.get('ativo', False),
+    )
+
+@receiver(post_save, sender=Produto)
+def ajustar_totais_categoria_produto(sender, instance, created, **kwargs):
+    categoria_anterior, ativo_anterior = (None, False) if created else instance._estado_categoria
+    if (categoria_anterior, ativo_anterior) != (instance.categoria_id, instance.ativo):
+        if ativo_anterior:
+            categorias.ajustar_total(categoria_anterior, -1)
+        if instance.ativo:
+            categorias.ajustar_total(instance.categoria_id, 1)
+    instance._estado_categoria = (instance.categoria_id, instance.ativo)
+
+@receiver(post_delete, sender=Produto)
+def ajustar_totais_categoria_produto_removido(sender, instance, **kwargs):
+    if instance.ativo:
+        categorias.ajustar_total(instance.categoria_id, -1)
+
+@receiver(post_init, sender=Categoria)
+def guardar_pai_categoria(sender, instance, **kwargs):
+    instance._pai_anterior = instance.__dict__.get('categoria_pai_id')
+
+@receiver(post_save, sender=Categoria)
+def atualizar_arvore_categoria(sender, instance, created, **kwargs):
+    if created:
+        categorias.inserir_categoria(instance)
+    elif instance._pai_anterior != instance.categoria_pai_id:
+        categorias.reconstruir_arvore()
+    else:
+        categorias.invalidar_arvore()
+    instance._pai_anterior = instance.categoria_pai_id
+
+@receiver(post_delete, sender=Categoria)
+def reconstruir_arvore_categoria_removida(sender, instance, **kwargs):
+    # Subcategorias ficam sem pai (SET_NULL) sem disparar save
+    transaction.on_commit(categorias.reconstruir_arvore)
+
+
+# Mantém os agregados de avaliação do produto (só avaliações aprovadas contam)
+@receiver(post_init, sender=AvaliacaoProduto)
+def guardar_estado_avaliacao(sender, instance, **kwargs):
+    instance._estado_avaliacao = (
+        instance.__dict__.get('produto_id'),
+        instance.__dict__.get('aprovada', False),
+        instance.__dict__.get('nota'),
+    )
+
+@receiver(post_save, sender=AvaliacaoProduto)
+def ajustar_agregados_avaliacao(sender, instance, created, **kwargs):
+    anterior = (None, False, None) if created else instance._estado_avaliacao
+    atual = (instance.produto_id, instance.aprovada, instance.nota)
+    if anterior != atual:
+        produto_anterior, aprovada_anterior, nota_anterior = anterior
+        if aprovada_anterior:
+            avaliacoes.ajustar_agregados(produto_anterior, nota_anterior, -1)
+        if instance.aprovada:
+            avaliacoes.ajustar_agregados(instance.produto_id, instance.nota, 1)
+    instance._estado_avaliacao = atual
+
+@receiver(post_delete, sender=AvaliacaoProduto)
+def ajustar_agregados_avaliacao_removida(sender, instance, **kwargs):
+    produto_id, aprovada, nota = instance._estado_avaliacao
+    if aprovada:
+        avaliacoes.ajustar_agregados(produto_id, nota, -1)
+
+
+# Nomes que aparecem no autocomplete da busca: só os campos lidos pelo índice invalidam
+_CAMPOS_SUGESTOES = {
+    Produto: ('nome', 'ativo', 'marca_id'),  # a marca pesa pelo número de produtos
+    Categoria: ('nome', 'ativo'),
+    Marca: ('nome', 'ativo'),
+    Tag: ('nome',),
+}
+
+def _campos_sugestoes(instance):
+    return tuple(instance.__dict__.get(campo) for campo in _CAMPOS_SUGESTOES[type(instance)])
+
+@receiver(post_init, sender=Produto)
+@receiver(post_init, sender=Categoria)
+@receiver(post_init, sender=Marca)
+@receiver(post_init, sender=Tag)
+def guardar_campos_sugestoes(sender, instance, **kwargs):
+    instance._campos_sugestoes = _campos_sugestoes(instance)
+
+@receiver(post_save, sender=Produto)
+@receiver(post_save, sender=Categoria)
+@receiver(post_save, sender=Marca)
+@receiver(post_save, sender=Tag)
+def invalidar_sugestoes(sender, instance, created, **kwargs):
+    atuais = _campos_sugestoes(instance)
+    if created or atuais != instance._campos_sugestoes:
+        sugestoes.agendar_invalidacao()
+    instance._campos_sugestoes = atuais
+
+@receiver(post_delete, sender=Produto)
+@receiver(post_delete, sender=Categoria)
+@receiver(post_delete, sender=Marca)
+@receiver(post_delete, sender=Tag)
+def invalidar_sugestoes_removido(sender, instance, **kwargs):
+    sugestoes.agendar_invalidacao()
+
+
+# Derivadas de imagem (card, galeria e zoom em WebP/JPEG), geradas fora da requisição
+def _nome_imagem(instance):
+    campo = instance.logo if isinstance(instance, Marca) else instance.imagem
+    return campo.name if campo else None
+
+@receiver(post_save, sender=Produto)
+@receiver(post_save, sender=ImagemProduto)
+@receiver(post_save, sender=Marca)
+def gerar_derivadas_imagem(sender, instance, **kwargs):
+    imagens.agendar_derivadas([_nome_imagem(instance)])
+
+@receiver(post_delete, sender=Marca)
+def remover_derivadas_logo(sender, instance, **kwargs):
+    # Imagens de produto são apagadas pela contagem de referências (core.midia)
+    nome = _nome_imagem(instance)
+    if nome:
+        transaction.on_commit(lambda: imagens.remover_derivadas(nome))
+
+
+# Contagem de referências dos arquivos de imagem endereçados por conteúdo
+def _nome_arquivo(valor):
+    return getattr(valor, 'name', valor) or None
+
+@receiver(post_init, sender=Produto)
+@receiver(post_init, sender=ImagemProduto)
+def guardar_imagem_anterior(sender, instance, **kwargs):
+    instance._imagem_anterior = _nome_arquivo(instance.__dict__.get('imagem'))
+
+@receiver(post_save, sender=Produto)
+@receiver(post_save, sender=ImagemProduto)
+def ajustar_referencias_imagem(sender, instance, created, **kwargs):
+    if 'imagem' not in instance.__dict__:
+        return  # campo adiado e não alterado
+    anterior = None if created else instance._imagem_anterior
+    atual = _nome_arquivo(instance.imagem)
+    if anterior != atual:
+        midia.adicionar_referencia(atual)
+        midia.remover_referencia(anterior)
+    else:
+        midia.descartar_reserva(atual)  # mesmo arquivo enviado de novo
+    instance._imagem_anterior = atual
+
+@receiver(post_delete, sender=Produto)
+@receiver(post_delete, sender=ImagemProduto)
+def remover_referencia_imagem(sender, instance, **kwargs):
+    midia.remover_referencia(instance._imagem_anterior)
+
+
+# Coocorrências de "comprados juntos" e rankings de vendas: o pedido conta enquanto
+# está em Pedido.STATUS_PAGOS
+@receiver(post_init, sender=Pedido)
+def guardar_status_pedido(sender, instance, **kwargs):
+    instance._status_anterior = instance.__dict__.get('status')
+
+@receiver(post_save, sender=Pedido)
+def atualizar_coocorrencias_pedido(sender, instance, created, **kwargs):
+    pago_antes = not created and instance._status_anterior in Pedido.STATUS_PAGOS
+    pago_agora = instance.status in Pedido.STATUS_PAGOS
+    if pago_antes != pago_agora:
+        recomendacoes.agendar_pedido(instance.pk, 1 if pago_agora else -1)
+        rankings.agendar_pedido(instance.pk, 1 if pago_agora else -1)
+    instance._status_anterior = instance.status
+
+@receiver(pre_delete, sender=Pedido)
+def remover_coocorrencias_pedido(sender, instance, **kwargs):
+    # Os itens são apagados em cascata antes do commit; guarda os produtos agora
+    if instance._status_anterior in Pedido.STATUS_PAGOS:
+        quantidades = dict(
+            instance.itens.values('produto_id').annotate(total=Sum('quantidade')).values_list('produto_id', 'total')
+        )
+        recomendacoes.agendar_pedido(instance.pk, -1, quantidades)
+        # Na transação da remoção, enquanto a marca rankings_aplicado ainda existe
+        rankings.aplicar_pedido(instance.pk, -1, quantidades, instance.data_criacao)
+
+
+# Similares por conteúdo: só mudanças nas características do vetor marcam o produto para recálculo
+def _caracteristicas_produto(instance):
+    return tuple(
+        instance.__dict__.get(campo) for campo in ('categoria_id', 'marca_id', 'genero', 'temporada', 'ativo')
+    )
+
+@receiver(post_init, sender=Produto)
+def guardar_caracteristicas_produto(sender, instance, **kwargs):
+    instance._caracteristicas = _caracteristicas_produto(instance)
+
+@receiver(post_save, sender=Produto)
+def atualizar_similares_produto(sender, instance, created, **kwargs):
+    atuais = _caracteristicas_produto(instance)
+    if created or atuais != instance._caracteristicas:
+        similares.marcar_pendentes([instance.pk])
+    instance._caracteristicas = atuais
+
+@receiver(m2m_changed, sender=Produto.tags.through)
+def atualizar_similares_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        similares.marcar_pendentes([instance.pk])
+    elif pk_set:
+        similares.marcar_pendentes(pk_set)
+
+@receiver(m2m_changed, sender=ProdutoVariacao.atributos.through)
+def atualizar_similares_atributos(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        similares.marcar_pendentes([instance.produto_id])
+    else:
+        similares.marcar_pendentes(
+            ProdutoVariacao.objects.filter(id__in=pk_set or []).values_list('produto_id', flat=True)
+        )
+
+@receiver(post_delete, sender=ProdutoVariacao)
+def atualizar_similares_variacao_removida(sender, instance, **kwargs):
+    similares.marcar_pendentes([instance.produto_id])
+
+
+# Invalida as tags de cache do objeto alterado (core.cache, TAGS_MODELOS); inclui deletes em cascata
+def invalidar_tags_modelo(sender, instance, **kwargs):
+    invalidar_tags(tags_da_instancia(instance))
+
+
+for _modelo in CACHE_CONFIG['TAGS_MODELOS']:
+    post_save.connect(invalidar_tags_modelo, sender=_modelo, dispatch_uid=f'invalidar_tags_{_modelo}')
+    post_delete.connect(invalidar_tags_modelo, sender=_modelo, dispatch_uid=f'invalidar_tags_{_modelo}')
+
@@ -0,0 +1,289 @@
+"""
+Produtos similares por conteúdo.
+
+Serve também para produtos sem histórico de vendas: cada produto ativo vira
+um vetor esparso de características já cadastradas (categoria e categoria
+pai, marca, gênero, temporada, tags e os AtributoValor das variações), com
+peso por grupo e IDF, para que características raras pesem mais que as
+comuns. Com as linhas normalizadas, a similaridade de cosseno é um produto
+matricial, calculado em blocos de linhas para limitar a memória; os K
+melhores de cada produto vão para ProdutoRelacionado (tipo 'similares') e
+são lidos por core.recomendacoes.obter_relacionados.
+
+Os signals só marcam os produtos alterados em SimilarPendente, na mesma
+transação da alteração; nada é calculado na requisição. O comando
+calcular_similares --pendentes (agendado) recalcula os marcados e os que os
+têm como vizinhos, relendo do banco só as linhas deles na matriz guardada no
+cache; sem a opção, refaz o catálogo inteiro. Os dois seguram o mesmo lock,
+então só um processo grava a matriz por vez.
+"""
+import logging
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from django.core.cache import cache
+from django.db import transaction
+from scipy import sparse
+
+from core.models import Produto, ProdutoRelacionado, ProdutoVariacao, SimilarPendente
+from core.recomendacoes import gravar_vizinhos
+
+logger = logging.getLogger(__name__)
+
+SIMILARES_CONFIG = {
+    'TOP_K': 12,
+    # Peso de cada grupo de características antes do IDF
+    'PESOS': {
+        'categoria': 3.0,
+        'categoria_pai': 1.0,
+        'marca': 1.5,
+        'genero': 1.0,
+        'temporada': 1.0,
+        'tag': 1.0,
+        'atributo': 0.5,
+    },
+    'TAMANHO_BLOCO': 1000,  # linhas por bloco no produto matricial
+    'SCORE_MINIMO': 0.05,
+    'CHAVE_MATRIZ': 'similares_matriz',
+    'TIMEOUT_MATRIZ': 60 * 60 * 24,  # o comando calcular_similares revetoriza tudo (e refaz o IDF)
+    'CHAVE_LOCK': 'similares_matriz_lock',
+    'TIMEOUT_LOCK': 60 * 30,  # cobre a vetorização completa; some sozinho se o processo morrer
+}
+
+TIPO = 'similares'
+
+
+def _caracteristicas(produto_ids: Optional[Iterable[int]] = None) -> Tuple[np.ndarray, List[tuple]]:
+    """Ids dos produtos ativos (todos ou só os informados) e as (produto_id, grupo, valor) de cada um"""
+    produtos = Produto.objects.filter(ativo=True)
+    tags = Produto.tags.through.objects.filter(produto__ativo=True)
+    atributos = ProdutoVariacao.atributos.through.objects.filter(produtovariacao__produto__ativo=True)
+    if produto_ids is not None:
+        produto_ids = list(produto_ids)
+        produtos = produtos.filter(id__in=produto_ids)
+        tags = tags.filter(produto_id__in=produto_ids)
+        atributos = atributos.filter(produtovariacao__produto_id__in=produto_ids)
+
+    ids, caracteristicas = [], []
+    for produto_id, categoria_id, categoria_pai_id, marca_id, genero, temporada in produtos.order_by('id').values_list(
+        'id', 'categoria_id', 'categoria__categoria_pai_id', 'marca_id', 'genero', 'temporada'
+    ):
+        ids.append(produto_id)
+        caracteristicas += [
+            (produto_id, 'categoria', categoria_id),
+            (produto_id, 'categoria_pai', categoria_pai_id),
+            (produto_id, 'marca', marca_id),
+            (produto_id, 'genero', genero),
+            (produto_id, 'temporada', temporada),
+        ]
+    caracteristicas += [(produto_id, 'tag', tag_id) for produto_id, tag_id in tags.values_list('produto_id', 'tag_id')]
+    caracteristicas += [
+        (produto_id, 'atributo', valor_id)
+        for produto_id, valor_id in atributos.values_list('produtovariacao__produto_id', 'atributovalor_id').distinct()
+    ]
+    return np.array(ids, dtype=np.int64), caracteristicas
+
+
+def _montar(produto_ids: np.ndarray, caracteristicas: List[tuple], colunas: dict) -> sparse.csr_matrix:
+    """Matriz com o peso de grupo de cada característica; as novas ganham coluna em `colunas`"""
+    pesos_grupo = SIMILARES_CONFIG['PESOS']
+    linha_de = {produto_id: linha for linha, produto_id in enumerate(produto_ids.tolist())}
+    linhas, indices, pesos = [], [], []
+    for produto_id, grupo, valor in caracteristicas:
+        linha = linha_de.get(produto_id)
+        if linha is None or valor in (None, ''):
+            continue
+        linhas.append(linha)
+        indices.append(colunas.setdefault((grupo, valor), len(colunas)))
+        pesos.append(pesos_grupo[grupo])
+    return sparse.csr_matrix(
+        (np.array(pesos, dtype=np.float32), (linhas, indices)),
+        shape=(len(produto_ids), len(colunas)),
+    )
+
+
+def _normalizar(matriz: sparse.csr_matrix, idf: np.ndarray) -> sparse.csr_matrix:
+    matriz = (matriz @ sparse.diags(idf.astype(np.float32))).tocsr()
+    normas = np.sqrt(np.asarray(matriz.multiply(matriz).sum(axis=1)).ravel())
+    normas[normas == 0] = 1
+    return (sparse.diags((1 / normas).astype(np.float32)) @ matriz).tocsr()
+
+
+def _idf(total_produtos: int, frequencia: np.ndarray) -> np.ndarray:
+    # Característica presente em quase todo produto não diferencia nada
+    return np.log((1 + total_produtos) / (1 + frequencia)) + 1
+
+
+def construir_matriz() -> dict:
+    """Vetoriza o catálogo inteiro e guarda a matriz (com colunas e IDF) no cache"""
+    produto_ids, caracteristicas = _caracteristicas()
+    colunas = {}
+    matriz = _montar(produto_ids, caracteristicas, colunas)
+    idf = _idf(matriz.shape[0], np.bincount(matriz.indices, minlength=matriz.shape[1]))
+    estado = {'matriz': _normalizar(matriz, idf), 'ids': produto_ids, 'colunas': colunas, 'idf': idf}
+    cache.set(SIMILARES_CONFIG['CHAVE_MATRIZ'], estado, SIMILARES_CONFIG['TIMEOUT_MATRIZ'])
+    return estado
+
+
+def vetorizar() -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """Matriz esparsa produto x característica, com linhas normalizadas, e o id de cada linha"""
+    estado = construir_matriz()
+    return estado['matriz'], estado['ids']
+
+
+def _matriz_atualizada(alterados: Set[int]) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    Matriz do cache com só as linhas dos produtos alterados relidas do banco.
+    O IDF fica o da última vetorização completa; características novas
+    entram como raras. Sem matriz no cache, vetoriza o catálogo. Chamada com
+    o lock da matriz (ver _travar_matriz).
+    """
+    estado = cache.get(SIMILARES_CONFIG['CHAVE_MATRIZ'])
+    if estado is None:
+        estado = construir_matriz()
+        return estado['matriz'], estado['ids']
+
+    # Criados e desativados sem marca também entram ou saem
+    ativos = set(Produto.objects.filter(ativo=True).values_list('id', flat=True))
+    releitura = (alterados | (ativos - set(estado['ids'].tolist()))) & ativos
+    manter = np.flatnonzero(np.isin(estado['ids'], list(ativos - releitura)))
+
+    colunas = estado['colunas']
+    novos_ids, caracteristicas = _caracteristicas(releitura)
+    novas = _montar(novos_ids, caracteristicas, colunas)
+    idf = np.concatenate([
+        estado['idf'], np.full(len(colunas) - len(estado['idf']), _idf(len(ativos), 1))
+    ])
+    antigas = estado['matriz'][manter]
+    antigas.resize((antigas.shape[0], len(colunas)))
+
+    estado.update(
+        matriz=sparse.vstack([antigas, _normalizar(novas, idf)]).tocsr(),
+        ids=np.concatenate([estado['ids'][manter], novos_ids]),
+        idf=idf,
+    )
+    cache.set(SIMILARES_CONFIG['CHAVE_MATRIZ'], estado, SIMILARES_CONFIG['TIMEOUT_MATRIZ'])
+    return estado['matriz'], estado['ids']
+
+
+def calcular_vizinhos(matriz: sparse.csr_matrix, produto_ids: np.ndarray,
+                      linhas: Optional[Iterable[int]] = None, top_k: Optional[int] = None) -> dict:
+    """{produto_id: [(similar_id, score), ...]} das linhas informadas (todas por padrão)"""
+    top_k = min(top_k or SIMILARES_CONFIG['TOP_K'], max(matriz.shape[0] - 1, 0))
+    linhas = np.arange(matriz.shape[0]) if linhas is None else np.fromiter(linhas, dtype=np.int64)
+    if top_k == 0:
+        return {int(produto_ids[linha]): [] for linha in linhas}
+
+    transposta = matriz.T.tocsc()
+    vizinhos = {}
+    for inicio in range(0, len(linhas), SIMILARES_CONFIG['TAMANHO_BLOCO']):
+        bloco = linhas[inicio:inicio + SIMILARES_CONFIG['TAMANHO_BLOCO']]
+        scores = (matriz[bloco] @ transposta).toarray()
+        scores[np.arange(len(bloco)), bloco] = -1  # o próprio produto
+
+        # Top-K de todas as linhas do bloco de uma vez, depois ordenado por score e id
+        melhores = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        valores = np.take_along_axis(scores, melhores, axis=1)
+        ordem = np.lexsort((produto_ids[melhores], -valores), axis=1)
+        melhores = np.take_along_axis(melhores, ordem, axis=1)
+        valores = np.take_along_axis(valores, ordem, axis=1)
+
+        for linha, colunas, scores_linha in zip(bloco, melhores, valores):
+            vizinhos[int(produto_ids[linha])] = [
+                (int(produto_ids[coluna]), float(score))
+                for coluna, score in zip(colunas, scores_linha)
+                if score >= SIMILARES_CONFIG['SCORE_MINIMO']
+            ]
+    return vizinhos
+
+
+def atualizar_similares(produto_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Recalcula os similares do catálogo inteiro ou só dos produtos informados,
+    incluindo os que os tinham como vizinhos e os seus novos vizinhos.
+    """
+    if produto_ids is None:
+        matriz, ids = vetorizar()
+        return gravar_vizinhos(calcular_vizinhos(matriz, ids), TIPO, substituir_tudo=True)
+
+    alterados = set(produto_ids)
+    if not alterados:
+        return 0
+    matriz, ids = _matriz_atualizada(alterados)
+    alvo = alterados | set(
+        ProdutoRelacionado.objects.filter(tipo=TIPO, relacionado_id__in=alterados).values_list('produto_id', flat=True)
+    )
+    posicoes = {produto_id: linha for linha, produto_id in enumerate(ids.tolist())}
+    vizinhos = calcular_vizinhos(matriz, ids, [posicoes[produto_id] for produto_id in alvo if produto_id in posicoes])
+    # A similaridade é simétrica: quem entrou no top-K de um alterado provavelmente o tem no seu
+    novos = {similar for produto_id in alterados for similar, _ in vizinhos.get(produto_id, [])} - set(vizinhos)
+    vizinhos.update(calcular_vizinhos(matriz, ids, [posicoes[produto_id] for produto_id in novos]))
+    # Produtos inativos perdem a lista
+    vizinhos.update({produto_id: [] for produto_id in alvo if produto_id not in posicoes})
+    return gravar_vizinhos(vizinhos, TIPO)
+
+
+def marcar_pendentes(produto_ids: Iterable[int]) -> None:
+    """
+    Marca os produtos para o próximo calcular_similares --pendentes. A marca
+    é gravada na transação corrente: some se ela for desfeita e, até o
+    commit, a linha fica travada e o cálculo a deixa para a rodada seguinte.
+    """
+    ids = sorted(set(produto_ids))  # mesma ordem em todas as transações: sem deadlock
+    if not ids:
+        return
+    SimilarPendente.objects.bulk_create(
+        [SimilarPendente(produto_id=produto_id) for produto_id in ids],
+        update_conflicts=True, unique_fields=['produto_id'], update_fields=['marcado_em'],
+    )
+
+
+@contextmanager
+def _travar_matriz():
+    """Lock da matriz no cache; entrega False se outro cálculo já o tem"""
+    travou = cache.add(SIMILARES_CONFIG['CHAVE_LOCK'], True, SIMILARES_CONFIG['TIMEOUT_LOCK'])
+    try:
+        yield travou
+    finally:
+        if travou:
+            cache.delete(SIMILARES_CONFIG['CHAVE_LOCK'])
+
+
+def _retirar_pendentes(limite: Optional[int] = None) -> List[int]:
+    """Apaga e devolve os produtos marcados, sem esperar pelas marcas de transações em andamento"""
+    with transaction.atomic():
+        pendentes = SimilarPendente.objects.select_for_update(skip_locked=True).order_by('produto_id')
+        ids = list(pendentes.values_list('produto_id', flat=True)[:limite])
+        SimilarPendente.objects.filter(produto_id__in=ids).delete()
+    return ids
+
+
+def atualizar_pendentes(limite: Optional[int] = None) -> Optional[int]:
+    """
+    Recalcula os produtos marcados por marcar_pendentes (até `limite`) num
+    único cálculo. Devolve None se outro cálculo estiver em andamento; numa
+    falha, os produtos voltam a ficar marcados.
+    """
+    with _travar_matriz() as travou:
+        if not travou:
+            return None
+        ids = _retirar_pendentes(limite)
+        try:
+            return atualizar_similares(ids)
+        except Exception:
+            marcar_pendentes(ids)
+            raise
+
+
+def recalcular_catalogo() -> Optional[int]:
+    """Revetoriza e recalcula o catálogo inteiro, o que também resolve os pendentes"""
+    with _travar_matriz() as travou:
+        if not travou:
+            return None
+        ids = _retirar_pendentes()
+        try:
+            return atualizar_similares()
+        except Exception:
+            marcar_pendentes(ids)
+            raise
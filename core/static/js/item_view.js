@@ -1,3 +1,19 @@
+// =====================
+// Matriz de disponibilidade (gerada no servidor, ver core/variacoes.py)
+// =====================
+const matrizVariacoes = JSON.parse(
+    document.getElementById('matriz-variacoes')?.textContent || 'null'
+) || { variacoes: {}, combinacoes: {}, disponibilidade: {}, cores: [], tamanhos: [] };
+
+function getVariacao(variacaoId) {
+    return matrizVariacoes.variacoes[String(variacaoId)] || null;
+}
+
+function getVariacaoIdParaCorTamanho(corId, tamanhoId) {
+    const tamanhos = matrizVariacoes.disponibilidade[String(corId)] || {};
+    return tamanhos[String(tamanhoId)] || null;
+}
+
 // =====================
 // Quantidade
 // =====================
@@ -25,7 +41,7 @@ function increaseQuantity() {
     if (btn) {
         const variacaoId = parseInt(btn.getAttribute('data-variacao-id'));
         if (variacaoId) {
-            const variacao = variacoesDisponiveis.find(v => v.id === variacaoId);
+            const variacao = getVariacao(variacaoId);
             if (variacao) {
                 estoqueMaximo = variacao.estoque;
             }
@@ -65,24 +81,13 @@ function selectColor(corId) {
     // Habilita/desabilita e mostra/oculta botões de tamanho baseados na cor selecionada e estoque
     document.querySelectorAll('.size-btn').forEach(btn => {
         const tamanhoId = parseInt(btn.getAttribute('data-tamanho-id'));
-        let disponivelNestaCor = false;
-        let estoqueDisponivel = 0;
-
-        // Verifica se existe alguma variação com a cor E o tamanho selecionados que tenha estoque
-        variacoesDisponiveis.forEach(variacao => {
-            const temCor = variacao.atributos.some(attr => attr.tipo === 'Cor' && attr.id === selectedCorId);
-            const temTamanho = variacao.atributos.some(attr => attr.tipo === 'Tamanho' && attr.id === tamanhoId);
-            if (temCor && temTamanho && variacao.estoque > 0) {
-                disponivelNestaCor = true;
-                estoqueDisponivel = variacao.estoque; // Poderia ser a soma, mas para o botão individual, o estoque da variação específica
-            }
-        });
+        // Existe variação com a cor E o tamanho selecionados com estoque?
+        const disponivelNestaCor = getVariacaoIdParaCorTamanho(selectedCorId, tamanhoId) !== null;
 
         if (disponivelNestaCor) {
             btn.disabled = false;
             btn.classList.remove('disabled');
             btn.querySelector('.sem-estoque').style.display = 'none';
-            // btn.setAttribute('data-estoque', estoqueDisponivel); // O estoque já vem da variação ao selecionar o tamanho
         } else {
             btn.disabled = true;
             btn.classList.add('disabled');
@@ -106,11 +111,8 @@ function selectSize(btn) {
     btn.classList.add('selected');
 
     // Encontra a variação correspondente à cor e tamanho selecionados
-    const variacaoSelecionada = variacoesDisponiveis.find(v => 
-        v.atributos.some(attr => attr.tipo === 'Cor' && attr.id === selectedCorId) &&
-        v.atributos.some(attr => attr.tipo === 'Tamanho' && attr.id === selectedTamanhoId) &&
-        v.estoque > 0
-    );
+    const variacaoId = getVariacaoIdParaCorTamanho(selectedCorId, selectedTamanhoId);
+    const variacaoSelecionada = variacaoId ? { id: variacaoId, ...getVariacao(variacaoId) } : null;
 
     if (variacaoSelecionada) {
         selectedVariacaoId = variacaoSelecionada.id;
@@ -185,7 +187,7 @@ function validateAddToCart() {
     }
     
     // Verifica estoque disponível
-    const variacaoSelecionada = variacoesDisponiveis.find(v => v.id === selectedVariacaoId);
+    const variacaoSelecionada = getVariacao(selectedVariacaoId);
     if (variacaoSelecionada && quantity > variacaoSelecionada.estoque) {
         validationMessage.innerText = `Quantidade solicitada (${quantity}) excede o estoque disponível (${variacaoSelecionada.estoque}).`;
         validationMessage.style.color = '#c00';
@@ -0,0 +1,62 @@
+"""
+Storage de mídia endereçado por conteúdo.
+
+O nome do arquivo é o SHA-256 do conteúdo, dentro de um diretório único e
+de um subdiretório com os dois primeiros caracteres do hash (ex.:
+produtos/3f/3fa9...c1.jpg), ignorando o upload_to. Enviar a mesma foto de
+novo, como capa ou na galeria, reaproveita o arquivo existente. Quem apaga o arquivo é core.midia,
+quando a última referência (Produto.imagem ou ImagemProduto.imagem) some;
+por isso save() conta a referência do upload lá, com a linha do arquivo
+travada, antes de decidir entre gravar e reaproveitar.
+"""
+import hashlib
+import os
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ArmazenamentoPorConteudo(FileSystemStorage):
+    """FileSystemStorage que nomeia os arquivos pelo hash do conteúdo"""
+
+    def __init__(self, diretorio='produtos', **kwargs):
+        self.diretorio = diretorio
+        super().__init__(**kwargs)
+
+    def nome_por_conteudo(self, nome: str, conteudo) -> str:
+        hasher = hashlib.sha256()
+        if hasattr(conteudo, 'seek'):
+            conteudo.seek(0)
+        for pedaco in conteudo.chunks():
+            hasher.update(pedaco)
+        if hasattr(conteudo, 'seek'):
+            conteudo.seek(0)
+        digest = hasher.hexdigest()
+        extensao = os.path.splitext(nome)[1].lower()
+        return posixpath.join(self.diretorio, digest[:2], f'{digest}{extensao}')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.nome_por_conteudo(name, content)
+
+        def _gravar():
+            if self.exists(name):
+                # Mesmo conteúdo já armazenado
+                return name
+            return super(ArmazenamentoPorConteudo, self).save(name, content, max_length=max_length)
+
+        from core.midia import gravar_com_referencia  # core.midia importa os modelos, que importam este módulo
+        return gravar_com_referencia(name, _gravar)
+
+
+armazenamento_por_conteudo = ArmazenamentoPorConteudo()
+
+
+def obter_armazenamento():
+    return armazenamento_por_conteudo
@@ -0,0 +1,233 @@
+"""
+Sugestões de busca (autocomplete).
+
+O índice é uma lista ordenada de chaves normalizadas (sem acento, em
+minúsculas), uma para cada início de palavra dos nomes de produtos ativos,
+marcas, categorias e tags: "Calça Jeans" gera "calca jeans" e "jeans".
+Um prefixo é resolvido com bisect sobre essa lista, sem consultar o banco,
+e todas as entradas do intervalo do prefixo são ranqueadas por peso antes
+de cortar no limite. Os prefixos curtos, cujos intervalos são os maiores,
+já saem ranqueados da construção do índice (top-k por prefixo).
+
+O índice é construído fora das requisições, por publicar_indice (comando
+construir_sugestoes, agendado, e a importação do catálogo), e publicado no
+cache compartilhado. Os signals só incrementam a versão pedida
+(invalidar_indice); o comando reconstrói quando ela passa da publicada.
+Cada processo guarda o índice em memória e só troca pelo publicado quando
+este muda: até lá, e mesmo com a versão pedida à frente, segue servindo o
+que tem, sem nunca construir na requisição. As respostas por prefixo são
+cacheadas com o índice servido na chave.
+"""
+import hashlib
+import heapq
+import logging
+from bisect import bisect_left
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from core.busca import normalizar_texto
+from core.cache import get_or_compute
+from core.models import Categoria, Marca, Produto, Tag
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+SUGESTOES_CONFIG = {
+    'CHAVE_VERSAO': 'sugestoes_versao',
+    'CHAVE_INDICE': 'sugestoes_indice',
+    'CHAVE_PUBLICADO': 'sugestoes_publicado',  # versão e id do índice publicado, sem o índice
+    'CHAVE_LOCK': 'sugestoes_lock',
+    'TIMEOUT_LOCK': 60 * 10,
+    'PREFIXO_CACHE': 'sugestoes_',
+    'TIMEOUT': 60 * 60,  # 1 hora; um índice novo muda a chave antes disso
+    'MIN_CARACTERES': 2,
+    'LIMITE_PADRAO': 8,
+    'LIMITE_MAXIMO': 20,
+    'PREFIXO_CURTO': 3,  # prefixos até este tamanho têm o top-k calculado na construção do índice
+    'MAX_AGE': 60,  # Cache-Control das respostas, em segundos
+}
+
+# Ordem de desempate entre tipos com a mesma relevância
+_TIPOS = ('produto', 'categoria', 'marca', 'tag')
+
+_indice = {'id': None, 'versao': None, 'chaves': [], 'posicoes': [], 'entradas': [], 'melhores': {}}
+
+
+def _versao() -> int:
+    cache.add(SUGESTOES_CONFIG['CHAVE_VERSAO'], 1, None)
+    return cache.get(SUGESTOES_CONFIG['CHAVE_VERSAO'], 1)
+
+
+def invalidar_indice() -> None:
+    """Incrementa a versão pedida; a próxima publicar_indice reconstrói o índice"""
+    cache.add(SUGESTOES_CONFIG['CHAVE_VERSAO'], 1, None)
+    try:
+        cache.incr(SUGESTOES_CONFIG['CHAVE_VERSAO'])
+    except ValueError:
+        cache.set(SUGESTOES_CONFIG['CHAVE_VERSAO'], 2, None)
+
+
+def agendar_invalidacao() -> None:
+    """Invalida o índice após o commit da transação corrente"""
+    apos_commit(invalidar_indice, erro="Erro ao invalidar índice de sugestões")
+
+
+def _url_listagem(**params) -> str:
+    return f"{reverse('product-listing')}?{urlencode(params)}"
+
+
+def _entradas():
+    """Gera (tipo, texto, url, peso) de tudo que pode ser sugerido"""
+    for produto_id, nome, peso in Produto.objects.filter(ativo=True).values_list(
+        'id', 'nome', 'total_avaliacoes'
+    ):
+        yield 'produto', nome, reverse('item-view', args=[produto_id]), peso
+    for nome, peso in Categoria.objects.filter(ativo=True).values_list('nome', 'total_produtos'):
+        yield 'categoria', nome, _url_listagem(categoria=nome), peso
+    for nome, peso in Marca.objects.filter(ativo=True).annotate(
+        peso=Count('produtos', filter=Q(produtos__ativo=True))
+    ).values_list('nome', 'peso'):
+        yield 'marca', nome, _url_listagem(q=nome), peso
+    for nome, peso in Tag.objects.annotate(
+        peso=Count('produtos', filter=Q(produtos__ativo=True))
+    ).values_list('nome', 'peso'):
+        yield 'tag', nome, _url_listagem(tag=nome), peso
+
+
+def _candidatos(chaves: list, posicoes: list, entradas: list, prefixo: str) -> Dict[int, bool]:
+    """{entrada: nome começa pelo prefixo} de todas as chaves do intervalo do prefixo"""
+    candidatos = {}
+    fim = bisect_left(chaves, prefixo + '\U0010ffff')
+    for i in range(bisect_left(chaves, prefixo), fim):
+        posicao = posicoes[i]
+        candidatos[posicao] = candidatos.get(posicao, False) or entradas[posicao]['chave'].startswith(prefixo)
+    return candidatos
+
+
+def _ranquear(candidatos: Dict[int, bool], entradas: list, limite: int) -> List[int]:
+    """As limite melhores entradas: nome começando pelo prefixo vale mais que palavra do meio, depois o peso"""
+    return [
+        posicao for posicao, _ in heapq.nsmallest(
+            limite,
+            candidatos.items(),
+            key=lambda item: (
+                not item[1],
+                -entradas[item[0]]['peso'],
+                _TIPOS.index(entradas[item[0]]['tipo']),
+                len(entradas[item[0]]['texto']),
+            )
+        )
+    ]
+
+
+def construir_indice(versao=None) -> dict:
+    """Monta a lista ordenada de chaves por início de palavra e o top-k dos prefixos curtos"""
+    entradas, pares = [], []
+    for tipo, texto, url, peso in _entradas():
+        termos = normalizar_texto(texto).split()
+        if not termos:
+            continue
+        posicao = len(entradas)
+        entradas.append({
+            'tipo': tipo, 'texto': texto, 'url': url, 'peso': peso or 0, 'chave': ' '.join(termos)
+        })
+        for inicio in range(len(termos)):
+            pares.append((' '.join(termos[inicio:]), posicao))
+
+    pares.sort()
+    chaves = [chave for chave, _ in pares]
+    posicoes = [posicao for _, posicao in pares]
+    curtos = {
+        chave[:tamanho]
+        for chave in chaves
+        for tamanho in range(SUGESTOES_CONFIG['MIN_CARACTERES'], SUGESTOES_CONFIG['PREFIXO_CURTO'] + 1)
+        if len(chave) >= tamanho
+    }
+    return {
+        'versao': versao,
+        'chaves': chaves,
+        'posicoes': posicoes,
+        'entradas': entradas,
+        'melhores': {
+            prefixo: _ranquear(
+                _candidatos(chaves, posicoes, entradas, prefixo), entradas, SUGESTOES_CONFIG['LIMITE_MAXIMO']
+            )
+            for prefixo in curtos
+        },
+    }
+
+
+def publicar_indice(forcar: bool = False) -> Optional[dict]:
+    """
+    Constrói o índice e o publica no cache compartilhado se a versão pedida
+    passou da publicada (ou com forcar). Retorna None se o publicado já está
+    em dia ou se outra construção está em andamento.
+    """
+    versao = _versao()  # lida antes: invalidações durante a construção pedem outra
+    publicado = cache.get(SUGESTOES_CONFIG['CHAVE_PUBLICADO'])
+    if (not forcar and publicado is not None and publicado['versao'] >= versao
+            and cache.has_key(SUGESTOES_CONFIG['CHAVE_INDICE'])):
+        return None
+    if not cache.add(SUGESTOES_CONFIG['CHAVE_LOCK'], True, SUGESTOES_CONFIG['TIMEOUT_LOCK']):
+        return None
+
+    try:
+        indice = construir_indice(versao)
+        indice['id'] = uuid4().hex
+        cache.set(SUGESTOES_CONFIG['CHAVE_INDICE'], indice, None)
+        cache.set(SUGESTOES_CONFIG['CHAVE_PUBLICADO'], {'versao': versao, 'id': indice['id']}, None)
+        return indice
+    finally:
+        cache.delete(SUGESTOES_CONFIG['CHAVE_LOCK'])
+
+
+def obter_indice() -> dict:
+    """
+    Retorna o índice do processo, trocado pelo publicado quando este muda.
+    Sem índice publicado segue com o atual (vazio antes da primeira
+    publicação); a construção fica com publicar_indice.
+    """
+    global _indice
+    publicado = cache.get(SUGESTOES_CONFIG['CHAVE_PUBLICADO'])
+    if publicado is not None and publicado['id'] != _indice['id']:
+        indice = cache.get(SUGESTOES_CONFIG['CHAVE_INDICE'])
+        if indice is not None and indice['id'] == publicado['id']:
+            _indice = indice
+        elif _indice['id'] is None:
+            logger.warning("Índice de sugestões publicado não encontrado no cache; rode construir_sugestoes")
+    return _indice
+
+
+def sugerir(texto: str, limite: int = None, indice: dict = None) -> List[dict]:
+    """Retorna até limite sugestões cujo nome (ou uma de suas palavras) começa com texto"""
+    limite = min(limite or SUGESTOES_CONFIG['LIMITE_PADRAO'], SUGESTOES_CONFIG['LIMITE_MAXIMO'])
+    prefixo = normalizar_texto(texto)
+    if len(prefixo) < SUGESTOES_CONFIG['MIN_CARACTERES']:
+        return []
+
+    indice = indice or obter_indice()
+    entradas = indice['entradas']
+    if len(prefixo) <= SUGESTOES_CONFIG['PREFIXO_CURTO']:
+        melhores = indice['melhores'].get(prefixo, [])[:limite]
+    else:
+        melhores = _ranquear(
+            _candidatos(indice['chaves'], indice['posicoes'], entradas, prefixo), entradas, limite
+        )
+    return [
+        {chave: entradas[posicao][chave] for chave in ('tipo', 'texto', 'url')}
+        for posicao in melhores
+    ]
+
+
+def obter_sugestoes(texto: str, limite: int = None) -> List[dict]:
+    """Retorna as sugestões do prefixo com cache por índice servido"""
+    prefixo = normalizar_texto(texto)
+    indice = obter_indice()
+    assinatura = hashlib.md5(f'{prefixo}|{limite}'.encode()).hexdigest()
+    cache_key = f"{SUGESTOES_CONFIG['PREFIXO_CACHE']}{indice['id']}_{assinatura}"
+    return get_or_compute(cache_key, lambda: sugerir(prefixo, limite, indice), SUGESTOES_CONFIG['TIMEOUT'])
@@ -0,0 +1,31 @@
+"""
+Tarefas executadas após o commit da transação corrente.
+
+Índices e modelos de leitura (busca, cards, facetas, similares, ...) são
+atualizados depois do commit, para não enxergarem dados que ainda podem ser
+desfeitos. Uma falha na tarefa vai para o log e não afeta a requisição, que
+já gravou seus dados; os comandos de reconstrução corrigem o que ficar para
+trás.
+"""
+import logging
+from typing import Callable, Optional
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def apos_commit(funcao: Callable, *args, erro: str, ao_falhar: Optional[Callable] = None, **kwargs) -> None:
+    """
+    Chama funcao(*args, **kwargs) após o commit. Em caso de exceção registra
+    "erro: <exceção>" e chama ao_falhar, se informado.
+    """
+    def _executar():
+        try:
+            funcao(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"{erro}: {str(e)}")
+            if ao_falhar is not None:
+                ao_falhar()
+
+    transaction.on_commit(_executar)
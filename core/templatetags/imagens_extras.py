@@ -0,0 +1,28 @@
+from django import template
+from django.core.files.storage import default_storage
+
+from core.imagens import IMAGENS_CONFIG, derivadas_disponiveis, manifesto, nome_derivada
+
+register = template.Library()
+
+
+def _nome(imagem):
+    """Aceita um FieldFile (produto.imagem) ou o caminho salvo (card.imagem)."""
+    return getattr(imagem, 'name', imagem) or ''
+
+
+@register.filter
+def srcset(imagem, extensao='webp'):
+    """Retorna o srcset ("url 400w, url 800w, ...") das derivadas já geradas."""
+    return ', '.join(f'{url} {largura}w' for url, largura in derivadas_disponiveis(_nome(imagem), extensao))
+
+
+@register.filter
+def derivada(imagem, tamanho='card'):
+    """Retorna a URL da derivada JPEG do tamanho pedido, ou a do original se ainda não existir."""
+    nome = _nome(imagem)
+    if not nome:
+        return ''
+    if tamanho in IMAGENS_CONFIG['TAMANHOS'] and (tamanho, 'jpg') in manifesto(nome):
+        return default_storage.url(nome_derivada(nome, tamanho, 'jpg'))
+    return default_storage.url(nome)
@@ -1,7 +1,52 @@
-from django.test import TestCase
+import csv
+import gzip
+import os
+import tempfile
+import time
+from decimal import Decimal
+from xml.etree import ElementTree
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.core.cache import cache, caches
 from django.core.exceptions import ValidationError
 from django.utils import timezone
-from .models import Produto, Categoria, Marca
+from django.contrib.auth.models import User
+from .models import (
+    Produto, Categoria, Marca, Tag, ProdutoCard, ProdutoVariacao, AtributoTipo, AtributoValor, AvaliacaoProduto,
+    ImagemProduto, ArquivoMidia, Endereco, Pedido, ItemPedido, CoocorrenciaProduto, ProdutoRelacionado,
+    Carrinho, ItemCarrinho, ReservaEstoque, Cupom, SimilarPendente
+)
+from .busca import buscar_produtos, normalizar_texto
+from .facetas import calcular as calcular_facetas
+from .paginacao import decodificar_cursor, paginar
+from .histograma import calcular_histograma
+from .categorias import filtrar_por_categoria
+from .variacoes import gerar_combinacoes, obter_matriz
+from .promocoes import aplicar_fronteiras, proxima_fronteira
+from .avaliacoes import recalcular_avaliacoes
+from .sugestoes import construir_indice, publicar_indice, sugerir
+from .imagens import gerar_derivadas, listar_originais
+from .templatetags.imagens_extras import derivada, srcset
+from .midia import apagar_se_orfao, recalcular_referencias
+from .storage import armazenamento_por_conteudo
+from .importacao import ImportadorCatalogo
+from .admin import ProdutoVariacaoAdminForm
+from .recomendacoes import RECOMENDACOES_CONFIG, obter_relacionados, reconstruir
+from . import similares
+from .similares import atualizar_pendentes, atualizar_similares, recalcular_catalogo
+from .rankings import aplicar_pedido, epoca_atual, reconstruir as reconstruir_rankings
+from .views import ORDENACOES_LISTAGEM
+from .feeds import FEEDS_CONFIG, caminho_arquivo, gerar as gerar_feeds
+from .cache import (
+    CACHE_CONFIG, CacheLocal, get_or_compute, invalidar_namespace, invalidar_tags, limpar_cache_local, montar_chave,
+    obter_geracao, tag
+)
+from .context_processors import get_notificacoes_cache
+from .metricas_cache import obter_metricas, prefixo_da_chave, zerar_metricas
+from user.models import Notificacao
 
 class ProdutoModelTest(TestCase):
     def setUp(self):
@@ -91,4 +136,1096 @@ class ProdutoModelTest(TestCase):
             estoque=-1
         )
         with self.assertRaises(ValidationError):
-            produto.full_clean()
\ No newline at end of file
+            produto.full_clean()
+
+class BuscaProdutoTest(TestCase):
+    def setUp(self):
+        self.categoria = Categoria.objects.create(nome="Calçados")
+        self.marca = Marca.objects.create(nome="Marca Teste")
+
+    def test_normalizar_texto_remove_acentos(self):
+        self.assertEqual(normalizar_texto("  Calçado   Ténis "), "calcado tenis")
+
+    def test_busca_com_prefixo_sem_acento_e_relevancia(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tenis = Produto.objects.create(
+                nome="Tênis Corrida",
+                preco=200,
+                categoria=self.categoria,
+                marca=self.marca
+            )
+            sandalia = Produto.objects.create(
+                nome="Sandália",
+                descricao="Confortável para corrida leve",
+                preco=90,
+                categoria=self.categoria,
+                marca=self.marca
+            )
+
+        resultado = list(buscar_produtos(Produto.objects.all(), "corr").order_by('-relevancia'))
+        self.assertEqual(resultado, [tenis, sandalia])
+        self.assertEqual(list(buscar_produtos(Produto.objects.all(), "tenis")), [tenis])
+        self.assertFalse(buscar_produtos(Produto.objects.all(), "!!").exists())
+
+
+class FacetasTest(TestCase):
+    def test_contagem_disjuntiva(self):
+        # Cores 1 (azul) e 2 (preto); tamanhos 10 (P) e 11 (M)
+        indice = {
+            'tipos': {1: 'Cor', 2: 'Cor', 10: 'Tamanho', 11: 'Tamanho'},
+            'postings': {1: {100, 101}, 2: {102}, 10: {100, 102}, 11: {101}},
+            'por_produto': {},
+        }
+        ids, contagens = calcular_facetas({100, 101, 102}, {'Cor': {1}, 'Tamanho': set()}, indice)
+        self.assertEqual(ids, {100, 101})
+        # Outras cores continuam contando; tamanhos respeitam a cor escolhida
+        self.assertEqual(contagens, {1: 2, 2: 1, 10: 1, 11: 1})
+
+        ids, _ = calcular_facetas({100, 101, 102}, {'Cor': {1, 2}, 'Tamanho': {10}}, indice)
+        self.assertEqual(ids, {100, 102})
+
+    def test_listagem_filtra_no_sql_e_cacheia_as_contagens(self):
+        cache.clear()
+        categoria = Categoria.objects.create(nome="Roupas")
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        preto = AtributoValor.objects.create(tipo=cor, valor="Preto", codigo="PT")
+        with self.captureOnCommitCallbacks(execute=True):
+            camisa = Produto.objects.create(nome="Camisa", preco=80, categoria=categoria)
+            calca = Produto.objects.create(nome="Calça", preco=90, categoria=categoria)
+            gerar_combinacoes(camisa, [azul.id], estoque=1)
+            gerar_combinacoes(calca, [preto.id], estoque=1)
+
+        with mock.patch('core.facetas.calcular', wraps=calcular_facetas) as calcular:
+            dados = self.client.get(f'/api/produtos/?cores={azul.id}').json()
+            # Outra ordenação, mesmo estado de filtro: contagens do cache
+            self.client.get(f'/api/produtos/?cores={azul.id}&sort=price_asc')
+        self.assertEqual([item['id'] for item in dados['resultados']], [camisa.pk])
+        self.assertEqual(dados['facetas'], {str(azul.id): 1, str(preto.id): 1})
+        calcular.assert_called_once()
+
+
+class ProdutoCardTest(TestCase):
+    def test_card_acompanha_produto(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        agora = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            produto = Produto.objects.create(
+                nome="Camiseta",
+                preco=100,
+                preco_promocional=75,
+                promocao_inicio=agora - timezone.timedelta(hours=1),
+                promocao_fim=agora + timezone.timedelta(days=1),
+                categoria=categoria
+            )
+
+        card = ProdutoCard.objects.get(pk=produto.pk)
+        self.assertEqual(card.preco_vigente(), 75)
+        self.assertEqual(card.calcular_desconto(), 25)
+        self.assertFalse(card.em_estoque)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            produto.nome = "Camiseta Básica"
+            produto.save()
+        card.refresh_from_db()
+        self.assertEqual(card.nome, "Camiseta Básica")
+
+
+
+class PrecoVigenteSQLTest(TestCase):
+    def test_anotacao_segue_regra_da_promocao(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        agora = timezone.now()
+        em_promocao = Produto.objects.create(
+            nome="Camiseta", preco=100, preco_original=120, preco_promocional=60,
+            promocao_inicio=agora - timezone.timedelta(hours=1),
+            promocao_fim=agora + timezone.timedelta(hours=1),
+            categoria=categoria
+        )
+        expirada = Produto.objects.create(
+            nome="Bermuda", preco=80, preco_promocional=10,
+            promocao_inicio=agora - timezone.timedelta(days=2),
+            promocao_fim=agora - timezone.timedelta(days=1),
+            categoria=categoria
+        )
+
+        produtos = list(Produto.objects.with_preco_vigente().order_by('preco_efetivo'))
+        self.assertEqual(produtos, [em_promocao, expirada])
+        for produto in produtos:
+            self.assertEqual(produto.preco_efetivo, produto.preco_vigente())
+            self.assertEqual(produto.desconto_efetivo, produto.calcular_desconto())
+        self.assertFalse(Produto.objects.with_preco_vigente().filter(preco_efetivo__lt=50).exists())
+
+
+class AgendadorPromocoesTest(TestCase):
+    def test_fim_da_promocao_invalida_precos_cacheados(self):
+        agora = timezone.now()
+        fim = agora + timezone.timedelta(minutes=5)
+        produto = Produto.objects.create(
+            nome="Camiseta", preco=100, preco_promocional=70,
+            promocao_inicio=agora - timezone.timedelta(days=1), promocao_fim=fim,
+            categoria=Categoria.objects.create(nome="Roupas")
+        )
+        self.assertEqual(proxima_fronteira(agora), fim)
+        self.assertEqual(produto.preco_vigente(), 70)
+        self.assertEqual(produto.calcular_desconto(), 30)
+
+        # Antes da fronteira nada muda; depois dela o escopo do produto é invalidado
+        self.assertEqual(aplicar_fronteiras(agora, fim), 0)
+        self.assertEqual(aplicar_fronteiras(fim, fim + timezone.timedelta(seconds=1)), 1)
+        self.assertIsNone(cache.get(montar_chave('produto', 'preco', escopo=produto.pk)))
+        produto.refresh_from_db()
+        self.assertEqual(produto.desconto, 0)  # desconto gravado recalculado no instante da fronteira
+
+class PaginacaoCursorTest(TestCase):
+    def test_percorre_todas_as_paginas_sem_repetir(self):
+        for nome in ["Blusas", "Calças", "Bermudas", "Vestidos", "Saias", "Blusas"]:
+            Categoria.objects.create(nome=nome)
+        ordenacao = ('nome', 'pk')
+        esperado = list(Categoria.objects.order_by(*ordenacao))
+
+        pagina = paginar(Categoria.objects.all(), ordenacao, 2)
+        vistos = list(pagina)
+        while pagina.proximo:
+            pagina = paginar(Categoria.objects.all(), ordenacao, 2, cursor=pagina.proximo)
+            vistos.extend(pagina)
+        self.assertEqual(vistos, esperado)
+
+        anterior = paginar(Categoria.objects.all(), ordenacao, 2, cursor=pagina.anterior)
+        self.assertEqual(list(anterior), esperado[2:4])
+        self.assertIsNone(decodificar_cursor("adulterado", ordenacao))
+
+
+class HistogramaPrecosTest(TestCase):
+    def test_faixas_e_tercis(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        with self.captureOnCommitCallbacks(execute=True):
+            for preco in [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]:
+                Produto.objects.create(nome=f"Produto {preco}", preco=preco, categoria=categoria)
+
+        histograma = calcular_histograma(ProdutoCard.objects.all(), faixas=5)
+        self.assertEqual((histograma['minimo'], histograma['maximo']), (10, 100))
+        self.assertEqual([faixa['quantidade'] for faixa in histograma['faixas']], [2, 2, 2, 2, 2])
+        self.assertLess(histograma['faixa_preco_1'], histograma['faixa_preco_2'])
+        self.assertEqual(calcular_histograma(ProdutoCard.objects.none())['total'], 0)
+
+
+class ArvoreCategoriasTest(TestCase):
+    def test_totais_e_filtro_por_subarvore(self):
+        roupas = Categoria.objects.create(nome="Roupas")
+        camisetas = Categoria.objects.create(nome="Camisetas", categoria_pai=roupas)
+        polo = Categoria.objects.create(nome="Polo", categoria_pai=camisetas)
+        calcados = Categoria.objects.create(nome="Calçados")
+
+        produto = Produto.objects.create(nome="Polo Azul", preco=50, categoria=polo)
+        Produto.objects.create(nome="Camiseta Lisa", preco=30, categoria=camisetas)
+        Produto.objects.create(nome="Tênis", preco=200, categoria=calcados)
+
+        totais = dict(Categoria.objects.values_list('nome', 'total_produtos'))
+        self.assertEqual(totais, {"Roupas": 2, "Camisetas": 2, "Polo": 1, "Calçados": 1})
+        self.assertEqual(
+            set(filtrar_por_categoria(Produto.objects.all(), "roupas").values_list('nome', flat=True)),
+            {"Polo Azul", "Camiseta Lisa"}
+        )
+
+        produto.ativo = False
+        produto.save()
+        self.assertEqual(Categoria.objects.get(pk=roupas.pk).total_produtos, 1)
+
+        # Mover a subárvore recalcula caminhos e totais
+        camisetas.categoria_pai = calcados
+        camisetas.save()
+        totais = dict(Categoria.objects.values_list('nome', 'total_produtos'))
+        self.assertEqual(totais["Roupas"], 0)
+        self.assertEqual(totais["Calçados"], 2)
+
+        # Instância antiga não zera o total mantido por F()
+        calcados_antiga = Categoria.objects.get(pk=calcados.pk)
+        Produto.objects.create(nome="Bota", preco=300, categoria=calcados)
+        calcados_antiga.ordem = 5
+        calcados_antiga.save()
+        self.assertEqual(Categoria.objects.get(pk=calcados.pk).total_produtos, 3)
+
+        roupas.categoria_pai = polo
+        roupas.save()
+        polo.categoria_pai = roupas
+        with self.assertRaises(ValidationError):
+            polo.save()
+
+
+class MatrizVariacoesTest(TestCase):
+    def test_matriz_em_uma_consulta_e_invalidada_por_versao(self):
+        produto = Produto.objects.create(nome="Camiseta", preco=100, categoria=Categoria.objects.create(nome="Roupas"))
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        tamanho = AtributoTipo.objects.create(nome="Tamanho", tipo="size")
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="#00F")
+        p = AtributoValor.objects.create(tipo=tamanho, valor="P", ordem=1)
+        m = AtributoValor.objects.create(tipo=tamanho, valor="M", ordem=2)
+        variacao_p, variacao_m = ProdutoVariacao.objects.bulk_create([
+            ProdutoVariacao(produto=produto, sku="CAM-AZ-P", estoque=3, preco_adicional=5, atributos_hash="p"),
+            ProdutoVariacao(produto=produto, sku="CAM-AZ-M", estoque=0, atributos_hash="m"),
+        ])
+        ProdutoVariacao.atributos.through.objects.bulk_create([
+            ProdutoVariacao.atributos.through(produtovariacao=variacao_p, atributovalor=azul),
+            ProdutoVariacao.atributos.through(produtovariacao=variacao_p, atributovalor=p),
+            ProdutoVariacao.atributos.through(produtovariacao=variacao_m, atributovalor=azul),
+            ProdutoVariacao.atributos.through(produtovariacao=variacao_m, atributovalor=m),
+        ])
+
+        with self.assertNumQueries(1):
+            matriz = obter_matriz(produto.id)
+        self.assertEqual(matriz['disponibilidade'], {str(azul.id): {str(p.id): variacao_p.id}})
+        self.assertEqual(matriz['combinacoes'][f"{min(azul.id, m.id)}-{max(azul.id, m.id)}"], variacao_m.id)
+        self.assertEqual(matriz['variacoes'][str(variacao_p.id)]['preco_adicional'], '5.00')
+        self.assertEqual(produto.get_tamanhos_disponiveis(), ["P"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            variacao_m.estoque = 2
+            variacao_m.save()
+        self.assertEqual(produto.get_tamanhos_disponiveis(), ["P", "M"])
+
+
+class AgregadosAvaliacaoTest(TestCase):
+    def test_agregados_acompanham_aprovacao_e_remocao(self):
+        produto = Produto.objects.create(nome="Camiseta", preco=100, categoria=Categoria.objects.create(nome="Roupas"))
+        ana = User.objects.create_user("ana")
+        bia = User.objects.create_user("bia")
+
+        pendente = AvaliacaoProduto.objects.create(produto=produto, usuario=ana, nota=4)
+        AvaliacaoProduto.objects.create(produto=produto, usuario=bia, nota=5, aprovada=True)
+        produto.refresh_from_db()
+        self.assertEqual((produto.total_avaliacoes, produto.soma_notas), (1, 5))
+
+        pendente.aprovada = True
+        pendente.save()
+        pendente.nota = 2
+        pendente.save()
+        produto.refresh_from_db()
+        with self.assertNumQueries(0):
+            self.assertEqual(produto.media_avaliacoes(), 3.5)
+            self.assertEqual(
+                [(faixa['nota'], faixa['quantidade']) for faixa in produto.distribuicao_avaliacoes()],
+                [(5, 1), (4, 0), (3, 0), (2, 1), (1, 0)]
+            )
+
+        pendente.delete()
+        Produto.objects.filter(pk=produto.pk).update(total_avaliacoes=7)  # desvio
+        recalcular_avaliacoes()
+        produto.refresh_from_db()
+        self.assertEqual((produto.total_avaliacoes, produto.soma_notas, produto.avaliacoes_nota_2), (1, 5, 0))
+
+    def test_save_de_instancia_antiga_preserva_agregados(self):
+        produto = Produto.objects.create(nome="Camiseta", preco=100, categoria=Categoria.objects.create(nome="Roupas"))
+        AvaliacaoProduto.objects.create(produto=produto, usuario=User.objects.create_user("ana"), nota=4, aprovada=True)
+
+        produto.nome = "Camiseta Azul"  # instância lida antes da avaliação
+        produto.save()
+        produto.refresh_from_db()
+        self.assertEqual((produto.nome, produto.total_avaliacoes, produto.avaliacoes_nota_4), ("Camiseta Azul", 1, 1))
+
+
+class SugestoesBuscaTest(TestCase):
+    def test_prefixo_casa_inicio_de_palavra_sem_acento(self):
+        roupas = Categoria.objects.create(nome="Calçados")
+        Produto.objects.create(nome="Calça Jeans", preco=100, categoria=roupas)
+        Produto.objects.create(nome="Jaqueta Jeans", preco=200, categoria=roupas, ativo=False)
+        Marca.objects.create(nome="Jeanswear")
+        indice = construir_indice()
+
+        self.assertEqual(
+            [(s['tipo'], s['texto']) for s in sugerir("calc", indice=indice)],
+            [("categoria", "Calçados"), ("produto", "Calça Jeans")]
+        )
+        # Nome começando pelo prefixo vem antes de palavra do meio
+        self.assertEqual([s['texto'] for s in sugerir("jean", indice=indice)], ["Jeanswear", "Calça Jeans"])
+        self.assertEqual(sugerir("j", indice=indice), [])
+
+        publicar_indice(forcar=True)  # a requisição não constrói o índice
+        resposta = self.client.get('/api/search/suggest/', {'q': 'calça j'})
+        self.assertEqual([s['texto'] for s in resposta.json()['sugestoes']], ["Calça Jeans"])
+        self.assertIn('max-age', resposta['Cache-Control'])
+
+    def test_ranqueia_todo_o_intervalo_do_prefixo_pelo_peso(self):
+        entradas = [('produto', f"Camisa {i:03d}", f"/produto/{i}/", 0) for i in range(300)]
+        entradas.append(('produto', "Casaco", "/produto/casaco/", 40))  # depois de 300 chaves na ordem alfabética
+        with mock.patch('core.sugestoes._entradas', return_value=entradas):
+            indice = construir_indice()
+        self.assertEqual(sugerir("ca", indice=indice)[0]['texto'], "Casaco")
+        self.assertEqual(sugerir("casa", indice=indice)[0]['texto'], "Casaco")
+        self.assertEqual(sugerir("camisa 01", indice=indice, limite=3)[0]['texto'], "Camisa 010")
+
+    def test_so_campos_do_indice_invalidam(self):
+        produto = Produto.objects.create(nome="Calça Jeans", preco=100, categoria=Categoria.objects.create(nome="Roupas"))
+        with mock.patch('core.sugestoes.invalidar_indice') as invalidar, self.captureOnCommitCallbacks(execute=True):
+            produto.preco = 90
+            produto.save()
+        invalidar.assert_not_called()
+        with mock.patch('core.sugestoes.invalidar_indice') as invalidar, self.captureOnCommitCallbacks(execute=True):
+            produto.nome = "Calça Skinny"
+            produto.save()
+        invalidar.assert_called_once()
+
+    def test_requisicao_so_troca_pelo_indice_publicado(self):
+        roupas = Categoria.objects.create(nome="Roupas")
+        Produto.objects.create(nome="Calça Jeans", preco=100, categoria=roupas)
+        publicar_indice(forcar=True)
+        self.assertIsNone(publicar_indice())  # já em dia
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Produto.objects.create(nome="Camisa Polo", preco=80, categoria=roupas)
+        # Versão pedida à frente da publicada: segue servindo o índice que tem
+        with mock.patch('core.sugestoes.construir_indice') as construir:
+            self.assertEqual(sugerir("cami"), [])
+            self.assertEqual([s['texto'] for s in sugerir("calç")], ["Calça Jeans"])
+        construir.assert_not_called()
+
+        self.assertIsNotNone(publicar_indice())
+        self.assertEqual([s['texto'] for s in sugerir("cami")], ["Camisa Polo"])
+
+
+class DerivadasImagemTest(TestCase):
+    def test_gera_tamanhos_sem_ampliar_e_expoe_srcset(self):
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            os.makedirs(os.path.join(media, 'produtos'))
+            Image.new('RGBA', (1000, 500), (255, 0, 0, 128)).save(os.path.join(media, 'produtos', 'foto.png'))
+
+            self.assertEqual(gerar_derivadas('produtos/foto.png'), 6)
+            self.assertEqual(gerar_derivadas('produtos/foto.png'), 0)
+            with Image.open(os.path.join(media, 'produtos', 'foto__card.webp')) as card:
+                self.assertEqual(card.size, (400, 200))
+            with Image.open(os.path.join(media, 'produtos', 'foto__zoom.jpg')) as zoom:
+                self.assertEqual(zoom.size, (1000, 500))
+
+            self.assertEqual(list(listar_originais(media)), ['produtos/foto.png'])
+            # Lidas do manifesto gravado na geração, sem consultar o storage
+            with mock.patch('core.imagens.default_storage.exists') as exists:
+                self.assertEqual(
+                    srcset('produtos/foto.png', 'webp'),
+                    '/media/produtos/foto__card.webp 400w, /media/produtos/foto__galeria.webp 800w, '
+                    '/media/produtos/foto__zoom.webp 1600w'
+                )
+                self.assertEqual(derivada('produtos/foto.png', 'card'), '/media/produtos/foto__card.jpg')
+            exists.assert_not_called()
+
+
+class MidiaPorConteudoTest(TestCase):
+    def test_mesmo_conteudo_um_arquivo_apagado_na_ultima_referencia(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            categoria = Categoria.objects.create(nome="Roupas")
+            primeiro = Produto.objects.create(nome="Camiseta", preco=50, categoria=categoria)
+            primeiro.imagem.save('frente.jpg', ContentFile(b'mesma foto'))
+            segundo = ImagemProduto(produto=primeiro)
+            segundo.imagem.save('copia.jpg', ContentFile(b'mesma foto'))
+
+            self.assertEqual(primeiro.imagem.name, segundo.imagem.name)
+            self.assertEqual(ArquivoMidia.objects.get(nome=primeiro.imagem.name).referencias, 2)
+            caminho = primeiro.imagem.path
+
+            with self.captureOnCommitCallbacks(execute=True):
+                segundo.delete()
+            self.assertTrue(os.path.exists(caminho))
+
+            ArquivoMidia.objects.update(referencias=9)  # desvio
+            recalcular_referencias()
+            self.assertEqual(ArquivoMidia.objects.get(nome=primeiro.imagem.name).referencias, 1)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                primeiro.delete()
+            self.assertFalse(os.path.exists(caminho))
+            self.assertFalse(ArquivoMidia.objects.exists())
+
+    def test_upload_do_mesmo_conteudo_protege_o_arquivo_da_remocao(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            produto = Produto.objects.create(nome="Camiseta", preco=50, categoria=Categoria.objects.create(nome="Roupas"))
+            produto.imagem.save('frente.jpg', ContentFile(b'mesma foto'))
+            nome = produto.imagem.name
+            ArquivoMidia.objects.filter(nome=nome).update(referencias=0)  # última referência removida em outra requisição
+
+            # Upload reaproveita o arquivo; a remoção agendada roda antes do post_save do upload
+            self.assertEqual(armazenamento_por_conteudo.save('copia.jpg', ContentFile(b'mesma foto')), nome)
+            self.assertFalse(apagar_se_orfao(nome))
+            self.assertTrue(armazenamento_por_conteudo.exists(nome))
+
+            ImagemProduto.objects.create(produto=produto, imagem=nome)
+            self.assertEqual(ArquivoMidia.objects.get(nome=nome).referencias, 1)
+
+    def test_save_que_falha_desfaz_a_contagem_do_upload(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            produto = Produto.objects.create(nome="Camiseta", preco=50, categoria=Categoria.objects.create(nome="Roupas"))
+            imagem = ImagemProduto(produto=produto, imagem=ContentFile(b'foto nova', name='nova.jpg'))
+            with mock.patch.object(ImagemProduto, '_do_insert', side_effect=IntegrityError), \
+                    self.captureOnCommitCallbacks(execute=True), self.assertRaises(IntegrityError):
+                imagem.save()
+            self.assertFalse(ArquivoMidia.objects.filter(referencias__gt=0).exists())
+            self.assertFalse(armazenamento_por_conteudo.exists(imagem.imagem.name))
+
+            # Sem reserva sobrando: o próximo save do mesmo conteúdo conta a sua referência
+            imagem = ImagemProduto.objects.create(produto=produto, imagem=ContentFile(b'foto nova', name='nova.jpg'))
+            self.assertEqual(ArquivoMidia.objects.get(nome=imagem.imagem.name).referencias, 1)
+
+
+class ImportacaoCatalogoTest(TestCase):
+    def test_importa_em_lotes_com_upsert_e_erros_por_linha(self):
+        Categoria.objects.create(nome="Roupas")
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        AtributoTipo.objects.create(nome="Tamanho", tipo="size")
+        AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        linhas = [
+            (2, {'sku': 'CAM1', 'nome': 'Camiseta', 'preco': '59,90', 'categoria': 'roupas', 'marca': 'Acme',
+                 'tags': 'verao;basico', 'atributos': 'Cor=Azul;Tamanho=M', 'estoque': '5'}),
+            (3, {'sku': 'CAM1', 'nome': 'Camiseta', 'preco': '59,90', 'categoria': 'roupas',
+                 'atributos': 'Cor=Azul;Tamanho=G', 'estoque': '0'}),
+            (4, {'sku': 'CAM2', 'nome': 'Camiseta', 'preco': '10', 'categoria': 'Inexistente'}),
+            (5, '{"sku": "CAM3", "nome": "Regata", "preco": "abc", "categoria": "Roupas"}'),
+        ]
+        erros = []
+        totais = ImportadorCatalogo(tamanho_lote=2, ao_errar=lambda numero, mensagem: erros.append(numero)).importar(linhas)
+
+        self.assertEqual((totais['produtos'], totais['variacoes'], totais['erros']), (1, 2, 2))
+        self.assertEqual(erros, [4, 5])
+        produto = Produto.objects.get(sku='CAM1')
+        self.assertEqual((produto.slug, str(produto.preco), produto.marca.nome), ('camiseta', '59.90', 'Acme'))
+        self.assertEqual(sorted(produto.tags.values_list('nome', flat=True)), ['basico', 'verao'])
+        self.assertEqual(
+            sorted(produto.variacoes.values_list('sku', 'estoque')), [('CAM1-AZ-G', 0), ('CAM1-AZ-M', 5)]
+        )
+        self.assertTrue(ProdutoCard.objects.filter(produto=produto).exists())
+        self.assertEqual(Categoria.objects.get(nome="Roupas").total_produtos, 1)
+        # Similares: marcados na transação do lote, calculados depois pelo comando
+        self.assertEqual(list(SimilarPendente.objects.values_list('produto_id', flat=True)), [produto.id])
+        atualizar_pendentes()
+        self.assertFalse(SimilarPendente.objects.exists())
+
+        # Reimportar atualiza em vez de duplicar
+        ImportadorCatalogo().importar([(2, {'sku': 'CAM1', 'preco': '49.90', 'atributos': 'Cor=Azul;Tamanho=M', 'estoque': '9'})])
+        produto.refresh_from_db()
+        self.assertEqual((str(produto.preco), produto.nome, produto.variacoes.count()), ('49.90', 'Camiseta', 2))
+        self.assertEqual(produto.variacoes.get(sku='CAM1-AZ-M').estoque, 9)
+        self.assertEqual(produto.historico_precos.count(), 1)
+
+    def test_celula_vazia_e_regravacao_linha_a_linha_seguem_o_lote(self):
+        Categoria.objects.create(nome="Roupas")
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        AtributoValor.objects.create(tipo=cor, valor="Preto", codigo="PT")
+        ImportadorCatalogo().importar([
+            (2, {'sku': 'CAM1', 'nome': 'Camiseta', 'preco': '59.90', 'categoria': 'Roupas', 'marca': 'Acme'}),
+        ])
+        ImportadorCatalogo().importar([(2, {'sku': 'CAM1', 'nome': '', 'preco': '49.90', 'marca': ' '})])
+        produto = Produto.objects.get(sku='CAM1')
+        self.assertEqual((produto.nome, str(produto.preco), produto.marca.nome), ('Camiseta', '49.90', 'Acme'))
+
+        # O SKU de variação repetido derruba o lote; na regravação a 2ª linha do SKU só acrescenta a variação
+        erros = []
+        totais = ImportadorCatalogo(ao_errar=lambda numero, mensagem: erros.append(numero)).importar([
+            (2, {'sku': 'CAM2', 'nome': 'Regata', 'preco': '30', 'categoria': 'Roupas', 'atributos': 'Cor=Azul'}),
+            (3, {'sku': 'CAM2', 'nome': 'Outra', 'preco': '99', 'atributos': 'Cor=Preto'}),
+            (4, {'sku': 'CAM3', 'nome': 'Bermuda', 'preco': '40', 'categoria': 'Roupas', 'atributos': 'Cor=Azul'}),
+            (5, {'sku': 'CAM3', 'atributos': 'Cor=Preto', 'variacao_sku': 'CAM2-PT'}),
+        ])
+        self.assertEqual(erros, [5])
+        self.assertEqual((totais['produtos'], totais['variacoes']), (2, 3))
+        regata = Produto.objects.get(sku='CAM2')
+        self.assertEqual((regata.nome, str(regata.preco)), ('Regata', '30.00'))
+        self.assertEqual(sorted(regata.variacoes.values_list('sku', flat=True)), ['CAM2-AZ', 'CAM2-PT'])
+
+
+class GerarCombinacoesTest(TestCase):
+    def test_cria_grade_e_pula_combinacoes_existentes(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        produto = Produto.objects.create(nome="Camisa", preco=80, categoria=categoria, sku="CAM")
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        tamanho = AtributoTipo.objects.create(nome="Tamanho", tipo="size", ordem=1)
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        verde = AtributoValor.objects.create(tipo=cor, valor="Verde", valor_adicional_preco=5)
+        p = AtributoValor.objects.create(tipo=tamanho, valor="P", codigo="P")
+        m = AtributoValor.objects.create(tipo=tamanho, valor="M", codigo="M")
+
+        criadas = gerar_combinacoes(produto, [azul.id, p.id], estoque=2)
+        self.assertEqual([variacao.sku for variacao in criadas], ["CAM-AZ-P"])
+        criadas = gerar_combinacoes(produto, [azul.id, verde.id, p.id, m.id])
+        self.assertEqual(sorted(variacao.sku for variacao in criadas), ["CAM-AZ-M", "CAM-VER-M", "CAM-VER-P"])
+        self.assertEqual(produto.variacoes.get(sku="CAM-VER-P").preco_adicional, 5)
+        self.assertEqual(produto.variacoes.get(sku="CAM-AZ-P").atributos.count(), 2)
+
+        # clean compara pelo hash, sem carregar as outras variações
+        variacao = produto.variacoes.get(sku="CAM-AZ-M")
+        with self.assertNumQueries(3):
+            variacao.full_clean(validate_unique=False, validate_constraints=False)
+        ProdutoVariacao.atributos.through.objects.filter(produtovariacao=variacao, atributovalor=m).update(
+            atributovalor=p
+        )
+        with self.assertRaises(ValidationError):
+            variacao.full_clean(validate_unique=False, validate_constraints=False)
+
+    def test_combinacao_repetida_no_m2m_vira_validation_error(self):
+        produto = Produto.objects.create(nome="Camisa", preco=80, categoria=Categoria.objects.create(nome="Roupas"))
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul")
+        verde = AtributoValor.objects.create(tipo=cor, valor="Verde")
+        primeira, segunda = gerar_combinacoes(produto, [azul.id, verde.id])
+        if primeira.atributos.get() != azul:
+            primeira, segunda = segunda, primeira
+
+        with self.assertRaises(ValidationError), transaction.atomic():
+            segunda.atributos.set([azul])
+        self.assertEqual(list(segunda.atributos.all()), [verde])
+
+        form = ProdutoVariacaoAdminForm(instance=segunda, data={
+            'produto': produto.pk, 'atributos': [azul.pk], 'estoque': 0, 'preco_adicional': 0, 'ativo': True,
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('atributos', form.errors)
+
+
+class PedidosMixin:
+    def setUp(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produtos = [
+                Produto.objects.create(nome=f"Produto {i}", preco=50, categoria=categoria) for i in range(4)
+            ]
+        self.usuario = User.objects.create_user(username="cliente", password="senha-segura-123")
+        self.endereco = Endereco.objects.create(
+            usuario=self.usuario, nome_completo="Maria Silva", telefone="(11) 99999-9999", rua="Rua A", numero="10",
+            bairro="Centro", cep="01000-000", cidade="São Paulo", estado="SP"
+        )
+
+    def _pedido(self, status, *produtos, quantidade=1):
+        pedido = Pedido.objects.create(status=status, usuario=self.usuario, endereco_entrega=self.endereco)
+        ItemPedido.objects.bulk_create(
+            ItemPedido(pedido=pedido, produto=produto, quantidade=quantidade, preco_unitario=50)
+            for produto in produtos
+        )
+        return pedido
+
+
+class RecomendacoesTest(PedidosMixin, TestCase):
+    def _vizinhos(self, produto):
+        return list(
+            ProdutoRelacionado.objects.filter(produto=produto, tipo='comprados_juntos').order_by('posicao').values_list('relacionado_id', flat=True)
+        )
+
+    @mock.patch.dict(RECOMENDACOES_CONFIG, MIN_COOCORRENCIAS=1)
+    def test_reconstroi_e_atualiza_por_pedido(self):
+        p1, p2, p3, p4 = self.produtos
+        self._pedido("C", p1, p2)
+        self._pedido("C", p1, p2, p3)
+        self._pedido("PA", p1, p3)
+        self._pedido("C", p4)
+        self._pedido("X", p2, p3)  # cancelado não conta
+
+        resultado = reconstruir()
+        self.assertEqual(resultado['pedidos'], 4)
+        self.assertEqual(CoocorrenciaProduto.objects.get(produto_a=p1, produto_b=p1).pedidos, 3)
+        # cosseno: p1 = 2/sqrt(3*2) > p3 = 1/sqrt(2*2)
+        self.assertEqual(self._vizinhos(p2), [p1.id, p3.id])
+        self.assertEqual(self._vizinhos(p4), [])
+        self.assertEqual([card.pk for card in obter_relacionados(p2.id)], [p1.id, p3.id])
+
+        # Pedido pago soma os pares dele; cancelado depois, subtrai
+        pedido = self._pedido("P", p2, p4)
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.status = "PA"
+            pedido.save()
+        self.assertEqual(CoocorrenciaProduto.objects.get(produto_a=p2, produto_b=p4).pedidos, 1)
+        self.assertEqual(self._vizinhos(p4), [p2.id])
+        self.assertEqual([card.pk for card in obter_relacionados(p4.id)], [p2.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.status = "X"
+            pedido.save()
+        self.assertFalse(CoocorrenciaProduto.objects.filter(produto_a=p2, produto_b=p4).exists())
+        self.assertEqual(self._vizinhos(p4), [])
+
+
+class SimilaresTest(TestCase):
+    def test_similares_por_caracteristicas(self):
+        roupas = Categoria.objects.create(nome="Roupas")
+        calcados = Categoria.objects.create(nome="Calçados")
+        marca = Marca.objects.create(nome="Marca X")
+        verao = Tag.objects.create(nome="Verão")
+        with self.captureOnCommitCallbacks(execute=True):
+            camisa = Produto.objects.create(nome="Camisa", preco=50, categoria=roupas, marca=marca, temporada="verao")
+            regata = Produto.objects.create(nome="Regata", preco=40, categoria=roupas, marca=marca, temporada="verao")
+            calca = Produto.objects.create(nome="Calça", preco=90, categoria=roupas, temporada="inverno")
+            tenis = Produto.objects.create(nome="Tênis", preco=200, categoria=calcados, genero="F")
+            camisa.tags.add(verao)
+            regata.tags.add(verao)
+
+        self.assertEqual(atualizar_similares(), 6)
+        self.assertEqual([card.pk for card in obter_relacionados(camisa.id, 'similares')], [regata.id, calca.id])
+        self.assertEqual(obter_relacionados(tenis.id, 'similares'), [])
+
+        # Produto novo, sem vendas, é marcado pelos signals e entra no cálculo dos pendentes
+        with self.captureOnCommitCallbacks(execute=True):
+            bermuda = Produto.objects.create(nome="Bermuda", preco=60, categoria=roupas, marca=marca, temporada="verao")
+            bermuda.tags.add(verao)
+        atualizar_pendentes()
+        self.assertEqual(obter_relacionados(bermuda.id, 'similares')[0].pk, camisa.id)
+        self.assertIn(bermuda.id, [card.pk for card in obter_relacionados(camisa.id, 'similares')])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bermuda.ativo = False
+            bermuda.save()
+        atualizar_pendentes()
+        self.assertNotIn(bermuda.id, [card.pk for card in obter_relacionados(camisa.id, 'similares')])
+
+    def test_alteracoes_marcam_pendentes_e_o_lote_calcula_sem_revetorizar(self):
+        roupas = Categoria.objects.create(nome="Roupas")
+        verao = Tag.objects.create(nome="Verão")
+        camisa = Produto.objects.create(nome="Camisa", preco=50, categoria=roupas, temporada="verao")
+        recalcular_catalogo()
+
+        with mock.patch('core.similares.atualizar_similares', wraps=similares.atualizar_similares) as atualizar, \
+                mock.patch('core.similares.construir_matriz', wraps=similares.construir_matriz) as construir:
+            with self.captureOnCommitCallbacks(execute=True):
+                regata = Produto.objects.create(nome="Regata", preco=40, categoria=roupas, temporada="verao")
+                regata.tags.add(verao)
+                camisa.tags.add(verao)
+            # Nada é calculado na requisição
+            atualizar.assert_not_called()
+            self.assertEqual(set(SimilarPendente.objects.values_list('produto_id', flat=True)), {camisa.id, regata.id})
+
+            self.assertEqual(atualizar_pendentes(), 2)
+        self.assertEqual(atualizar.call_count, 1)
+        self.assertEqual(set(atualizar.call_args.args[0]), {camisa.id, regata.id})
+        construir.assert_not_called()
+        self.assertFalse(SimilarPendente.objects.exists())
+        self.assertEqual([card.pk for card in obter_relacionados(camisa.id, 'similares')], [regata.id])
+
+    def test_pendentes_ficam_marcados_sem_lock_ou_com_falha(self):
+        roupas = Categoria.objects.create(nome="Roupas")
+        camisa = Produto.objects.create(nome="Camisa", preco=50, categoria=roupas)
+
+        cache.add(similares.SIMILARES_CONFIG['CHAVE_LOCK'], True)
+        self.assertIsNone(atualizar_pendentes())
+        cache.delete(similares.SIMILARES_CONFIG['CHAVE_LOCK'])
+        self.assertTrue(SimilarPendente.objects.filter(produto_id=camisa.id).exists())
+
+        with mock.patch('core.similares.atualizar_similares', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            atualizar_pendentes()
+        self.assertTrue(SimilarPendente.objects.filter(produto_id=camisa.id).exists())
+        self.assertIsNone(cache.get(similares.SIMILARES_CONFIG['CHAVE_LOCK']))
+
+
+class RankingsTest(PedidosMixin, TestCase):
+    def _ordem(self, sort):
+        return list(
+            ProdutoCard.objects.filter(ativo=True).order_by(*ORDENACOES_LISTAGEM[sort]).values_list('pk', flat=True)
+        )
+
+    def test_mais_vendidos_e_em_alta(self):
+        p1, p2, p3, p4 = self.produtos
+        antigos = [self._pedido("C", p1), self._pedido("PA", p1, quantidade=2)]
+        Pedido.objects.filter(pk__in=[pedido.pk for pedido in antigos]).update(
+            data_criacao=timezone.now() - timezone.timedelta(days=30)
+        )
+        self._pedido("C", p2)
+        self._pedido("X", p3, quantidade=10)  # cancelado não conta
+
+        self.assertEqual(reconstruir_rankings(), {'produtos': 2, 'unidades': 4})
+        self.assertEqual(ProdutoCard.objects.get(pk=p1.pk).unidades_vendidas, 3)
+        self.assertEqual(self._ordem('bestsellers')[:2], [p1.id, p2.id])
+        # 1 unidade hoje vale mais que 3 há 30 dias (meia-vida de 7 dias)
+        self.assertEqual(self._ordem('trending')[:2], [p2.id, p1.id])
+
+        pedido = self._pedido("P", p3, quantidade=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.status = "PA"
+            pedido.save()
+        self.assertEqual(ProdutoCard.objects.get(pk=p3.pk).unidades_vendidas, 5)
+        self.assertEqual(self._ordem('bestsellers')[0], p3.id)
+        self.assertEqual(self._ordem('trending')[0], p3.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            pedido.status = "X"
+            pedido.save()
+        card = ProdutoCard.objects.get(pk=p3.pk)
+        self.assertEqual((card.unidades_vendidas, card.tendencia), (0, 0))
+
+    def test_reconstruir_traz_a_epoca_para_agora(self):
+        p1, p2 = self.produtos[:2]
+        daqui_a_30_anos = timezone.now() + timezone.timedelta(days=365 * 30)  # 2^(dias/7) já estouraria o float64
+        Pedido.objects.filter(pk=self._pedido("PA", p1).pk).update(data_criacao=daqui_a_30_anos)
+
+        reconstruir_rankings(agora=daqui_a_30_anos)
+        self.assertEqual(epoca_atual(), daqui_a_30_anos)
+        self.assertAlmostEqual(ProdutoCard.objects.get(pk=p1.pk).tendencia, 1.0)
+
+        aplicar_pedido(self._pedido("PA", p2, quantidade=2).pk, 1, momento=daqui_a_30_anos)
+        self.assertAlmostEqual(ProdutoCard.objects.get(pk=p2.pk).tendencia, 2.0)
+
+    def test_pedido_somado_pela_reconstrucao_nao_conta_duas_vezes(self):
+        p1 = self.produtos[0]
+        with self.captureOnCommitCallbacks() as callbacks:
+            pedido = self._pedido("PA", p1, quantidade=2)
+        # A reconstrução roda entre o commit do pagamento e o aplicar_pedido agendado
+        reconstruir_rankings()
+        for callback in callbacks:
+            callback()
+        self.assertEqual(ProdutoCard.objects.get(pk=p1.pk).unidades_vendidas, 2)
+
+        pedido.delete()
+        self.assertEqual(ProdutoCard.objects.get(pk=p1.pk).unidades_vendidas, 0)
+
+
+class VendaCatalogoTest(PedidosMixin, TestCase):
+    def test_venda_so_invalida_o_catalogo_quando_o_estoque_zera(self):
+        produto = self.produtos[0]
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        with self.captureOnCommitCallbacks(execute=True):
+            variacao = gerar_combinacoes(produto, [azul.id], estoque=2)[0]
+        pedido = Pedido.objects.create(status="P", usuario=self.usuario, endereco_entrega=self.endereco)
+
+        def _vender():
+            geracao = obter_geracao('catalogo')
+            with self.captureOnCommitCallbacks(execute=True):
+                ItemPedido.objects.create(pedido=pedido, produto=produto, variacao=variacao, quantidade=1, preco_unitario=50)
+            return obter_geracao('catalogo') != geracao
+
+        self.assertFalse(_vender())
+        self.assertTrue(_vender())  # estoque zerado: o card sai dos filtros de cor e de estoque
+        self.assertFalse(ProdutoCard.objects.get(pk=produto.pk).em_estoque)
+
+
+@mock.patch.dict(FEEDS_CONFIG, URLS_POR_SHARD=1)
+class FeedsTest(TestCase):
+    def test_gera_feed_e_sitemap_incrementais(self):
+        categoria = Categoria.objects.create(nome="Roupas")
+        cor = AtributoTipo.objects.create(nome="Cor", tipo="color")
+        azul = AtributoValor.objects.create(tipo=cor, valor="Azul", codigo="AZ")
+        agora = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            camisa = Produto.objects.create(
+                nome="Camisa", preco=80, categoria=categoria, sku="CAM", preco_promocional=60,
+                promocao_inicio=agora, promocao_fim=agora + timezone.timedelta(days=2),
+            )
+            gerar_combinacoes(camisa, [azul.id], estoque=3)
+            Produto.objects.create(nome="Calça", preco=120, categoria=categoria)
+            Produto.objects.create(nome="Inativo", preco=10, categoria=categoria, ativo=False)
+
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            self.assertEqual(gerar_feeds(), {'shards': 2, 'regravados': 2, 'removidos': 0, 'urls': 2})
+
+            with gzip.open(caminho_arquivo('produtos.csv.gz'), 'rt', encoding='utf-8', newline='') as arquivo:
+                linhas = {linha['id']: linha for linha in csv.DictReader(arquivo)}
+            self.assertEqual(len(linhas), 2)
+            self.assertEqual(linhas['CAM-AZ']['item_group_id'], 'CAM')
+            self.assertEqual(linhas['CAM-AZ']['color'], 'Azul')
+            self.assertEqual(linhas['CAM-AZ']['availability'], 'in_stock')
+            self.assertEqual(linhas['CAM-AZ']['sale_price'], '60.00 BRL')
+
+            with gzip.open(caminho_arquivo('produtos.xml.gz')) as arquivo:
+                self.assertEqual(len(ElementTree.parse(arquivo).findall('./channel/item')), 2)
+            indice = ElementTree.parse(caminho_arquivo('sitemap.xml')).getroot()
+            self.assertEqual(len(indice), 2)
+
+            # Sem mudanças nada é regravado; mudar um produto regrava só o shard dele
+            self.assertEqual(gerar_feeds()['regravados'], 0)
+            with self.captureOnCommitCallbacks(execute=True):
+                camisa.nome = "Camisa Polo"
+                camisa.save()
+            self.assertEqual(gerar_feeds()['regravados'], 1)
+
+            response = self.client.get('/sitemap.xml')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/xml')
+
+
+class CondicionalTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        categoria = Categoria.objects.create(nome="Roupas")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produto = Produto.objects.create(nome="Camisa", preco=80, categoria=categoria)
+
+    def test_pagina_produto_responde_304_ate_mudar(self):
+        url = f'/produto/{self.produto.pk}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.produto.nome = "Camisa Polo"
+            self.produto.save()
+        # Não responde 304; o corpo ainda vem do cache_page até expirar, com o ETag dele
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        cache.clear()
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+    def test_pagina_produto_com_last_modified(self):
+        url = f'/produto/{self.produto.pk}/'
+        ultima = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=ultima).status_code, 304)
+
+        Produto.objects.filter(pk=self.produto.pk).update(updated_at=timezone.now() + timezone.timedelta(minutes=1))
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=ultima).status_code, 200)
+
+    def test_contador_carrinho_usa_versao_do_usuario(self):
+        usuario = User.objects.create_user(username="cliente", password="senha-segura-123")
+        self.client.force_login(usuario)
+        etag = self.client.get('/api/cart/count/')['ETag']
+        self.assertEqual(self.client.get('/api/cart/count/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        carrinho, _ = Carrinho.objects.get_or_create(usuario=usuario)
+        ItemCarrinho.objects.create(carrinho=carrinho, produto=self.produto, quantidade=2)
+        response = self.client.get('/api/cart/count/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 1)
+
+
+class NamespacesCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.produto = Produto.objects.create(
+            nome="Camiseta", preco=100, categoria=Categoria.objects.create(nome="Roupas")
+        )
+
+    def test_geracao_invalida_escopo_ou_namespace(self):
+        chave = montar_chave('produto', 'preco', escopo=1)
+        outra = montar_chave('produto', 'preco', escopo=2)
+        invalidar_namespace('produto', 1)
+        self.assertNotEqual(montar_chave('produto', 'preco', escopo=1), chave)
+        self.assertEqual(montar_chave('produto', 'preco', escopo=2), outra)
+
+        invalidar_namespace('produto')
+        self.assertNotEqual(montar_chave('produto', 'preco', escopo=2), outra)
+        with self.assertRaises(ValueError):
+            montar_chave('inexistente', 'chave')
+
+    def test_save_do_produto_renova_preco_e_desconto(self):
+        self.assertEqual(self.produto.preco_vigente(), 100)
+        self.produto.preco = 80
+        self.produto.save()
+        self.assertEqual(self.produto.preco_vigente(), 80)
+        self.assertEqual(self.produto.desconto, 20)
+
+    def test_libera_reservas_expiradas_e_invalida_a_variacao(self):
+        variacao = ProdutoVariacao.objects.bulk_create([
+            ProdutoVariacao(produto=self.produto, sku="CAM-P", estoque=5, atributos_hash="p")
+        ])[0]
+        ReservaEstoque.reservar_estoque(variacao.id, 2, "sessao")
+        self.assertEqual(ReservaEstoque.get_quantidade_reservada(variacao.id), 2)
+
+        ReservaEstoque.objects.update(data_expiracao=timezone.now() - timezone.timedelta(minutes=1))
+        ReservaEstoque.liberar_reservas_expiradas()
+        self.assertEqual(ReservaEstoque.objects.get().status, 'E')
+        self.assertEqual(ReservaEstoque.get_quantidade_reservada(variacao.id), 0)
+
+
+class TagsCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.produto = Produto.objects.create(
+            nome="Camiseta", preco=100, categoria=Categoria.objects.create(nome="Roupas")
+        )
+        usuario = User.objects.create_user(username="cliente", password="senha-segura-123")
+        self.item = ItemCarrinho.objects.create(
+            carrinho=Carrinho.objects.create(usuario=usuario), produto=self.produto, quantidade=2
+        )
+
+    def test_valor_descartado_quando_uma_tag_muda(self):
+        calcular = mock.Mock(return_value='valor')
+        tags = [tag('produto', 1), tag('cupom', 'ABC')]
+        get_or_compute('teste_tags', calcular, tags=tags)
+        invalidar_tags([tag('produto', 2)])
+        self.assertEqual(get_or_compute('teste_tags', calcular, tags=tags), 'valor')
+        self.assertEqual(calcular.call_count, 1)
+        invalidar_tags(['cupom:ABC'])
+        get_or_compute('teste_tags', calcular, tags=tags)
+        self.assertEqual(calcular.call_count, 2)
+
+    def test_precos_do_carrinho_acompanham_o_produto(self):
+        self.assertEqual(self.item.preco_total(), 200)
+        self.assertEqual(self.item.carrinho.calcular_total(), 200)
+
+        self.produto.preco = 80
+        self.produto.save()
+        self.assertEqual(self.item.preco_unitario(), 80)
+        self.assertEqual(self.item.preco_total(), 160)
+        self.assertEqual(Carrinho.objects.get().calcular_total(), 160)
+
+
+class DoisNiveisCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        limpar_cache_local()
+        Categoria.objects.create(nome="Roupas")
+
+    def test_servido_da_memoria_e_invalidado_no_processo(self):
+        self.assertEqual([c.nome for c in Categoria.get_categorias_ativas()], ["Roupas"])
+        with self.assertNumQueries(0), mock.patch('core.cache.cache.get') as get:
+            Categoria.get_categorias_ativas()
+        get.assert_not_called()
+
+        Categoria.objects.create(nome="Calçados")
+        self.assertEqual(len(Categoria.get_categorias_ativas()), 2)
+
+    def test_produto_salvo_nao_invalida_dados_de_referencia(self):
+        Categoria.get_categorias_ativas()
+        with self.captureOnCommitCallbacks(execute=True):
+            Produto.objects.create(nome="Camiseta", preco=100, categoria=Categoria.objects.get())
+        with self.assertNumQueries(0):
+            Categoria.get_categorias_ativas()
+
+    def test_invalidacao_de_outro_worker_chega_apos_o_intervalo(self):
+        usuario = User.objects.create_user(username="cliente", password="senha-segura-123")
+        self.assertEqual(get_notificacoes_cache(usuario.id), 0)
+
+        # Outro worker grava e incrementa a geração; este processo não vê o incr na hora
+        Notificacao.objects.bulk_create([Notificacao(usuario=usuario, mensagem="Pedido enviado")])
+        cache.incr(f"{CACHE_CONFIG['PREFIXO_GERACAO']}usuario_{usuario.id}")
+        self.assertEqual(get_notificacoes_cache(usuario.id), 0)
+
+        agora = time.monotonic()
+        with mock.patch('core.cache.time.monotonic', return_value=agora + CACHE_CONFIG['INTERVALO_GERACOES'] + 1):
+            self.assertEqual(get_notificacoes_cache(usuario.id), 1)
+
+    def test_lru_limitado(self):
+        local = CacheLocal(tamanho_maximo=2, ttl=60)
+        local.gravar('a', 1)
+        local.gravar('b', 2)
+        local.obter('a')
+        local.gravar('c', 3)
+        self.assertEqual(len(local), 2)
+        self.assertEqual(local.obter('a'), 1)
+        self.assertEqual(local.obter('c'), 3)
+        self.assertNotEqual(local.obter('b'), 2)  # o menos usado saiu
+
+
+class StampedeCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calcular = mock.Mock(return_value='novo')
+        get_or_compute('teste_stampede', lambda: 'antigo', 60)
+        self.depois_de_expirar = time.time() + 120  # ainda dentro da JANELA_OBSOLETO
+
+    def test_expirado_recalculado_por_quem_pega_o_lock(self):
+        with mock.patch('core.cache.time.time', return_value=self.depois_de_expirar):
+            self.assertEqual(get_or_compute('teste_stampede', self.calcular, 60), 'novo')
+        self.calcular.assert_called_once()
+
+    def test_obsoleto_servido_enquanto_outro_worker_recalcula(self):
+        cache.add('lock_teste_stampede', True)
+        with mock.patch('core.cache.time.time', return_value=self.depois_de_expirar):
+            self.assertEqual(get_or_compute('teste_stampede', self.calcular, 60), 'antigo')
+        self.calcular.assert_not_called()
+
+    def test_sem_valor_espera_o_dono_do_lock(self):
+        cache.add('lock_outra_chave', True)
+
+        def _outro_worker_termina(segundos):
+            cache.delete('lock_outra_chave')
+            get_or_compute('outra_chave', lambda: 'do outro worker', 60)
+
+        with mock.patch('core.cache.time.sleep', side_effect=_outro_worker_termina):
+            self.assertEqual(get_or_compute('outra_chave', self.calcular, 60), 'do outro worker')
+        self.calcular.assert_not_called()
+
+    def test_lock_preso_calcula_sem_esperar_muito(self):
+        cache.add('lock_outra_chave', True)
+        inicio = time.monotonic()
+        self.assertEqual(get_or_compute('outra_chave', self.calcular, 60), 'novo')
+        self.assertLess(time.monotonic() - inicio, 2)
+
+    def test_invalidacao_durante_o_calculo_com_tags_do_valor(self):
+        def _tags(valor):
+            return [tag('produto', produto_id) for produto_id in valor]
+
+        # Sem registro anterior as tags só são conhecidas depois: um único cálculo
+        primeiro = mock.Mock(return_value=[1])
+        get_or_compute('itens', primeiro, 60, tags=_tags)
+        primeiro.assert_called_once()
+
+        def _recalcular():
+            invalidar_tags([tag('produto', 1)])  # outro worker altera o produto durante o cálculo
+            return [1]
+
+        # Recalculado com a geração de antes do cálculo: já nasce inválido
+        cache.set('itens', dict(cache.get('itens'), expira=0), 60)
+        get_or_compute('itens', _recalcular, 60, tags=_tags)
+        recalcular = mock.Mock(return_value=[1])
+        get_or_compute('itens', recalcular, 60, tags=_tags)
+        recalcular.assert_called_once()
+
+
+class MetricasCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        zerar_metricas()
+
+    def test_contadores_por_prefixo(self):
+        cache.get('produto_teste_preco')
+        cache.set('produto_teste_preco', 'R$ 10')
+        cache.get('produto_teste_preco')
+        cache.delete('produto_teste_preco')
+
+        linha = obter_metricas()['produto']
+        self.assertEqual((linha['acertos'], linha['faltas'], linha['gravacoes'], linha['remocoes']), (1, 1, 1, 1))
+        self.assertEqual(linha['operacoes'], 4)
+        self.assertEqual(linha['taxa_acerto'], 0.5)
+        self.assertGreater(linha['tamanho_medio_bytes'], 0)
+        self.assertEqual(prefixo_da_chave('lock_produto_1_preco'), 'lock_produto')
+        self.assertEqual(prefixo_da_chave('core.context_processors.get_enderecos_cache:5'),
+                         'core.context_processors.get_enderecos_cache')
+
+    def test_tamanho_por_amostra_e_envio_em_lote(self):
+        backend = caches['default']
+        with mock.patch('core.metricas_cache._tamanho', mock.Mock(return_value=7)) as tamanho:
+            for numero in range(20):
+                cache.set(f'produto_{numero}_preco', 'R$ 10')
+        self.assertEqual(tamanho.call_count, 2)
+
+        with mock.patch.object(backend.interno, 'incr') as incr, \
+                mock.patch.object(backend.interno, 'get_many', wraps=backend.interno.get_many) as get_many, \
+                mock.patch.object(backend.interno, 'set_many', wraps=backend.interno.set_many) as set_many:
+            backend.enviar_metricas()
+        incr.assert_not_called()
+        self.assertEqual((get_many.call_count, set_many.call_count), (1, 1))
+
+        linha = obter_metricas()['produto']
+        self.assertEqual((linha['gravacoes'], linha['bytes_gravados'], linha['tamanho_medio_bytes']), (20, 140, 7))
+
+        # Com outro worker enviando, os contadores ficam para o próximo envio
+        cache.get('produto_0_preco')
+        backend.interno.add('metricas_cache_lock_envio', 1, 5)
+        backend.enviar_metricas()
+        self.assertEqual(obter_metricas()['produto']['acertos'], 0)
+        backend.interno.delete('metricas_cache_lock_envio')
+        self.assertEqual(obter_metricas()['produto']['acertos'], 1)
+
+    def test_endpoint_so_para_staff(self):
+        User.objects.create_user(username="cliente", password="senha-segura-123")
+        User.objects.create_user(username="gerente", password="senha-segura-123", is_staff=True)
+        cache.get('carrinho_teste')
+
+        self.client.login(username="cliente", password="senha-segura-123")
+        self.assertEqual(self.client.get('/api/cache/metricas/').status_code, 302)
+
+        self.client.login(username="gerente", password="senha-segura-123")
+        response = self.client.get('/api/cache/metricas/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['prefixos']['carrinho']['faltas'], 1)
+
+
+class CupomCarrinhoTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        limpar_cache_local()
+        self.usuario = User.objects.create_user(username="cliente", password="senha-segura-123")
+        Cupom.objects.create(codigo="DEZ", tipo='percentual', desconto_percentual=10)
+        self.client.force_login(self.usuario)
+
+    @mock.patch('core.views.obter_carrinho_usuario', mock.Mock(return_value=None))
+    @mock.patch('core.views.obter_itens_do_carrinho', mock.Mock(return_value=([], Decimal('100.00'))))
+    def test_aplicar_e_remover_cupom_atualiza_o_total(self):
+        self.assertEqual(self.client.get('/carrinho/').context['total_carrinho_com_cupom'], Decimal('100.00'))
+
+        self.client.post('/carrinho/', {'cupom': 'DEZ'})
+        self.assertEqual(self.client.get('/carrinho/').context['total_carrinho_com_cupom'], Decimal('90.00'))
+
+        self.client.post('/carrinho/', {'remover_cupom': '1'})
+        self.assertEqual(self.client.get('/carrinho/').context['total_carrinho_com_cupom'], Decimal('100.00'))
@@ -0,0 +1,189 @@
+"""
+Matriz de disponibilidade das variações de um produto.
+
+Para a página do produto, todas as variações ativas são lidas em uma única
+consulta sobre a tabela de ligação variação/atributo e compactadas em uma
+matriz "combinação de valores -> variação (id, estoque, preço adicional)".
+A matriz vai para o template como JSON, e o item_view.js escolhe a
+variação sem voltar ao servidor. O cache fica no escopo do produto em
+core.cache, invalidado quando variações, estoques ou atributos mudam.
+
+gerar_combinacoes cria de uma vez a grade de variações (ex.: cores x
+tamanhos), pulando as combinações cujo atributos_hash já existe.
+"""
+import logging
+from decimal import Decimal
+from itertools import product as produto_cartesiano
+from typing import Iterable, List, Optional
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from core import busca, cards, facetas, similares
+from core.cache import get_or_compute, invalidar_escopos, montar_chave
+from core.models import AtributoTipo, AtributoValor, Produto, ProdutoVariacao
+from core.tarefas import apos_commit
+
+logger = logging.getLogger(__name__)
+
+VARIACOES_CONFIG = {
+    'TIMEOUT': 60 * 60 * 24,  # 24 horas; a geração do produto invalida antes disso
+}
+
+
+def chave_combinacao(valor_ids: Iterable[int]) -> str:
+    """Chave da combinação de valores, independente da ordem (ex.: '3-7')"""
+    return '-'.join(str(valor_id) for valor_id in sorted(valor_ids))
+
+
+def _ordenados(valores: dict) -> list:
+    return [dados for _, dados in sorted(valores.values(), key=lambda item: item[0])]
+
+
+def montar_matriz(produto_id: int) -> dict:
+    """Monta a matriz de disponibilidade do produto com uma única consulta"""
+    linhas = ProdutoVariacao.atributos.through.objects.filter(
+        produtovariacao__produto_id=produto_id,
+        produtovariacao__ativo=True,
+    ).order_by('produtovariacao_id').values_list(
+        'produtovariacao_id',
+        'produtovariacao__estoque',
+        'produtovariacao__preco_adicional',
+        'atributovalor_id',
+        'atributovalor__valor',
+        'atributovalor__codigo',
+        'atributovalor__ordem',
+        'atributovalor__tipo__tipo',
+    )
+
+    variacoes, cores, tamanhos = {}, {}, {}
+    for variacao_id, estoque, preco_adicional, valor_id, valor, codigo, ordem, tipo in linhas:
+        variacao = variacoes.setdefault(variacao_id, {
+            'estoque': estoque,
+            'preco_adicional': str(preco_adicional),
+            'atributos': [],
+            'cor': None,
+            'tamanho': None,
+        })
+        variacao['atributos'].append(valor_id)
+        dados = {'id': valor_id, 'valor': valor, 'codigo': codigo}
+        if tipo == 'color':
+            variacao['cor'] = valor_id
+            if estoque > 0:
+                cores[valor_id] = ((ordem, valor), dados)
+        elif tipo == 'size':
+            variacao['tamanho'] = valor_id
+            if estoque > 0:
+                tamanhos[valor_id] = ((ordem, valor), dados)
+
+    combinacoes, disponibilidade = {}, {}
+    for variacao_id, variacao in variacoes.items():
+        combinacoes[chave_combinacao(variacao['atributos'])] = variacao_id
+        if variacao['estoque'] > 0 and variacao['cor'] and variacao['tamanho']:
+            disponibilidade.setdefault(str(variacao['cor']), {})[str(variacao['tamanho'])] = variacao_id
+
+    return {
+        'variacoes': {str(variacao_id): variacao for variacao_id, variacao in variacoes.items()},
+        'combinacoes': combinacoes,
+        'disponibilidade': disponibilidade,
+        'cores': _ordenados(cores),
+        'tamanhos': _ordenados(tamanhos),
+    }
+
+
+def obter_matriz(produto_id: int) -> dict:
+    """Retorna a matriz de disponibilidade do produto com cache versionado"""
+    cache_key = montar_chave('produto', 'matriz_variacoes', escopo=produto_id)
+    return get_or_compute(cache_key, lambda: montar_matriz(produto_id), VARIACOES_CONFIG['TIMEOUT'])
+
+
+def invalidar_matrizes(produto_ids: Iterable[int]) -> None:
+    """Incrementa a geração dos produtos; as matrizes antigas expiram sozinhas"""
+    invalidar_escopos('produto', produto_ids)
+
+
+def agendar_invalidacao(produto_ids: Iterable[int]) -> None:
+    """Invalida as matrizes após o commit da transação corrente"""
+    ids = set(produto_ids)
+    if not ids:
+        return
+    apos_commit(invalidar_matrizes, ids, erro="Erro ao invalidar matriz de variações")
+
+
+def gerar_combinacoes(
+    produto: Produto,
+    valor_ids: Iterable[int],
+    estoque: int = 0,
+    preco_adicional: Optional[Decimal] = None,
+) -> List[ProdutoVariacao]:
+    """
+    Cria, em uma transação, uma variação para cada combinação dos valores
+    informados (produto cartesiano entre os tipos) que o produto ainda não
+    tem. Sem preco_adicional, usa a soma de valor_adicional_preco dos
+    valores. Retorna as variações criadas.
+    """
+    valores = list(AtributoValor.objects.filter(id__in=set(valor_ids)).select_related('tipo'))
+    if not valores:
+        raise ValidationError("Selecione ao menos um valor de atributo.")
+
+    por_tipo = {}
+    for valor in sorted(valores, key=lambda valor: (valor.tipo.ordem, valor.tipo.nome, valor.ordem, valor.valor)):
+        por_tipo.setdefault(valor.tipo_id, []).append(valor)
+    faltantes = [nome for tipo_id, nome in AtributoTipo.get_obrigatorios().items() if tipo_id not in por_tipo]
+    if faltantes:
+        raise ValidationError(f"Atributo obrigatório '{faltantes[0]}' não foi selecionado.")
+
+    combinacoes = {
+        ProdutoVariacao.hash_de_atributos(valor.id for valor in combinacao): combinacao
+        for combinacao in produto_cartesiano(*por_tipo.values())
+    }
+
+    with transaction.atomic():
+        # Serializa geradores concorrentes do mesmo produto
+        Produto.objects.select_for_update().filter(pk=produto.pk).exists()
+        existentes = set(
+            ProdutoVariacao.objects.filter(
+                produto=produto, atributos_hash__in=list(combinacoes)
+            ).values_list('atributos_hash', flat=True)
+        )
+
+        novas = []
+        for atributos_hash, combinacao in combinacoes.items():
+            if atributos_hash in existentes:
+                continue
+            novas.append(ProdutoVariacao(
+                produto=produto,
+                atributos_hash=atributos_hash,
+                sku=ProdutoVariacao.sku_de_atributos(produto.sku, combinacao),
+                estoque=estoque,
+                preco_adicional=(
+                    preco_adicional if preco_adicional is not None
+                    else sum((valor.valor_adicional_preco for valor in combinacao), Decimal('0'))
+                ),
+            ))
+
+        # SKU já usado por outra variação fica em branco, como quando o produto não tem SKU
+        em_uso = set(
+            ProdutoVariacao.objects.filter(
+                sku__in=[variacao.sku for variacao in novas if variacao.sku]
+            ).values_list('sku', flat=True)
+        )
+        for variacao in novas:
+            if variacao.sku in em_uso:
+                variacao.sku = None
+
+        ProdutoVariacao.objects.bulk_create(novas)
+        ProdutoVariacao.atributos.through.objects.bulk_create([
+            ProdutoVariacao.atributos.through(produtovariacao_id=variacao.id, atributovalor_id=valor.id)
+            for variacao in novas for valor in combinacoes[variacao.atributos_hash]
+        ])
+
+        # bulk_create não dispara os signals de ProdutoVariacao
+        if novas:
+            busca.agendar_atualizacao([produto.pk])
+            facetas.agendar_atualizacao([produto.pk])
+            cards.agendar_atualizacao([produto.pk])
+            similares.marcar_pendentes([produto.pk])
+            agendar_invalidacao([produto.pk])
+
+    return novas
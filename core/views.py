@@ -1,83 +1,49 @@
 from django.shortcuts import redirect
 from django.conf import settings
-from django.http import JsonResponse, Http404
+from django.http import FileResponse, JsonResponse, Http404
 from django.views.generic import TemplateView, ListView, DetailView, View
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db import models
+from django.contrib.admin.views.decorators import staff_member_required
 from core.models import (
     Produto, Endereco, ProdutoVariacao, Cupom, LogAcao, 
-    AtributoValor, ItemCarrinho, Categoria
+    AtributoValor, ItemCarrinho, ProdutoCard
+)
+from core.busca import buscar_produtos
+from core.facetas import filtrar as filtrar_facetas, obter_contagens as obter_contagens_facetas
+from core.cards import serializar_card
+from core.paginacao import PAGINACAO_CONFIG, paginar
+from core.histograma import obter_histograma
+from core.categorias import arvore_categorias, filtrar_por_categoria
+from core.variacoes import obter_matriz as obter_matriz_variacoes
+from core.sugestoes import SUGESTOES_CONFIG, obter_sugestoes
+from core.recomendacoes import obter_relacionados, relacionados_carrinho
+from core.similares import TIPO as SIMILARES
+from core.feeds import FEEDS_CONFIG, caminho_arquivo
+from core.condicional import etag_contador_carrinho, etag_listagem, etag_produto, ultima_modificacao_produto
+from core.cache import get_or_compute, invalidar_namespace, montar_chave, tag
+from core.metricas_cache import obter_metricas
+from checkout.utils import (
+    adicionar_ao_carrinho, cotar_frete_melhor_envio, obter_itens_do_carrinho, obter_carrinho_usuario, tags_itens_carrinho
 )
-from checkout.utils import adicionar_ao_carrinho, cotar_frete_melhor_envio, obter_itens_do_carrinho, obter_carrinho_usuario
-from decimal import Decimal
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page, never_cache
 from django.utils.decorators import method_decorator
-from functools import lru_cache, wraps
+from functools import wraps
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.decorators.csrf import csrf_protect
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 from django.utils.html import strip_tags
 import re
 from django.utils.cache import patch_cache_control
 import hashlib
 import logging
+import os
 
 # Configuração do logger
 logger = logging.getLogger(__name__)
 
-# Cache para categorias
-@lru_cache(maxsize=128)
-def obter_categorias_hierarquicas():
-    """
-    Retorna categorias organizadas hierarquicamente com subcategorias
-    """
-    cache_key = 'categorias_hierarquicas'
-    result = cache.get(cache_key)
-    
-    if result is None:
-        # Buscar todas as categorias com informações dos produtos
-        categorias_principais = Categoria.objects.filter(categoria_pai=None).prefetch_related(
-            'subcategorias', 
-            'produtos'
-        ).annotate(
-            total_produtos=models.Count('produtos', distinct=True)
-        ).order_by('nome')
-        
-        categorias_hierarquicas = []
-        
-        for categoria in categorias_principais:
-            # Contar produtos da categoria principal e subcategorias
-            produtos_categoria = categoria.total_produtos
-            produtos_subcategorias = sum(
-                sub.produtos.count() for sub in categoria.subcategorias.all()
-            )
-            total_produtos = produtos_categoria + produtos_subcategorias
-            
-            categoria_data = {
-                'categoria': categoria,
-                'total_produtos': total_produtos,
-                'subcategorias': []
-            }
-            
-            # Adicionar subcategorias ordenadas
-            for subcategoria in categoria.subcategorias.annotate(
-                total_produtos=models.Count('produtos', distinct=True)
-            ).order_by('nome'):
-                categoria_data['subcategorias'].append({
-                    'categoria': subcategoria,
-                    'total_produtos': subcategoria.total_produtos
-                })
-            
-            categorias_hierarquicas.append(categoria_data)
-            
-        cache.set(cache_key, categorias_hierarquicas, timeout=3600)  # Cache por 1 hora
-        result = categorias_hierarquicas
-    
-    return result
-
 # ==========================
 # Views relacionadas aos produtos
 # ==========================
@@ -85,22 +51,15 @@ def obter_categorias_hierarquicas():
 # Cache para views
 @method_decorator(cache_page(60 * 15), name='dispatch')  # Cache por 15 minutos
 class IndexView(ListView):
-    model = Produto
+    model = ProdutoCard
     template_name = 'index.html'
     context_object_name = 'produtos'
     
     def get_queryset(self):
-        return super().get_queryset().filter(ativo=True).select_related(
-            'categoria',
-            'marca'
-        ).prefetch_related(
-            'variacoes',
-            'variacoes__atributos',
-            'variacoes__atributos__tipo',
-            'imagens',
-            'tags'
-        )
+        # Cards já trazem preço, imagem, avaliação e variação padrão
+        return super().get_queryset().filter(ativo=True).with_preco_vigente().order_by('-created_at')
 
+@condition(etag_func=etag_contador_carrinho)
 def cart_count(request):
     count = 0
     if request.user.is_authenticated:
@@ -110,9 +69,15 @@ def cart_count(request):
     else:
         cart = request.session.get('carrinho', {})
         count = sum(item.get('quantidade', 0) for item in cart.values())
-    return JsonResponse({'count': count})
-
-# Cache para views
+    response = JsonResponse({'count': count})
+    # Consultado a cada 30s pelo base.js: o navegador revalida com If-None-Match e recebe 304
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+# Cache para views; o ETag responde 304 antes do cache e do template
+@method_decorator(
+    condition(etag_func=etag_produto, last_modified_func=ultima_modificacao_produto), name='dispatch'
+)
 @method_decorator(cache_page(60 * 15), name='dispatch')  # Cache por 15 minutos
 class ItemView(DetailView):
     model = Produto
@@ -124,88 +89,56 @@ class ItemView(DetailView):
             'categoria',
             'marca'
         ).prefetch_related(
-            'variacoes',
-            'variacoes__atributos',
-            'variacoes__atributos__tipo',
-            'imagens',
-            'avaliacoes'
+            'imagens'
         )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         produto = self.object
         
-        # Cache para dados do produto
-        cache_key = f'produto_{produto.id}_context'
-        cached_context = cache.get(cache_key)
+        # Dados básicos do produto
+        context['preco_vigente'] = produto.preco_vigente()
+        context['desconto'] = produto.calcular_desconto()
+        # Avaliações vêm dos agregados gravados no produto, sem consulta extra
+        context['media_avaliacoes'] = produto.media_avaliacoes()
+        context['distribuicao_avaliacoes'] = produto.distribuicao_avaliacoes()
         
-        if cached_context is None:
-            # Dados básicos do produto
-            context['preco_vigente'] = produto.preco_vigente()
-            context['desconto'] = produto.calcular_desconto()
-            context['media_avaliacoes'] = produto.media_avaliacoes()
-            
-            # Buscar cores e tamanhos disponíveis usando prefetch_related
-            cores_disponiveis = AtributoValor.objects.filter(
-                tipo__nome="Cor",
-                variacoes__produto=produto,
-                variacoes__estoque__gt=0,
-                variacoes__ativo=True
-            ).distinct().order_by('ordem', 'valor')
-            
-            tamanhos_disponiveis = AtributoValor.objects.filter(
-                tipo__nome="Tamanho",
-                variacoes__produto=produto,
-                variacoes__estoque__gt=0,
-                variacoes__ativo=True
-            ).distinct().order_by('ordem', 'valor')
-            
-            context.update({
-                'cores_disponiveis': cores_disponiveis,
-                'tamanhos_disponiveis': tamanhos_disponiveis,
-                'variacoes': produto.variacoes.all(),
-            })
-            
-            cache.set(cache_key, context, timeout=3600)  # Cache por 1 hora
-            cached_context = context
+        # Cores, tamanhos e combinações saem da matriz de disponibilidade (cache versionado)
+        matriz = obter_matriz_variacoes(produto.id)
+        context.update({
+            'cores_disponiveis': matriz['cores'],
+            'tamanhos_disponiveis': matriz['tamanhos'],
+            'disponibilidade': matriz['disponibilidade'],
+            'matriz_variacoes': matriz,
+        })
+        # Vizinhos pré-calculados por core.recomendacoes
+        context['comprados_juntos'] = obter_relacionados(produto.id)
+        context['similares'] = obter_relacionados(produto.id, SIMILARES)
         
-        return cached_context
+        return context
 
+# Ordenações da listagem; o pk no final torna a chave do cursor única.
+# preco_efetivo é o preço com promoção, anotado em SQL por with_preco_vigente()
+ORDENACOES_LISTAGEM = {
+    'price_asc': ('preco_efetivo', 'pk'),
+    'price_desc': ('-preco_efetivo', '-pk'),
+    'newest': ('-created_at', '-pk'),
+    'relevance': ('-relevancia', '-pk'),
+    # Mantidas por core.rankings no próprio card
+    'bestsellers': ('-unidades_vendidas', '-pk'),
+    'trending': ('-tendencia', '-pk'),
+}
+
+@method_decorator(condition(etag_func=etag_listagem), name='dispatch')
 @method_decorator(cache_page(60 * 15), name='dispatch')  # Cache por 15 minutos
 class Product_Listing(ListView):
-    model = Produto
+    model = ProdutoCard
     template_name = 'product_listing.html'
     context_object_name = 'produtos'
     paginate_by = 12
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(ativo=True).select_related(
-            'categoria',
-            'marca'
-        ).prefetch_related(
-            'variacoes',
-            'variacoes__atributos',
-            'variacoes__atributos__tipo',
-            'tags'
-        )
-        
-        # Cache para faixas de preço
-        cache_key = 'faixas_preco'
-        faixas = cache.get(cache_key)
-        
-        if faixas is None:
-            if queryset.exists():
-                preco_min_qs = queryset.order_by('preco').first().preco
-                preco_max_qs = queryset.order_by('-preco').first().preco
-                faixa1 = preco_min_qs + (preco_max_qs - preco_min_qs) * Decimal('0.33')
-                faixa2 = preco_min_qs + (preco_max_qs - preco_min_qs) * Decimal('0.66')
-                faixa1 = int(faixa1)
-                faixa2 = int(faixa2)
-            else:
-                faixa1 = faixa2 = 0
-                
-            faixas = {'faixa1': faixa1, 'faixa2': faixa2}
-            cache.set(cache_key, faixas, timeout=3600)  # Cache por 1 hora
+        queryset = super().get_queryset().filter(ativo=True).with_preco_vigente()
         
         # Sanitização de parâmetros de busca
         q = self.request.GET.get('q', '').strip()
@@ -222,86 +155,188 @@ class Product_Listing(ListView):
             preco_min, preco_max = 0, float('inf')
             
         # Validação de IDs
-        cores_ids = [int(id) for id in self.request.GET.getlist('cores') if id.isdigit()]
-        tamanhos_ids = [int(id) for id in self.request.GET.getlist('tamanhos') if id.isdigit()]
+        cores_ids = self._ids_parametro('cores')
+        tamanhos_ids = self._ids_parametro('tamanhos')
         
         # Aplicar filtros com dados sanitizados
         if q:
-            queryset = queryset.filter(
-                models.Q(nome__icontains=q) |
-                models.Q(descricao__icontains=q) |
-                models.Q(categoria__nome__icontains=q) |
-                models.Q(marca__nome__icontains=q) |
-                models.Q(tags__nome__icontains=q)
-            ).distinct()
-            
+            queryset = buscar_produtos(queryset, q, prefixo='produto__')
+
         if categoria:
-            queryset = queryset.filter(categoria__nome__icontains=categoria)
+            queryset = filtrar_por_categoria(queryset, categoria)
         if tag:
-            queryset = queryset.filter(tags__nome__iexact=tag)
+            queryset = queryset.filter(produto__tags__nome__iexact=tag)
+
+        # Histograma de preços do estado atual, antes do próprio filtro de preço
+        self.histograma = obter_histograma(
+            queryset,
+            {'q': q, 'categoria': categoria, 'tag': tag},
+            campo='preco_efetivo'
+        )
             
         # Filtros de preço com valores validados
-        queryset = queryset.filter(preco__gte=preco_min, preco__lte=preco_max)
+        queryset = queryset.filter(preco_efetivo__gte=preco_min)
+        if preco_max != float('inf'):
+            queryset = queryset.filter(preco_efetivo__lte=preco_max)
+
+        # Faixas pré-definidas pelos tercis do histograma
+        faixa = self.request.GET.get('faixa_preco')
+        faixa_1, faixa_2 = self.histograma['faixa_preco_1'], self.histograma['faixa_preco_2']
+        if faixa == 'faixa1':
+            queryset = queryset.filter(preco_efetivo__lte=faixa_1)
+        elif faixa == 'faixa2':
+            queryset = queryset.filter(preco_efetivo__gt=faixa_1, preco_efetivo__lte=faixa_2)
+        elif faixa == 'faixa3':
+            queryset = queryset.filter(preco_efetivo__gt=faixa_2)
         
-        # Filtros de atributos com IDs validados
-        if cores_ids:
-            queryset = queryset.filter(
-                variacoes__atributos__id__in=cores_ids,
-                variacoes__atributos__tipo__nome="Cor",
-                variacoes__ativo=True
-            ).distinct()
-            
-        if tamanhos_ids:
-            queryset = queryset.filter(
-                variacoes__atributos__id__in=tamanhos_ids,
-                variacoes__atributos__tipo__nome="Tamanho",
-                variacoes__ativo=True
-            ).distinct()
+        # Contagens do índice de facetas (cacheadas por estado); o filtro de atributos vai para o SQL
+        selecionados = {'Cor': cores_ids, 'Tamanho': tamanhos_ids}
+        self.contagens_facetas = obter_contagens_facetas(
+            queryset,
+            {'q': q, 'categoria': categoria, 'tag': tag, 'preco_min': preco_min, 'preco_max': preco_max,
+             'faixa': faixa},
+            selecionados
+        )
+        self.facetas_selecionadas = cores_ids | tamanhos_ids
+        queryset = filtrar_facetas(queryset, selecionados)
 
         # Ordenação
         sort = self.request.GET.get('sort')
-        if sort == 'price_asc':
-            queryset = queryset.order_by('preco')
-        elif sort == 'price_desc':
-            queryset = queryset.order_by('-preco')
-        elif sort == 'newest':
-            queryset = queryset.order_by('-created_at')
-        else:
-            queryset = queryset.order_by('-created_at')
+        if sort not in ORDENACOES_LISTAGEM or (sort == 'relevance' and not q):
+            sort = 'relevance' if q else 'newest'
+        self.ordenacao = ORDENACOES_LISTAGEM[sort]
+
+        return queryset.order_by(*self.ordenacao)
 
-        return queryset
+    def paginate_queryset(self, queryset, page_size):
+        """Pagina por cursor, sem COUNT; ?page=N só vale para as primeiras páginas"""
+        cursor = self.request.GET.get('cursor')
+        numero = 1
+        if not cursor:
+            try:
+                numero = int(self.request.GET.get('page', 1))
+            except (TypeError, ValueError):
+                numero = 1
+            if not 1 <= numero <= PAGINACAO_CONFIG['PAGINAS_OFFSET']:
+                raise Http404("Página indisponível")
+
+        pagina = paginar(queryset, self.ordenacao, page_size, cursor=cursor, numero=numero)
+        return None, pagina, pagina.itens, pagina.tem_proxima or pagina.tem_anterior
         
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Cache para filtros
-        cache_key = 'filtros_produtos'
-        filtros = cache.get(cache_key)
-        
-        if filtros is None:
-            cores = AtributoValor.objects.filter(
-                tipo__nome="Cor",
-                variacoes__produto__ativo=True,
-                variacoes__estoque__gt=0,
-                variacoes__ativo=True
-            ).distinct().order_by('ordem', 'valor')
-            
-            tamanhos = AtributoValor.objects.filter(
-                tipo__nome="Tamanho",
-                variacoes__produto__ativo=True,
-                variacoes__estoque__gt=0,
-                variacoes__ativo=True
-            ).distinct().order_by('ordem', 'valor')
-            
-            filtros = {
-                'cores': cores,
-                'tamanhos': tamanhos
-            }
-            cache.set(cache_key, filtros, timeout=3600)  # Cache por 1 hora
-            
-        context.update(filtros)
+        # Valores de atributos com contagem de produtos para o estado atual dos filtros
+        ids_valores = set(self.contagens_facetas) | self.facetas_selecionadas
+        valores = AtributoValor.objects.filter(
+            id__in=ids_valores,
+            tipo__nome__in=['Cor', 'Tamanho']
+        ).select_related('tipo').order_by('ordem', 'valor')
+
+        cores, tamanhos = [], []
+        for valor in valores:
+            valor.total = self.contagens_facetas.get(valor.id, 0)
+            valor.selecionado = valor.id in self.facetas_selecionadas
+            if valor.tipo.nome == 'Cor':
+                cores.append(valor)
+            else:
+                tamanhos.append(valor)
+
+        context.update({
+            'cores': cores,
+            'tamanhos': tamanhos,
+            'cores_disponiveis': cores,
+            'tamanhos_disponiveis': tamanhos,
+            'categorias_hierarquicas': arvore_categorias(),
+            'histograma_precos': self.histograma,
+            'faixa_preco_1': self.histograma['faixa_preco_1'],
+            'faixa_preco_2': self.histograma['faixa_preco_2'],
+            'preco_minimo': self.histograma['minimo'],
+            'preco_maximo': self.histograma['maximo'],
+        })
+        context.update(self._links_paginacao(context['page_obj']))
         return context
 
+    def _links_paginacao(self, pagina):
+        """Monta as URLs de navegação preservando os filtros atuais"""
+        def _url(**params):
+            query = self.request.GET.copy()
+            query.pop('page', None)
+            query.pop('cursor', None)
+            for chave, valor in params.items():
+                query[chave] = valor
+            return f'?{query.urlencode()}'
+
+        links = {'url_anterior': None, 'url_proxima': None, 'paginas': []}
+        if pagina.numero is not None:
+            limite = PAGINACAO_CONFIG['PAGINAS_OFFSET']
+            ultima = min(pagina.numero + 1 if pagina.tem_proxima else pagina.numero, limite)
+            links['paginas'] = [(numero, _url(page=numero)) for numero in range(1, ultima + 1)]
+            if pagina.numero > 1:
+                links['url_anterior'] = _url(page=pagina.numero - 1)
+            if pagina.tem_proxima:
+                if pagina.numero < limite:
+                    links['url_proxima'] = _url(page=pagina.numero + 1)
+                else:
+                    links['url_proxima'] = _url(cursor=pagina.proximo)
+        else:
+            if pagina.anterior:
+                links['url_anterior'] = _url(cursor=pagina.anterior)
+            if pagina.proximo:
+                links['url_proxima'] = _url(cursor=pagina.proximo)
+        return links
+
+    def _ids_parametro(self, nome):
+        """Lê ids repetidos (?cores=1&cores=2) ou separados por vírgula (?cores=1,2)"""
+        ids = set()
+        for valor in self.request.GET.getlist(nome):
+            ids.update(int(parte) for parte in valor.split(',') if parte.strip().isdigit())
+        return ids
+
+class ProdutosAPIView(Product_Listing):
+    """Listagem de produtos em JSON, com os mesmos filtros, ordenações e cursores da página"""
+
+    def get(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        _, pagina, itens, _ = self.paginate_queryset(queryset, self.paginate_by)
+        return JsonResponse({
+            'resultados': [serializar_card(card) for card in itens],
+            'proximo': pagina.proximo,
+            'anterior': pagina.anterior,
+            'facetas': {str(valor_id): total for valor_id, total in self.contagens_facetas.items()},
+        })
+
+@require_http_methods(["GET"])
+def sugestoes_busca(request):
+    """Autocomplete da busca: produtos, categorias, marcas e tags pelo prefixo digitado"""
+    texto = request.GET.get('q', '').strip()[:100]
+    try:
+        limite = int(request.GET.get('limite', SUGESTOES_CONFIG['LIMITE_PADRAO']))
+    except (TypeError, ValueError):
+        limite = SUGESTOES_CONFIG['LIMITE_PADRAO']
+    limite = max(1, min(limite, SUGESTOES_CONFIG['LIMITE_MAXIMO']))
+
+    response = JsonResponse({'q': texto, 'sugestoes': obter_sugestoes(texto, limite)})
+    patch_cache_control(response, public=True, max_age=SUGESTOES_CONFIG['MAX_AGE'])
+    return response
+
+@never_cache
+@staff_member_required
+@require_http_methods(["GET"])
+def metricas_cache(request):
+    """Métricas do cache por prefixo de chave (core.metricas_cache), somadas de todos os workers"""
+    return JsonResponse({'prefixos': obter_metricas()})
+
+@require_http_methods(["GET", "HEAD"])
+def sitemap_xml(request):
+    """Índice do sitemap gerado por core.feeds (os shards são servidos como mídia)"""
+    caminho = caminho_arquivo('sitemap.xml')
+    if not os.path.exists(caminho):
+        raise Http404("Sitemap ainda não gerado")
+    response = FileResponse(open(caminho, 'rb'), content_type='application/xml')
+    patch_cache_control(response, public=True, max_age=FEEDS_CONFIG['MAX_AGE'])
+    return response
+
 # ==========================
 # Views relacionadas ao carrinho
 # ==========================
@@ -337,10 +372,12 @@ class CartView(LoginRequiredMixin, TemplateView):
             raise PermissionDenied("Acesso negado")
             
         # Cache seguro para itens do carrinho
-        cache_key = get_cache_key(self.request, 'carrinho')
-        cached_data = cache.get(cache_key)
-        
-        if cached_data is None:
+        # O cupom da sessão entra na chave: aplicar ou remover troca de entrada
+        cache_key = montar_chave(
+            'carrinho', 'contexto', self.request.session.get('cupom') or 'sem_cupom', escopo=self.request.user.id
+        )
+
+        def _calcular():
             # Obtém itens do carrinho (já com produtos/variações populados)
             itens_carrinho, total = obter_itens_do_carrinho(self.request)
             
@@ -426,8 +463,9 @@ class CartView(LoginRequiredMixin, TemplateView):
             if cupom_codigo:
                 try:
                     cupom = Cupom.objects.get(codigo__iexact=cupom_codigo)
-                    if cupom.is_valido(self.request.user):
-                        total_com_cupom = cupom.aplicar(total)
+                    valido, _ = cupom.is_valido(self.request.user, pedido_valor=total)
+                    if valido:
+                        total_com_cupom, _ = cupom.aplicar(total)
                         desconto = total - total_com_cupom
                         total = total_com_cupom
                     else:
@@ -447,7 +485,11 @@ class CartView(LoginRequiredMixin, TemplateView):
             else:
                 cep_usuario = None
                 
-            cached_data = {
+            # Configurar headers de cache
+            response = self.render_to_response(context)
+            patch_cache_control(response, no_cache=True, no_store=True, must_revalidate=True)
+
+            return {
                 'itens_carrinho': itens_carrinho,
                 'total_carrinho': total,
                 'cupom': cupom,
@@ -455,24 +497,30 @@ class CartView(LoginRequiredMixin, TemplateView):
                 'total_carrinho_com_cupom': total,
                 'cep_usuario': cep_usuario
             }
-            
-            # Configurar headers de cache
-            response = self.render_to_response(context)
-            patch_cache_control(response, no_cache=True, no_store=True, must_revalidate=True)
-            
-            cache.set(cache_key, cached_data, timeout=300)  # 5 minutos
-            
+
+        def _tags(dados):
+            # Some se o carrinho, um produto, uma variação ou o cupom mudar
+            cupom = dados['cupom']
+            return tags_itens_carrinho(dados['itens_carrinho']) + ([tag('cupom', cupom.codigo)] if cupom else [])
+
+        # Curto: a validade do cupom (datas, usos) muda sem save() que incremente a tag
+        cached_data = get_or_compute(cache_key, _calcular, 60 * 5, tags=_tags)  # 5 minutos
         context.update(cached_data)
+        context['sugestoes_carrinho'] = relacionados_carrinho(
+            item['produto'].id for item in cached_data['itens_carrinho']
+        )
         return context
 
     def post(self, request, *args, **kwargs):
-        # Lógica do cupom (mantida igual)
+        # Lógica do cupom
+        cupom_anterior = request.session.get('cupom')
         cupom_codigo = request.POST.get('cupom', '').strip()
         if cupom_codigo:
             try:
                 cupom = Cupom.objects.get(codigo__iexact=cupom_codigo)
-                if not cupom.is_valido(request.user):
-                    raise ValidationError("Cupom inválido ou expirado.")
+                valido, mensagem = cupom.is_valido(request.user)
+                if not valido:
+                    raise ValidationError(mensagem or "Cupom inválido ou expirado.")
                 request.session['cupom'] = cupom.codigo
                 messages.success(request, "Cupom aplicado com sucesso!")
                 LogAcao.objects.create(
@@ -494,6 +542,8 @@ class CartView(LoginRequiredMixin, TemplateView):
                 acao="Removeu cupom",
                 detalhes=""
             )
+        if request.session.get('cupom') != cupom_anterior and request.user.is_authenticated:
+            invalidar_namespace('carrinho', request.user.id)
         return redirect('carrinho')
 
 # Classes de manipulação do carrinho (mantidas iguais)
@@ -525,8 +575,8 @@ class ManipularItemCarrinho(LoginRequiredMixin, View):
             item.save()
             
         # Invalidar cache do carrinho
-        cache_key = get_cache_key(request, 'carrinho')
-        cache.delete(cache_key)
+        if request.user.is_authenticated:
+            invalidar_namespace('carrinho', request.user.id)
         
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             itens_carrinho, subtotal = obter_itens_do_carrinho(request)
@@ -642,8 +692,8 @@ class AddToCartView(LoginRequiredMixin, View):
             
             if resultado:
                 # Invalidar cache do carrinho
-                cache_key = get_cache_key(request, 'carrinho')
-                cache.delete(cache_key)
+                if request.user.is_authenticated:
+                    invalidar_namespace('carrinho', request.user.id)
                 
                 LogAcao.objects.create(
                     usuario=request.user,